@@ -4,33 +4,508 @@ Here are the steps, with progress bar percentages for each step:
 
 document_to_pixels
 - 0%-3%: Convert document into a PDF (skipped if the input file is a PDF)
-- 3%-5%: Split PDF into individual pages, and count those pages
+- 3%-5%: Count the pages of the PDF
 - 5%-50%: Convert each page into pixels (each page takes 45/n%, where n is the number of pages)
 
 pixels_to_pdf:
-- 50%-95%: Convert each page of pixels into a PDF (each page takes 45/n%, where n is the number of pages)
-- 95%-100%: Compress the final PDF
+- 50%-93%: Convert each page of pixels into a PDF (each page takes 43/n%, where n is the number of pages)
+  - With OCR, 50%-65% converts the pages and 65%-93% OCRs them
+- 93%-95%: Merge the pages into a single PDF
+- 95%-100%: Compress the final PDF, in parallel chunks of pages
+
+Scratch files go in /tmp, which the host mounts as a tmpfs when the document
+is small enough. With CHECKPOINT=1, pixels-to-pdf writes the PDF of each page
+to /checkpoint instead, followed by a page-N.done file with the SHA-256 of
+each of its layers, and skips the pages that already have one, so the host can
+resume a conversion that was interrupted. Pages of pixels and the safe PDF are
+written straight to their volumes, /dangerzone and /safezone, so nothing gets
+copied across filesystems.
+
+With WAIT_FOR_PIXELS=1, pixels-to-pdf runs while document-to-pixels is still
+converting the document, and waits for the host to move each page into
+/dangerzone once it's validated. The host creates /dangerzone/stop if
+document-to-pixels fails.
+
+document-to-pixels --pages 1-10,50 only converts those pages of the document,
+and --max-pages N only the first N of them, numbered from 1 in the order they
+appear. The other pages are never rendered.
+
+Each line of output is a JSON event, tagged with PROTOCOL_VERSION:
+
+- progress: {error, text, percentage, stage, stage_seconds, remaining_seconds}
+- page: {stage, page, wall_seconds, cpu_seconds, bytes}, when a page is done
+- stage: {stage, wall_seconds, cpu_seconds, bytes}, when a stage is done
+- span: {name, start_time, wall_seconds, thread}, when a command or a step
+  like saving a page is done, for tracing
+- degraded: {stage, page, error}, when a page couldn't be converted in a
+  stage, and was replaced with a placeholder (see PAGE_ATTEMPTS)
+
+Page and stage events also have a start_time. Start times are in seconds since
+the epoch.
+
+With --stream, nothing is mounted, and files go through stdin and stdout
+instead. document-to-pixels reads the document from stdin, and
+pixels-to-pdf reads the same events that document-to-pixels writes:
+
+- num_pages: {num_pages}, as soon as the number of pages is known
+- pixels: {page, width, height, bytes}, when a page is done, followed by its
+  bytes of RGB pixels
+- file: {name, bytes}, from pixels-to-pdf when it's done, followed by the
+  bytes of the safe PDF (safe-output-compressed.pdf) or of the OCR report
+  (ocr-report.json)
+
+CPU time includes the commands that the container runs. Pages that are OCRed
+in parallel don't have their own CPU time, so theirs is null.
 """
 
+import argparse
+import concurrent.futures
+import contextlib
 import glob
+import hashlib
 import json
+import math
 import os
+import re
+import resource
 import shutil
 import subprocess
 import sys
-from typing import Dict, Optional
+import threading
+import time
+from typing import (
+    Any,
+    BinaryIO,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
 
 import magic
-from PIL import Image
+from PIL import Image, ImageDraw, ImageStat
+
+# Version of the JSON events that the container outputs and, with --stream,
+# reads
+PROTOCOL_VERSION = 1
+
+# Resolution that pages are rendered to pixels at, and that the safe PDF is
+# built with
+RENDER_DPI = 150
+
+# Limits on the pixel pages that images are decoded into
+MAX_PAGE_WIDTH = 10000
+MAX_PAGE_HEIGHT = 10000
+MAX_IMAGE_FRAMES = 1000
+
+# Read-only LibreOffice profile that's created when building the container
+LIBREOFFICE_PROFILE = "/opt/libreoffice-profile"
+
+# Where the document and the files of the conversion are. Environment
+# variables can move them, to run this script outside of the container.
+TMP_DIR = os.environ.get("DANGERZONE_TMP_DIR", "/tmp")
+PIXEL_DIR = os.environ.get("DANGERZONE_PIXEL_DIR", "/dangerzone")
+SAFE_DIR = os.environ.get("DANGERZONE_SAFE_DIR", "/safezone")
+CHECKPOINT_DIR = os.environ.get("DANGERZONE_CHECKPOINT_DIR", "/checkpoint")
+INPUT_FILE = os.path.join(TMP_DIR, "input_file")
+
+# OCR runs on a grayscale copy of each page, which is downsampled to at most
+# OCR_DPI (if set, otherwise DEFAULT_OCR_DPI) and to at most OCR_MAX_PIXELS.
+# With OCR_BINARIZE=1 the copy is also thresholded to black and white. By
+# default, only pages bigger than OCR_MAX_PIXELS are downsampled, since pages
+# are rendered at just 150 DPI, and tesseract misses more small text below
+# that. A lower OCR_DPI is faster, but needs checking on the documents at hand
+# (see OCR_REPORT).
+DEFAULT_OCR_DPI = RENDER_DPI
+OCR_MAX_PIXELS = 4000000
+OCR_BINARIZE_THRESHOLD = 50
+
+
+# Thresholds that classify_page() uses. Levels are grayscale values from 0
+# (black) to 255 (white), and ratios are a fraction of the page's pixels. The
+# paper is the most common level of at least PAPER_MIN_LEVEL, since scanned
+# or photographed paper is rarely white, and pixels within PAPER_TOLERANCE of
+# it are paper. Pixels at least INK_CONTRAST darker than the paper are ink.
+BLANK_TOLERANCE = 2
+PAPER_MIN_LEVEL = 128
+PAPER_TOLERANCE = 24
+INK_CONTRAST = 64
+NEAR_BLANK_MAX_INK = 0.00005
+IMAGE_MAX_PAPER = 0.35
+IMAGE_MIN_STDDEV = 40
+
+# How often pixels-to-pdf looks for the next page, with WAIT_FOR_PIXELS=1, in
+# seconds
+PIXELS_POLL_INTERVAL = 0.1
+
+# PDFs are merged in a tree, in parallel chunks of at most this many files
+MERGE_CHUNK_SIZE = 64
+
+# The safe PDF is compressed in parallel chunks of at most this many pages.
+# The first chunk gets COMPRESS_FIRST_TIMEOUT_PER_PAGE seconds per page, and
+# the rest get COMPRESS_TIMEOUT_FACTOR times as long as they should take at
+# the throughput measured so far, but never less than COMPRESS_MIN_TIMEOUT.
+COMPRESS_CHUNK_SIZE = 50
+COMPRESS_FIRST_TIMEOUT_PER_PAGE = 3
+COMPRESS_TIMEOUT_FACTOR = 10
+COMPRESS_MIN_TIMEOUT = 30
+
+# Each document gets a time budget, which is split across the stages of the
+# conversion. Each stage gets a base number of seconds, plus some for each MB
+# of input and for each page, all multiplied by DEADLINE_SCALE. A stage ends
+# by the end of the budget of all stages so far, so the time that a stage
+# doesn't use is left for the ones after it. DEADLINE optionally caps the
+# budget of the whole document, in seconds.
+DEADLINE_STAGES = ["convert", "render", "pdf", "ocr", "merge", "compress"]
+DEADLINE_BUDGETS: Dict[str, Tuple[float, float, float]] = {
+    # stage: (base, per MB, per page)
+    "convert": (60, 10, 0),
+    "render": (0, 0, 10),
+    "pdf": (0, 0, 5),
+    "ocr": (0, 0, 30),
+    "merge": (10, 0, 0.5),
+    "compress": (10, 0, 3),
+}
+
+
+# Each step of converting a page (rendering it, turning its pixels into a
+# PDF, OCRing it) is tried up to PAGE_ATTEMPTS times (the default of the
+# PAGE_ATTEMPTS environment variable), since the tools sometimes crash or time
+# out on a page that they convert fine the next time. With PLACEHOLDER_PAGES=1,
+# a page that still fails is replaced with a placeholder that says so, instead
+# of failing the whole document: a page of pixels, a page of the safe PDF, or
+# an empty text layer, depending on the step.
+PAGE_ATTEMPTS = 2
+
+# Size of placeholder pages whose real size isn't known (Letter), the color of
+# their marks, and how much their text is scaled up
+PLACEHOLDER_WIDTH = 1275
+PLACEHOLDER_HEIGHT = 1650
+PLACEHOLDER_COLOR = (200, 0, 0)
+PLACEHOLDER_TEXT_SCALE = 4
+
+
+class ConversionError(Exception):
+    pass
+
+
+class FatalConversionError(ConversionError):
+    """
+    An error that retrying pages can't fix, like running out of time or a
+    missing tool, so the whole document fails
+    """
 
 
 class DangerzoneConverter:
-    def __init__(self) -> None:
-        pass
+    def __init__(self, stream: bool = False) -> None:
+        self.percentage: float = 0.0
+        self.output_lock = threading.Lock()
+
+        # With stream, files go through stdin and stdout instead of volumes.
+        # Pages of pixels that pixels-to-pdf receives are announced with
+        # pixels_received, until the host closes stdin.
+        self.stream = stream
+        self.pixels_received = threading.Condition()
+        self.receiving_pixels = stream
+
+        # The host can also move the pages into /dangerzone while
+        # document-to-pixels is still running
+        self.pixels_pending = os.environ.get("WAIT_FOR_PIXELS") == "1"
+
+        # The host tells the container how much time the previous containers
+        # of this document already took, and how big the original input is
+        self.start_time = time.monotonic() - float(
+            os.environ.get("DEADLINE_ELAPSED") or 0
+        )
+        self.deadline_scale = float(os.environ.get("DEADLINE_SCALE") or 1)
+        self.deadline: Optional[float] = None
+        if os.environ.get("DEADLINE"):
+            self.deadline = float(os.environ["DEADLINE"])
+        if os.environ.get("INPUT_SIZE"):
+            self.input_size = int(os.environ["INPUT_SIZE"])
+        elif os.path.exists(INPUT_FILE):
+            self.input_size = os.path.getsize(INPUT_FILE)
+        else:
+            self.input_size = 0
+        self.ocr_enabled = (
+            os.environ.get("OCR") == "1" and os.environ.get("OCR_LANGUAGE", "") != ""
+        )
+        self.num_pages = int(os.environ.get("NUM_PAGES") or 0)
+        self.page_attempts = max(
+            1, int(os.environ.get("PAGE_ATTEMPTS") or PAGE_ATTEMPTS)
+        )
+        self.placeholder_pages = os.environ.get("PLACEHOLDER_PAGES") == "1"
+
+        # The PDFs of the pages go where the host can keep them, if it asks to
+        self.checkpoint = os.environ.get("CHECKPOINT") == "1"
+        if self.checkpoint:
+            self.page_dir = CHECKPOINT_DIR
+        else:
+            self.page_dir = TMP_DIR
+        self.stage: Optional[str] = None
+        self.start_stage("convert")
+
+    def start_stage(self, stage: str) -> None:
+        """
+        Start a stage of the conversion. The commands that it runs have to
+        finish before the end of its budget (see DEADLINE_BUDGETS).
+        """
+        budget = 0.0
+        for deadline_stage in DEADLINE_STAGES[: DEADLINE_STAGES.index(stage) + 1]:
+            if deadline_stage == "ocr" and not self.ocr_enabled:
+                continue
+            base, per_mb, per_page = DEADLINE_BUDGETS[deadline_stage]
+            budget += (
+                base
+                + per_mb * self.input_size / (1024 * 1024)
+                + per_page * self.num_pages
+            )
+        budget *= self.deadline_scale
+        if self.deadline is not None:
+            budget = min(budget, self.deadline)
 
-    def document_to_pixels(self) -> int:
-        percentage = 0.0
+        if self.stage is not None:
+            self.end_stage()
+        self.stage = stage
+        self.stage_start_wall_time = time.time()
+        self.stage_start_time = time.monotonic()
+        self.stage_start_cpu_time = cpu_time()
+        self.stage_end_time = self.start_time + budget
+        self.stage_bytes = 0
 
+    def end_stage(self) -> None:
+        """
+        Report how long the current stage took, and how many bytes it produced
+        """
+        self.output_event(
+            "stage",
+            {
+                "stage": self.stage,
+                "start_time": self.stage_start_wall_time,
+                "wall_seconds": round(time.monotonic() - self.stage_start_time, 3),
+                "cpu_seconds": round(cpu_time() - self.stage_start_cpu_time, 3),
+                "bytes": self.stage_bytes,
+            },
+        )
+
+    def page_done(
+        self,
+        page: int,
+        start_time: float,
+        start_cpu_time: Optional[float],
+        num_bytes: int,
+    ) -> None:
+        """
+        Report how long a page took in the current stage, and how many bytes it
+        produced. start_cpu_time is None if the page was converted in parallel
+        with others, since its CPU time can't be told apart from theirs.
+        """
+        if start_cpu_time is None:
+            cpu_seconds = None
+        else:
+            cpu_seconds = round(cpu_time() - start_cpu_time, 3)
+        wall_seconds = time.monotonic() - start_time
+        self.output_event(
+            "page",
+            {
+                "stage": self.stage,
+                "page": page,
+                "start_time": time.time() - wall_seconds,
+                "wall_seconds": round(wall_seconds, 3),
+                "cpu_seconds": cpu_seconds,
+                "bytes": num_bytes,
+            },
+        )
+        self.stage_bytes += num_bytes
+
+    def try_page(
+        self, description: str, attempt: Callable[[], None]
+    ) -> Optional[ConversionError]:
+        """
+        Run attempt, which converts a page (or a few) in the current stage,
+        until it succeeds or has failed page_attempts times. Returns None if it
+        succeeded. If it didn't, raises its last error, or with placeholder
+        pages, returns it so the caller can put a placeholder in its place.
+        """
+        for attempt_number in range(1, self.page_attempts + 1):
+            try:
+                attempt()
+                return None
+            except FatalConversionError:
+                raise
+            except ConversionError as e:
+                error = e
+                if attempt_number < self.page_attempts:
+                    self.output(
+                        False, f"{e}, trying {description} again", self.percentage
+                    )
+
+        if not self.placeholder_pages:
+            raise error
+        return error
+
+    def page_degraded(self, page: int, num_pages: int, error: ConversionError) -> None:
+        """
+        Tell the host that a page was replaced with a placeholder in the
+        current stage
+        """
+        self.output_event(
+            "degraded", {"stage": self.stage, "page": page, "error": str(error)}
+        )
+        self.output(
+            False,
+            f"{error}, replaced page {page}/{num_pages} with a placeholder",
+            self.percentage,
+        )
+
+    @contextlib.contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        """
+        Report how long the with block took, for tracing
+        """
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.output_event(
+                "span",
+                {
+                    "name": name,
+                    "start_time": start_time,
+                    "wall_seconds": round(time.time() - start_time, 6),
+                    "thread": threading.get_native_id(),
+                },
+            )
+
+    def send_file(self, event: str, fields: Dict[str, Any], filename: str) -> None:
+        """
+        Send a file to the host over stdout, as an event with its number of
+        bytes, followed by its contents
+        """
+        with self.output_lock:
+            fields["bytes"] = os.path.getsize(filename)
+            line = json.dumps({"version": PROTOCOL_VERSION, "event": event, **fields})
+            sys.stdout.write(line + "\n")
+            sys.stdout.flush()
+            with open(filename, "rb") as f:
+                shutil.copyfileobj(f, sys.stdout.buffer)
+            sys.stdout.buffer.flush()
+
+    def receive_pixels(self) -> None:
+        """
+        Receive the pages of pixels that the host streams over stdin, in a
+        thread, into the same files in /dangerzone that document-to-pixels
+        writes when it's mounted. pixels-to-pdf waits for each one with
+        wait_for_pixels().
+
+        It stops once all pages are there. It reads from its own file object
+        instead of sys.stdin, which Python closes when it exits, so a read in
+        progress doesn't get in the way of that.
+        """
+        num_pages = None
+        pages_received = 0
+        stdin = open(sys.stdin.fileno(), "rb", closefd=False)
+        try:
+            for line in stdin:
+                event = json.loads(line)
+                if event["event"] == "num_pages":
+                    num_pages = int(event["num_pages"])
+                    write_file_atomically(f"{PIXEL_DIR}/num_pages", str(num_pages))
+                elif event["event"] == "pixels":
+                    filename_base = f"{PIXEL_DIR}/page-{int(event['page'])}"
+                    with open(f"{filename_base}.rgb", "wb") as f:
+                        copy_bytes(stdin, f, event["bytes"])
+                    write_file_atomically(f"{filename_base}.width", str(event["width"]))
+                    write_file_atomically(
+                        f"{filename_base}.height", str(event["height"])
+                    )
+                    pages_received += 1
+                with self.pixels_received:
+                    self.pixels_received.notify_all()
+                if pages_received == num_pages:
+                    break
+        finally:
+            with self.pixels_received:
+                self.receiving_pixels = False
+                self.pixels_received.notify_all()
+
+    def wait_for_pixels(self, filename: str) -> None:
+        """
+        When streaming, or with WAIT_FOR_PIXELS=1, wait until the host has sent
+        the file with the number of pages, or the last file of a page
+        """
+        if self.pixels_pending:
+            while not os.path.exists(filename):
+                if os.path.exists(f"{PIXEL_DIR}/stop"):
+                    raise ConversionError("The host stopped sending pages")
+                if time.monotonic() >= self.stage_end_time:
+                    raise ConversionError(
+                        f"Error waiting for pages, the document ran out of time in the {self.stage} stage"
+                    )
+                time.sleep(PIXELS_POLL_INTERVAL)
+            return
+        if not self.stream:
+            return
+        with self.pixels_received:
+            while not os.path.exists(filename):
+                if not self.receiving_pixels:
+                    raise ConversionError("The host stopped sending pages")
+                remaining = self.stage_end_time - time.monotonic()
+                if remaining <= 0 or not self.pixels_received.wait(remaining):
+                    raise ConversionError(
+                        f"Error waiting for pages, the document ran out of time in the {self.stage} stage"
+                    )
+
+    def document_to_pixels(
+        self, pages: Optional[str] = None, max_pages: Optional[int] = None
+    ) -> int:
+        self.percentage = 0.0
+
+        if self.stream:
+            with self.span("receive document"):
+                with open(INPUT_FILE, "wb") as f:
+                    shutil.copyfileobj(sys.stdin.buffer, f)
+
+        pdf_filename = self.convert_to_pdf()
+        if pdf_filename is None:
+            # Images are already pixels, so decode them directly
+            self.image_to_pixels(pages, max_pages)
+        else:
+            self.percentage += 3
+            self.pdf_to_pixels(pdf_filename, pages, max_pages)
+
+        self.output(False, "Converted document to pixels", self.percentage)
+        return 0
+
+    def count_pages(self) -> int:
+        """
+        Count the pages of the document, so the host can split the conversion
+        into shards. Documents that get converted to a PDF first leave it in
+        /dangerzone/document.pdf, so shards don't need to convert them again.
+        """
+        self.percentage = 0.0
+
+        pdf_filename = self.convert_to_pdf(PIXEL_DIR)
+        if pdf_filename is None:
+            num_pages = self.count_image_frames()
+        else:
+            num_pages = self.count_pdf_pages(pdf_filename)
+            if pdf_filename != INPUT_FILE:
+                os.rename(pdf_filename, f"{PIXEL_DIR}/document.pdf")
+
+        self.save_num_pages(num_pages)
+        self.output(False, f"Document has {num_pages} pages", self.percentage)
+        return 0
+
+    def convert_to_pdf(self, output_dir: str = TMP_DIR) -> Optional[str]:
+        """
+        Convert the input document to a PDF in output_dir, and return its
+        filename. Returns None for images, which don't need to be converted,
+        and the input document itself for PDFs.
+        """
         conversions: Dict[str, Dict[str, Optional[str]]] = {
             # .pdf
             "application/pdf": {"type": None},
@@ -90,183 +565,181 @@ class DangerzoneConverter:
                 "libreoffice_output_filter": "calc_pdf_Export",
             },
             # .jpg
-            "image/jpeg": {"type": "convert"},
+            "image/jpeg": {"type": "image"},
             # .gif
-            "image/gif": {"type": "convert"},
+            "image/gif": {"type": "image"},
             # .png
-            "image/png": {"type": "convert"},
+            "image/png": {"type": "image"},
             # .tif
-            "image/tiff": {"type": "convert"},
-            "image/x-tiff": {"type": "convert"},
+            "image/tiff": {"type": "image"},
+            "image/x-tiff": {"type": "image"},
         }
 
         # Detect MIME type
         mime = magic.Magic(mime=True)
-        mime_type = mime.from_file("/tmp/input_file")
+        mime_type = mime.from_file(INPUT_FILE)
 
         # Validate MIME type
         if mime_type not in conversions:
-            self.output(True, "The document format is not supported", percentage)
-            return 1
+            raise ConversionError("The document format is not supported")
 
         # Convert input document to PDF
         conversion = conversions[mime_type]
-        if conversion["type"] is None:
-            pdf_filename = "/tmp/input_file"
+        if conversion["type"] == "image":
+            return None
+        elif conversion["type"] is None:
+            return INPUT_FILE
         elif conversion["type"] == "libreoffice":
-            self.output(False, "Converting to PDF using LibreOffice", percentage)
-            args = [
-                "libreoffice",
-                "--headless",
-                "--convert-to",
-                f"pdf:{conversion['libreoffice_output_filter']}",
-                "--outdir",
-                "/tmp",
-                "/tmp/input_file",
-            ]
-            try:
-                p = subprocess.run(
-                    args,
-                    stdout=subprocess.DEVNULL,
-                    stderr=subprocess.DEVNULL,
-                    timeout=60,
-                )
-            except subprocess.TimeoutExpired:
-                self.output(
-                    True,
-                    "Error converting document to PDF, LibreOffice timed out after 60 seconds",
-                    percentage,
-                )
-                return 1
+            self.output(False, "Converting to PDF using LibreOffice", self.percentage)
 
-            if p.returncode != 0:
-                self.output(
-                    True,
-                    f"Conversion to PDF with LibreOffice failed",
-                    percentage,
-                )
-                return 1
-            pdf_filename = "/tmp/input_file.pdf"
-        elif conversion["type"] == "convert":
-            self.output(False, "Converting to PDF using GraphicsMagick", percentage)
-            args = [
-                "gm",
-                "convert",
-                "/tmp/input_file",
-                "/tmp/input_file.pdf",
-            ]
-            try:
-                p = subprocess.run(
-                    args,
-                    stdout=subprocess.DEVNULL,
-                    stderr=subprocess.DEVNULL,
-                    timeout=60,
-                )
-            except subprocess.TimeoutExpired:
-                self.output(
-                    True,
-                    "Error converting document to PDF, GraphicsMagick timed out after 60 seconds",
-                    percentage,
-                )
-                return 1
-            if p.returncode != 0:
-                self.output(
-                    True,
-                    "Conversion to PDF with GraphicsMagick failed",
-                    percentage,
-                )
-                return 1
-            pdf_filename = "/tmp/input_file.pdf"
-        else:
-            self.output(
-                True,
-                "Invalid conversion type",
-                percentage,
+            # LibreOffice needs to write to its profile, so start from a copy
+            # of the warm one that's baked into the container image (outside
+            # of the container, LibreOffice creates a new one instead)
+            if os.path.isdir(LIBREOFFICE_PROFILE):
+                shutil.copytree(LIBREOFFICE_PROFILE, f"{TMP_DIR}/libreoffice-profile")
+            self.run_command(
+                [
+                    "libreoffice",
+                    "--headless",
+                    f"-env:UserInstallation=file://{TMP_DIR}/libreoffice-profile",
+                    "--convert-to",
+                    f"pdf:{conversion['libreoffice_output_filter']}",
+                    "--outdir",
+                    output_dir,
+                    INPUT_FILE,
+                ],
+                error_message="Conversion to PDF with LibreOffice failed",
+                timeout_message="Error converting document to PDF, LibreOffice timed out",
             )
-            return 1
-
-        percentage += 3
+            pdf_filename = os.path.join(
+                output_dir, f"{os.path.basename(INPUT_FILE)}.pdf"
+            )
+            self.stage_bytes += os.path.getsize(pdf_filename)
+            return pdf_filename
+        else:
+            raise ConversionError("Invalid conversion type")
 
-        # Separate PDF into pages
-        self.output(
-            False,
-            "Separating document into pages",
-            percentage,
+    def count_pdf_pages(self, pdf_filename: str) -> int:
+        stdout = self.run_command(
+            ["pdfinfo", pdf_filename],
+            error_message="Counting the pages of the PDF failed",
+            timeout_message="Error counting the pages of the PDF, pdfinfo timed out",
         )
-        args = ["pdftk", pdf_filename, "burst", "output", "/tmp/page-%d.pdf"]
+        m = re.search(rb"^Pages:\s*([0-9]+)\s*$", stdout, re.MULTILINE)
+        if not m or int(m.group(1)) <= 0:
+            raise ConversionError("The PDF has no pages")
+        return int(m.group(1))
+
+    def count_image_frames(self) -> int:
+        Image.MAX_IMAGE_PIXELS = MAX_PAGE_WIDTH * MAX_PAGE_HEIGHT
         try:
-            p = subprocess.run(
-                args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=60
-            )
-        except subprocess.TimeoutExpired:
-            self.output(
-                True,
-                "Error separating document into pages, pdfseparate timed out after 60 seconds",
-                percentage,
-            )
-            return 1
-        if p.returncode != 0:
-            self.output(
-                True,
-                "Separating document into pages failed",
-                percentage,
-            )
-            return 1
+            with Image.open(INPUT_FILE) as im:
+                return getattr(im, "n_frames", 1)
+        except (OSError, ValueError, Image.DecompressionBombError):
+            raise ConversionError("Reading the image failed")
+
+    def save_num_pages(self, num_pages: int) -> None:
+        """
+        Tell the host how many pages to expect, as soon as that's known
+        """
+        self.num_pages = num_pages
+        if self.stream:
+            self.output_event("num_pages", {"num_pages": num_pages})
+        else:
+            write_file_atomically(f"{PIXEL_DIR}/num_pages", str(num_pages))
 
-        page_filenames = glob.glob("/tmp/page-*.pdf")
+    def save_page(self, page: int, width: int, height: int) -> None:
+        """
+        Pages of pixels are written straight to /dangerzone/page-N.rgb, and
+        once one is complete, this tells the host so it can validate it while
+        the rest of the pages are converted. The .height file is written last,
+        and marks the page as complete.
+        """
+        with self.span(f"save page {page}"):
+            if self.stream:
+                # Send the page to the host instead, and make room for the next
+                self.send_file(
+                    "pixels",
+                    {"page": page, "width": width, "height": height},
+                    f"{PIXEL_DIR}/page-{page}.rgb",
+                )
+                os.remove(f"{PIXEL_DIR}/page-{page}.rgb")
+                return
+            write_file_atomically(f"{PIXEL_DIR}/page-{page}.width", str(width))
+            write_file_atomically(f"{PIXEL_DIR}/page-{page}.height", str(height))
 
-        percentage += 2
+    def pdf_to_pixels(
+        self,
+        pdf_filename: str,
+        pages: Optional[str] = None,
+        max_pages: Optional[int] = None,
+    ) -> None:
+        # Count the pages. They're rendered one at a time straight from the
+        # PDF, rather than burst into a PDF per page first, since that copies
+        # the fonts and images the pages share into every one of them. Only
+        # the selected pages are rendered, numbered from 1.
+        self.output(False, "Counting the pages of the document", self.percentage)
+        selected_pages = parse_page_selection(
+            pages, self.count_pdf_pages(pdf_filename), max_pages
+        )
+        num_pages = len(selected_pages)
+        self.save_num_pages(num_pages)
+        self.start_stage("render")
+
+        self.percentage += 2
 
         # Convert to RGB pixel data
-        percentage_per_page = 45.0 / len(page_filenames)
-        for page in range(1, len(page_filenames) + 1):
-            pdf_filename = f"/tmp/page-{page}.pdf"
-            png_filename = f"/tmp/page-{page}.png"
-            rgb_filename = f"/tmp/page-{page}.rgb"
-            width_filename = f"/tmp/page-{page}.width"
-            height_filename = f"/tmp/page-{page}.height"
-            filename_base = f"/tmp/page-{page}"
+        percentage_per_page = 45.0 / num_pages
+        for page in range(1, num_pages + 1):
+            page_start_time = time.monotonic()
+            page_start_cpu_time = cpu_time()
+            png_filename = f"{TMP_DIR}/page-{page}.png"
+            rgb_filename = f"{PIXEL_DIR}/page-{page}.rgb"
+            filename_base = f"{TMP_DIR}/page-{page}"
+            document_page = selected_pages[page - 1]
 
             self.output(
                 False,
-                f"Converting page {page}/{len(page_filenames)} to pixels",
-                percentage,
+                f"Converting page {page}/{num_pages} to pixels",
+                self.percentage,
             )
 
-            # Convert to png
-            try:
-                p = subprocess.run(
-                    ["pdftocairo", pdf_filename, "-png", "-singlefile", filename_base],
-                    stdout=subprocess.DEVNULL,
-                    stderr=subprocess.DEVNULL,
-                    timeout=60,
-                )
-            except subprocess.TimeoutExpired:
-                self.output(
-                    True,
-                    "Error converting from PDF to PNG, pdftocairo timed out after 60 seconds",
-                    percentage,
-                )
-                return 1
-            if p.returncode != 0:
-                self.output(
-                    True,
-                    "Conversion from PDF to PNG failed",
-                    percentage,
+            # The page's size is only known once it's rendered
+            width, height = 0, 0
+
+            def render_page() -> None:
+                nonlocal width, height
+
+                # Convert to png
+                self.run_command(
+                    [
+                        "pdftocairo",
+                        pdf_filename,
+                        "-f",
+                        str(document_page),
+                        "-l",
+                        str(document_page),
+                        "-png",
+                        "-r",
+                        str(RENDER_DPI),
+                        "-singlefile",
+                        filename_base,
+                    ],
+                    error_message=f"Page {page}/{num_pages} conversion from PDF to PNG failed",
+                    timeout_message="Error converting from PDF to PNG, pdftocairo timed out",
                 )
-                return 1
 
-            # Save the width and height
-            im = Image.open(png_filename)
-            width, height = im.size
-            with open(width_filename, "w") as f:
-                f.write(str(width))
-            with open(height_filename, "w") as f:
-                f.write(str(height))
+                # Get the width and height
+                try:
+                    with Image.open(png_filename) as im:
+                        width, height = im.size
+                except OSError:
+                    raise ConversionError(
+                        f"Page {page}/{num_pages} conversion from PDF to PNG failed"
+                    )
 
-            # Convert to RGB pixels
-            try:
-                p = subprocess.run(
+                # Convert to RGB pixels
+                self.run_command(
                     [
                         "gm",
                         "convert",
@@ -275,145 +748,228 @@ class DangerzoneConverter:
                         "8",
                         f"rgb:{rgb_filename}",
                     ],
-                    timeout=60,
-                )
-            except subprocess.TimeoutExpired:
-                self.output(
-                    True,
-                    "Error converting from PNG to pixels, convert timed out after 60 seconds",
-                    percentage,
-                )
-                return 1
-            if p.returncode != 0:
-                self.output(
-                    True,
-                    "Conversion from PNG to RGB failed",
-                    percentage,
+                    error_message=f"Page {page}/{num_pages} conversion from PNG to RGB failed",
+                    timeout_message="Error converting from PNG to pixels, convert timed out",
                 )
-                return 1
+
+            error = self.try_page(f"page {page}/{num_pages}", render_page)
+            if error is not None:
+                width, height = PLACEHOLDER_WIDTH, PLACEHOLDER_HEIGHT
+                with open(rgb_filename, "wb") as f:
+                    f.write(placeholder_image(width, height, page).tobytes())
+                self.page_degraded(page, num_pages, error)
 
             # Delete the png
-            os.remove(png_filename)
+            if os.path.exists(png_filename):
+                os.remove(png_filename)
 
-            percentage += percentage_per_page
+            self.save_page(page, width, height)
+            self.page_done(
+                page, page_start_time, page_start_cpu_time, width * height * 3
+            )
+            self.percentage += percentage_per_page
 
-        self.output(
-            False,
-            "Converted document to pixels",
-            percentage,
-        )
+    def image_to_pixels(
+        self, pages: Optional[str] = None, max_pages: Optional[int] = None
+    ) -> None:
+        """
+        Decode a raster image straight into pages of pixels, without turning
+        it into a PDF first. Every frame of a multi-frame image (like an
+        animated GIF or a multi-page TIFF) becomes a page, unless only some
+        of them are selected.
+        """
+        self.output(False, "Converting image to pixels", self.percentage)
 
-        # Move converted files into /dangerzone
-        for filename in (
-            glob.glob("/tmp/page-*.rgb")
-            + glob.glob("/tmp/page-*.width")
-            + glob.glob("/tmp/page-*.height")
-        ):
-            shutil.move(filename, "/dangerzone")
+        # Refuse to decode anything bigger than the largest allowed page
+        Image.MAX_IMAGE_PIXELS = MAX_PAGE_WIDTH * MAX_PAGE_HEIGHT
+        try:
+            with Image.open(INPUT_FILE) as im:
+                num_frames = getattr(im, "n_frames", 1)
+                if num_frames > MAX_IMAGE_FRAMES:
+                    raise ConversionError(
+                        f"The image has too many frames ({num_frames}, the maximum is {MAX_IMAGE_FRAMES})"
+                    )
+                selected_frames = parse_page_selection(pages, num_frames, max_pages)
+                num_pages = len(selected_frames)
+                self.save_num_pages(num_pages)
+                self.start_stage("render")
 
-        return 0
+                self.percentage += 5
+                percentage_per_page = 45.0 / num_pages
+                for page, frame_number in enumerate(selected_frames, start=1):
+                    page_start_time = time.monotonic()
+                    page_start_cpu_time = cpu_time()
+                    im.seek(frame_number - 1)
+                    frame = im
+                    self.output(
+                        False,
+                        f"Converting page {page}/{num_pages} to pixels",
+                        self.percentage,
+                    )
+
+                    # Check the size before decoding the frame
+                    width, height = frame.size
+                    if width > MAX_PAGE_WIDTH or height > MAX_PAGE_HEIGHT:
+                        raise ConversionError(
+                            f"Page {page}/{num_pages} is too large ({width}x{height} pixels, the maximum is {MAX_PAGE_WIDTH}x{MAX_PAGE_HEIGHT})"
+                        )
+
+                    def decode_frame() -> None:
+                        try:
+                            # Flatten any transparency onto a white background
+                            if frame.mode in ("RGBA", "LA", "PA") or (
+                                frame.mode == "P" and "transparency" in frame.info
+                            ):
+                                rgba = frame.convert("RGBA")
+                                rgb = Image.new("RGB", rgba.size, (255, 255, 255))
+                                rgb.paste(rgba, mask=rgba.getchannel("A"))
+                            else:
+                                rgb = frame.convert("RGB")
+                        except (OSError, ValueError):
+                            raise ConversionError(
+                                f"Page {page}/{num_pages} conversion from image to pixels failed"
+                            )
+
+                        with open(f"{PIXEL_DIR}/page-{page}.rgb", "wb") as f:
+                            f.write(rgb.tobytes())
+
+                    error = self.try_page(f"page {page}/{num_pages}", decode_frame)
+                    if error is not None:
+                        with open(f"{PIXEL_DIR}/page-{page}.rgb", "wb") as f:
+                            f.write(placeholder_image(width, height, page).tobytes())
+                        self.page_degraded(page, num_pages, error)
+
+                    self.save_page(page, width, height)
+                    self.page_done(
+                        page, page_start_time, page_start_cpu_time, width * height * 3
+                    )
+                    self.percentage += percentage_per_page
+        except (OSError, ValueError, Image.DecompressionBombError):
+            raise ConversionError("Conversion from image to pixels failed")
 
     def pixels_to_pdf(self) -> int:
-        percentage: float = 50.0
+        self.percentage = 50.0
 
-        num_pages = len(glob.glob("/dangerzone/page-*.rgb"))
+        self.wait_for_pixels(f"{PIXEL_DIR}/num_pages")
+        with open(f"{PIXEL_DIR}/num_pages") as f:
+            num_pages = int(f.read().strip())
+        self.num_pages = num_pages
+        self.start_stage("pdf")
+        ocr_lang = os.environ.get("OCR_LANGUAGE", "")
+        ocr = os.environ.get("OCR") == "1" and ocr_lang != ""
+        ocr_dpi = int(os.environ.get("OCR_DPI") or DEFAULT_OCR_DPI)
+        ocr_binarize = os.environ.get("OCR_BINARIZE") == "1"
+        ocr_report = os.environ.get("OCR_REPORT") == "1"
+        ocr_batch = os.environ.get("OCR_BATCH") == "1"
+        ocr_workers = int(os.environ.get("OCR_WORKERS") or os.cpu_count() or 1)
+        ocr_skip_pages = os.environ.get("OCR_SKIP_PAGES") == "1"
+        ocr_report_pages: List[Dict[str, Any]] = []
+        ocr_pages: List[int] = []
+        page_points: Dict[int, Tuple[float, float]] = {}
+        page_types = {"blank": 0, "near-blank": 0, "image": 0, "text": 0}
+        page_type_of: Dict[int, str] = {}
+        skipped_pages: List[int] = []
 
-        # Convert RGB files to PDF files
-        percentage_per_page = 45.0 / num_pages
+        # Convert RGB files to PDF files, and prepare the pages to OCR
+        if ocr:
+            percentage_per_page = 15.0 / num_pages
+        else:
+            percentage_per_page = 43.0 / num_pages
         for page in range(1, num_pages + 1):
-            filename_base = f"/dangerzone/page-{page}"
+            page_start_time = time.monotonic()
+            page_start_cpu_time = cpu_time()
+            filename_base = f"{PIXEL_DIR}/page-{page}"
             rgb_filename = f"{filename_base}.rgb"
             width_filename = f"{filename_base}.width"
             height_filename = f"{filename_base}.height"
-            png_filename = f"/tmp/page-{page}.png"
-            ocr_filename = f"/tmp/page-{page}"
-            pdf_filename = f"/tmp/page-{page}.pdf"
+            pdf_filename = f"{self.page_dir}/page-{page}.pdf"
 
+            if self.checkpoint and os.path.exists(f"{self.page_dir}/page-{page}.done"):
+                # The host checked this page's PDFs from an earlier run
+                self.percentage += percentage_per_page
+                continue
+
+            self.wait_for_pixels(height_filename)
             with open(width_filename) as f:
-                width = f.read().strip()
+                width = int(f.read().strip())
             with open(height_filename) as f:
-                height = f.read().strip()
+                height = int(f.read().strip())
 
-            if os.environ.get("OCR") == "1" and os.environ.get("OCR_LANGUAGE"):
-                # OCR the document
+            if ocr:
                 self.output(
                     False,
                     f"Converting page {page}/{num_pages} from pixels to searchable PDF",
-                    percentage,
+                    self.percentage,
                 )
-
-                args = [
-                    "gm",
-                    "convert",
-                    "-size",
-                    f"{width}x{height}",
-                    "-depth",
-                    "8",
-                    f"rgb:{rgb_filename}",
-                    f"png:{png_filename}",
-                ]
-                try:
-                    p = subprocess.run(
-                        args,
-                        stdout=subprocess.DEVNULL,
-                        stderr=subprocess.DEVNULL,
-                        timeout=60,
-                    )
-                except subprocess.TimeoutExpired:
-                    self.output(
-                        True,
-                        "Error converting pixels to PNG, convert timed out after 60 seconds",
-                        percentage,
-                    )
-                    return 1
-                if p.returncode != 0:
-                    self.output(
-                        True,
-                        f"Page {page}/{num_pages} conversion to PNG failed",
-                        percentage,
-                    )
-                    return 1
-
-                args = [
-                    "tesseract",
-                    png_filename,
-                    ocr_filename,
-                    "-l",
-                    os.environ.get("OCR_LANGUAGE"),  # type: ignore
-                    "--dpi",
-                    "70",
-                    "pdf",
-                ]
-                try:
-                    p = subprocess.run(
-                        args,
-                        stdout=subprocess.DEVNULL,
-                        stderr=subprocess.DEVNULL,
-                        timeout=60,
-                    )
-                except subprocess.TimeoutExpired:
-                    self.output(
-                        True,
-                        "Error converting PNG to searchable PDF, tesseract timed out after 60 seconds",
-                        percentage,
-                    )
-                    return 1
-                if p.returncode != 0:
-                    self.output(
-                        True,
-                        f"Page {page}/{num_pages} OCR failed",
-                        percentage,
-                    )
-                    return 1
-
             else:
-                # Don't OCR
                 self.output(
                     False,
                     f"Converting page {page}/{num_pages} from pixels to PDF",
-                    percentage,
+                    self.percentage,
+                )
+
+            page_type, color = classify_page(rgb_filename, width, height)
+            page_types[page_type] += 1
+            page_type_of[page] = page_type
+            # Blank pages have no text, and with OCR_SKIP_PAGES=1, pages that
+            # probably don't have any aren't OCRed either
+            skip_ocr = page_type == "blank" or (ocr_skip_pages and page_type != "text")
+            width_pt = width * 72 / RENDER_DPI
+            height_pt = height * 72 / RENDER_DPI
+            page_points[page] = (width_pt, height_pt)
+
+            if page_type == "blank":
+                # There is nothing on the page besides its background color, so
+                # draw just that instead of embedding the pixels
+                r, g, b = (c / 255 for c in color)
+                write_pdf_page(
+                    pdf_filename,
+                    width_pt,
+                    height_pt,
+                    f"{r:.3f} {g:.3f} {b:.3f} rg 0 0 {width_pt:.2f} {height_pt:.2f} re f".encode(),
                 )
+            else:
+                # The image layer always keeps the full resolution of the page
+                def image_layer() -> None:
+                    self.run_command(
+                        [
+                            "gm",
+                            "convert",
+                            "-size",
+                            f"{width}x{height}",
+                            "-depth",
+                            "8",
+                            "-units",
+                            "PixelsPerInch",
+                            "-density",
+                            str(RENDER_DPI),
+                            f"rgb:{rgb_filename}",
+                            f"pdf:{pdf_filename}",
+                        ],
+                        error_message=f"Page {page}/{num_pages} conversion to PDF failed",
+                        timeout_message="Error converting RGB to PDF, convert timed out",
+                    )
 
+                error = self.try_page(f"page {page}/{num_pages}", image_layer)
+                if error is not None:
+                    placeholder_image(width, height, page).save(
+                        pdf_filename, "PDF", resolution=RENDER_DPI
+                    )
+                    self.page_degraded(page, num_pages, error)
+                    # There's no text to find on the placeholder
+                    skip_ocr = True
+
+            if ocr and skip_ocr:
+                # Nothing to OCR, so this page gets an empty text layer
+                skipped_pages.append(page)
+                write_pdf_page(
+                    f"{self.page_dir}/page-{page}-text.pdf", width_pt, height_pt
+                )
+            elif ocr:
+                # OCR a grayscale (or black and white) copy of the page. Its
+                # density is scaled along with it, since tesseract lays out
+                # the text layer using it, to match the image layer's size.
+                ocr_width, ocr_height = ocr_geometry(width, height, ocr_dpi)
                 args = [
                     "gm",
                     "convert",
@@ -422,120 +978,824 @@ class DangerzoneConverter:
                     "-depth",
                     "8",
                     f"rgb:{rgb_filename}",
-                    f"pdf:{pdf_filename}",
+                    "-colorspace",
+                    "GRAY",
                 ]
-                try:
-                    p = subprocess.run(
+                if ocr_binarize:
+                    args += ["-threshold", f"{OCR_BINARIZE_THRESHOLD}%"]
+                args += [
+                    "-resize",
+                    f"{ocr_width}x{ocr_height}!",
+                    "-units",
+                    "PixelsPerInch",
+                    "-density",
+                    str(round(RENDER_DPI * ocr_width / width)),
+                    f"png:{TMP_DIR}/page-{page}-ocr.png",
+                ]
+
+                def ocr_image(args: List[str] = args) -> None:
+                    self.run_command(
                         args,
-                        stdout=subprocess.DEVNULL,
-                        stderr=subprocess.DEVNULL,
-                        timeout=60,
-                    )
-                except subprocess.TimeoutExpired:
-                    self.output(
-                        True,
-                        "Error converting RGB to PDF, convert timed out after 60 seconds",
-                        percentage,
+                        error_message=f"Page {page}/{num_pages} conversion to PNG failed",
+                        timeout_message="Error converting pixels to PNG, convert timed out",
                     )
-                    return 1
-                if p.returncode != 0:
-                    self.output(
-                        True,
-                        f"Page {page}/{num_pages} conversion to PDF failed",
-                        percentage,
+
+                error = self.try_page(f"page {page}/{num_pages}", ocr_image)
+                if error is None:
+                    ocr_pages.append(page)
+                else:
+                    # The page keeps its image, but can't be searched
+                    write_pdf_page(
+                        f"{self.page_dir}/page-{page}-text.pdf", width_pt, height_pt
                     )
-                    return 1
+                    self.page_degraded(page, num_pages, error)
+
+            # The page's pixels aren't needed anymore, so free up the host's
+            # disk space right away instead of once the document is done
+            os.remove(rgb_filename)
+            os.remove(width_filename)
+            os.remove(height_filename)
+
+            # Pages that are OCRed are done once their text layer is too
+            if self.checkpoint and page not in ocr_pages:
+                self.checkpoint_page(page, ocr)
+
+            self.page_done(
+                page,
+                page_start_time,
+                page_start_cpu_time,
+                os.path.getsize(pdf_filename),
+            )
+            self.percentage += percentage_per_page
 
-            percentage += percentage_per_page
+        if ocr_pages:
+            self.start_stage("ocr")
+            ocr_report_pages = self.ocr(
+                ocr_pages,
+                num_pages,
+                ocr_lang,
+                ocr_batch,
+                ocr_workers,
+                ocr_report,
+                page_points,
+            )
+        elif ocr:
+            self.percentage += 28.0
+        if ocr_report:
+            # Report the type of every page, and the ones that weren't OCRed,
+            # so the thresholds of classify_page() can be tuned
+            for report_page in ocr_report_pages:
+                report_page["type"] = page_type_of.get(report_page["page"])
+                report_page["skipped"] = False
+            for page in skipped_pages:
+                ocr_report_pages.append(
+                    {
+                        "page": page,
+                        "seconds": 0.0,
+                        "text": "",
+                        "type": page_type_of.get(page),
+                        "skipped": True,
+                    }
+                )
+            ocr_report_pages.sort(key=lambda report_page: report_page["page"])
 
         # Merge pages into a single PDF
+        self.start_stage("merge")
         self.output(
             False,
             f"Merging {num_pages} pages into a single PDF",
-            percentage,
+            self.percentage,
         )
-        args = ["pdfunite"]
-        for page in range(1, num_pages + 1):
-            args.append(f"/tmp/page-{page}.pdf")
-        args.append(f"/tmp/safe-output.pdf")
-        try:
-            p = subprocess.run(
-                args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=60
-            )
-        except subprocess.TimeoutExpired:
-            self.output(
-                True,
-                "Error merging pages into a single PDF, pdfunite timed out after 60 seconds",
-                percentage,
+        if ocr:
+            merged_filename = f"{TMP_DIR}/safe-output-image.pdf"
+        else:
+            merged_filename = f"{TMP_DIR}/safe-output.pdf"
+        page_filenames = [
+            f"{self.page_dir}/page-{page}.pdf" for page in range(1, num_pages + 1)
+        ]
+        self.merge_pdf_files(
+            page_filenames,
+            merged_filename,
+            error_message="Merging pages into a single PDF failed",
+            timeout_message="Error merging pages into a single PDF, pdfunite timed out",
+        )
+
+        # Only the sizes of the pages are needed from now on, to compress them
+        page_sizes = [os.path.getsize(filename) for filename in page_filenames]
+        if not self.checkpoint:
+            for filename in page_filenames:
+                os.remove(filename)
+
+        if ocr:
+            # Lay the invisible text layer of each page over its image
+            text_filenames = [
+                f"{self.page_dir}/page-{page}-text.pdf"
+                for page in range(1, num_pages + 1)
+            ]
+            self.merge_pdf_files(
+                text_filenames,
+                f"{TMP_DIR}/safe-output-text.pdf",
+                error_message="Merging text layers into a single PDF failed",
+                timeout_message="Error merging text layers into a single PDF, pdfunite timed out",
             )
-            return 1
-        if p.returncode != 0:
-            self.output(
-                True,
-                "Merging pages into a single PDF failed",
-                percentage,
+            if not self.checkpoint:
+                for filename in text_filenames:
+                    os.remove(filename)
+            self.run_command(
+                [
+                    "pdftk",
+                    merged_filename,
+                    "multistamp",
+                    f"{TMP_DIR}/safe-output-text.pdf",
+                    "output",
+                    f"{TMP_DIR}/safe-output.pdf",
+                ],
+                error_message="Adding the text layer to the PDF failed",
+                timeout_message="Error adding the text layer to the PDF, pdftk timed out",
             )
-            return 1
+            os.remove(merged_filename)
+            os.remove(f"{TMP_DIR}/safe-output-text.pdf")
 
-        percentage += 2
+        self.stage_bytes += os.path.getsize(f"{TMP_DIR}/safe-output.pdf")
+        self.percentage += 2
+
+        skipped_types = ["blank"]
+        if ocr and ocr_skip_pages:
+            skipped_types += ["near-blank", "image"]
+        skipped = [
+            f"{page_types[page_type]} {page_type}"
+            for page_type in skipped_types
+            if page_types[page_type]
+        ]
+        if skipped:
+            if ocr:
+                text = "Skipped OCR on " + ", ".join(skipped) + " pages"
+            else:
+                text = "Skipped " + ", ".join(skipped) + " pages"
+            self.output(False, text, self.percentage)
 
         # Compress
+        self.start_stage("compress")
+        self.output(False, "Compressing PDF", self.percentage)
+        self.compress_pdf(
+            f"{TMP_DIR}/safe-output.pdf",
+            f"{SAFE_DIR}/safe-output-compressed.pdf",
+            page_sizes,
+        )
+        self.stage_bytes += os.path.getsize(f"{SAFE_DIR}/safe-output-compressed.pdf")
+        os.remove(f"{TMP_DIR}/safe-output.pdf")
+
+        self.percentage = 100.0
+        self.output(False, "Safe PDF created", self.percentage)
+        if ocr and ocr_report:
+            with open(f"{SAFE_DIR}/ocr-report.json", "w") as f:
+                json.dump(
+                    {
+                        "ocr_language": ocr_lang,
+                        "ocr_dpi": ocr_dpi,
+                        "binarize": ocr_binarize,
+                        "batch": ocr_batch,
+                        "workers": ocr_workers,
+                        "skip_pages": ocr_skip_pages,
+                        "page_types": page_types,
+                        "pages": ocr_report_pages,
+                    },
+                    f,
+                    indent=4,
+                )
+
+        if self.stream:
+            with self.span("send safe PDF"):
+                for name in ["safe-output-compressed.pdf", "ocr-report.json"]:
+                    if os.path.exists(f"{SAFE_DIR}/{name}"):
+                        self.send_file("file", {"name": name}, f"{SAFE_DIR}/{name}")
+
+        return 0
+
+    def merge_pdfs(self) -> int:
+        """
+        Merge the safe PDFs of the shards of a document, /dangerzone/part-N.pdf,
+        into a single safe PDF
+        """
+        self.percentage = 95.0
+        self.start_stage("merge")
+
+        num_parts = len(glob.glob(f"{PIXEL_DIR}/part-*.pdf"))
         self.output(
-            False,
-            f"Compressing PDF",
-            percentage,
+            False, f"Merging {num_parts} parts into a single PDF", self.percentage
         )
-        compress_timeout = num_pages * 3
-        try:
-            p = subprocess.run(
-                ["ps2pdf", "/tmp/safe-output.pdf", "/tmp/safe-output-compressed.pdf"],
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.DEVNULL,
-                timeout=compress_timeout,
+        self.merge_pdf_files(
+            [f"{PIXEL_DIR}/part-{part}.pdf" for part in range(1, num_parts + 1)],
+            f"{SAFE_DIR}/safe-output-compressed.pdf",
+            error_message="Merging parts into a single PDF failed",
+            timeout_message="Error merging parts into a single PDF, pdfunite timed out",
+        )
+        self.stage_bytes += os.path.getsize(f"{SAFE_DIR}/safe-output-compressed.pdf")
+
+        self.percentage = 100.0
+        self.output(False, "Safe PDF created", self.percentage)
+        return 0
+
+    def merge_pdf_files(
+        self,
+        filenames: List[str],
+        output_filename: str,
+        error_message: str,
+        timeout_message: str,
+    ) -> None:
+        """
+        Merge PDF files into output_filename with pdfunite. Instead of passing
+        every file to a single pdfunite process, they are merged in a tree:
+        chunks of up to MERGE_CHUNK_SIZE files are merged in parallel into
+        intermediate PDFs in /tmp, which are merged the same way, until one is
+        left.
+        """
+        output_base = os.path.join(
+            TMP_DIR, os.path.splitext(os.path.basename(output_filename))[0]
+        )
+        level = 0
+        while len(filenames) > MERGE_CHUNK_SIZE:
+            chunks = [
+                filenames[i : i + MERGE_CHUNK_SIZE]
+                for i in range(0, len(filenames), MERGE_CHUNK_SIZE)
+            ]
+            merged_filenames = [
+                f"{output_base}-merge-{level}-{i}.pdf" for i in range(len(chunks))
+            ]
+
+            def merge_chunk(i: int) -> None:
+                self.run_command(
+                    ["pdfunite"] + chunks[i] + [merged_filenames[i]],
+                    error_message=error_message,
+                    timeout_message=timeout_message,
+                )
+
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=os.cpu_count() or 1
+            ) as executor:
+                list(executor.map(merge_chunk, range(len(chunks))))
+
+            # Intermediate PDFs aren't needed once they're merged
+            if level > 0:
+                for filename in filenames:
+                    os.remove(filename)
+            filenames = merged_filenames
+            level += 1
+
+        self.run_command(
+            ["pdfunite"] + filenames + [output_filename],
+            error_message=error_message,
+            timeout_message=timeout_message,
+        )
+        if level > 0:
+            for filename in filenames:
+                os.remove(filename)
+
+    def compress_pdf(
+        self, input_filename: str, output_filename: str, page_sizes: List[int]
+    ) -> None:
+        """
+        Compress a PDF with ps2pdf. Ghostscript's pdfwrite device only uses a
+        single thread, so long PDFs are compressed in chunks of pages instead,
+        in parallel, and the compressed chunks are merged.
+
+        page_sizes are the sizes of the uncompressed pages, in bytes, which
+        the timeout of each chunk is based on. The first chunk is compressed
+        by itself, to measure the throughput.
+        """
+        num_pages = len(page_sizes)
+        chunks = [
+            (first_page, min(first_page + COMPRESS_CHUNK_SIZE - 1, num_pages))
+            for first_page in range(1, num_pages + 1, COMPRESS_CHUNK_SIZE)
+        ]
+        if len(chunks) == 1:
+            chunk_filenames = [output_filename]
+        else:
+            chunk_filenames = [
+                f"{TMP_DIR}/compressed-{i}.pdf" for i in range(1, len(chunks) + 1)
+            ]
+
+        percentage_per_page = (99.0 - self.percentage) / num_pages
+        bytes_done = 0
+        seconds_done = 0.0
+        pages_done = 0
+
+        def compress_chunk(i: int) -> Tuple[int, float]:
+            first_page, last_page = chunks[i]
+            chunk_bytes = sum(page_sizes[first_page - 1 : last_page])
+            if seconds_done > 0:
+                timeout = max(
+                    COMPRESS_MIN_TIMEOUT,
+                    COMPRESS_TIMEOUT_FACTOR * chunk_bytes * seconds_done / bytes_done,
+                )
+            else:
+                timeout = COMPRESS_FIRST_TIMEOUT_PER_PAGE * (last_page - first_page + 1)
+            args = ["ps2pdf"]
+            if len(chunks) > 1:
+                args += [f"-dFirstPage={first_page}", f"-dLastPage={last_page}"]
+            args += [input_filename, chunk_filenames[i]]
+            start_time = time.monotonic()
+            self.run_command(
+                args,
+                error_message="Compressing PDF failed",
+                timeout_message="Error compressing PDF, ps2pdf timed out",
+                timeout=round(timeout),
             )
-        except subprocess.TimeoutExpired:
+            return chunk_bytes, time.monotonic() - start_time
+
+        def chunk_done(i: int, chunk_bytes: int, seconds: float) -> None:
+            nonlocal bytes_done, seconds_done, pages_done
+            first_page, last_page = chunks[i]
+            bytes_done += chunk_bytes
+            seconds_done += seconds
+            pages_done += last_page - first_page + 1
+            self.percentage += percentage_per_page * (last_page - first_page + 1)
             self.output(
-                True,
-                f"Error compressing PDF, ps2pdf timed out after {compress_timeout} seconds",
-                percentage,
+                False, f"Compressed {pages_done}/{num_pages} pages", self.percentage
             )
-            return 1
-        if p.returncode != 0:
-            self.output(
-                True,
-                f"Compressing PDF failed",
-                percentage,
+
+        chunk_done(0, *compress_chunk(0))
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=os.cpu_count() or 1
+        ) as executor:
+            futures = {
+                executor.submit(compress_chunk, i): i for i in range(1, len(chunks))
+            }
+            for future in concurrent.futures.as_completed(futures):
+                chunk_done(futures[future], *future.result())
+
+        if len(chunks) > 1:
+            self.merge_pdf_files(
+                chunk_filenames,
+                output_filename,
+                error_message="Merging compressed pages into a single PDF failed",
+                timeout_message="Error merging compressed pages into a single PDF, pdfunite timed out",
             )
-            return 1
+            for filename in chunk_filenames:
+                os.remove(filename)
 
-        percentage = 100.0
-        self.output(False, "Safe PDF created", percentage)
+    def ocr(
+        self,
+        pages: List[int],
+        num_pages: int,
+        ocr_lang: str,
+        batch: bool,
+        workers: int,
+        report: bool,
+        page_points: Dict[int, Tuple[float, float]],
+    ) -> List[Dict[str, Any]]:
+        """
+        OCR the prepared /tmp/page-N-ocr.png images into text-only
+        /tmp/page-N-text.pdf files, running up to workers tesseract processes
+        at a time.
 
-        # Move converted files into /safezone
-        shutil.move("/tmp/safe-output.pdf", "/safezone")
-        shutil.move("/tmp/safe-output-compressed.pdf", "/safezone")
+        Normally each tesseract process OCRs a single page. In batch mode the
+        pages are split into one chunk per worker instead, and each tesseract
+        process OCRs a whole chunk into a multi-page PDF, so that it only
+        loads the language model once.
 
-        return 0
+        With placeholder pages, the pages of a chunk that can't be OCRed get
+        an empty text layer the size of page_points, in PDF points.
+        """
+        if batch:
+            chunk_size = math.ceil(len(pages) / workers)
+        else:
+            chunk_size = 1
+        chunks = [pages[i : i + chunk_size] for i in range(0, len(pages), chunk_size)]
+
+        # Only use one thread per tesseract process if there are several
+        env = dict(os.environ)
+        if workers > 1:
+            env["OMP_THREAD_LIMIT"] = "1"
+
+        def ocr_chunk(
+            chunk_index: int,
+        ) -> Tuple[float, Optional[float], Optional[ConversionError]]:
+            chunk = chunks[chunk_index]
+            # Not ocr-chunk-N.txt, which is where the txt renderer writes
+            list_filename = f"{TMP_DIR}/ocr-chunk-{chunk_index}-images.txt"
+            with open(list_filename, "w") as f:
+                for page in chunk:
+                    f.write(f"{TMP_DIR}/page-{page}-ocr.png\n")
+            args = [
+                "tesseract",
+                list_filename,
+                f"{TMP_DIR}/ocr-chunk-{chunk_index}",
+                "-l",
+                ocr_lang,
+                "-c",
+                "textonly_pdf=1",
+                "pdf",
+            ]
+            if report:
+                args.append("txt")
+            if len(chunk) == 1:
+                error_message = f"Page {chunk[0]}/{num_pages} OCR failed"
+            else:
+                error_message = f"Pages {chunk[0]}-{chunk[-1]}/{num_pages} OCR failed"
+            start_time = time.monotonic()
+            if workers == 1:
+                start_cpu_time: Optional[float] = cpu_time()
+            else:
+                start_cpu_time = None
+
+            def run_tesseract() -> None:
+                self.run_command(
+                    args,
+                    error_message=error_message,
+                    timeout_message="Error converting PNG to searchable PDF, tesseract timed out",
+                    env=env,
+                )
+
+            if len(chunk) == 1:
+                description = f"page {chunk[0]}/{num_pages}"
+            else:
+                description = f"pages {chunk[0]}-{chunk[-1]}/{num_pages}"
+            error = self.try_page(description, run_tesseract)
+            return start_time, start_cpu_time, error
+
+        report_pages: List[Dict[str, Any]] = []
+        percentage_per_page = 28.0 / len(pages)
+        pages_done = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(ocr_chunk, chunk_index): chunk_index
+                for chunk_index in range(len(chunks))
+            }
+            for future in concurrent.futures.as_completed(futures):
+                chunk_index = futures[future]
+                chunk = chunks[chunk_index]
+                start_time, start_cpu_time, error = future.result()
+                seconds = time.monotonic() - start_time
+
+                # Split the chunk's PDF back into a text layer for each page
+                if error is not None:
+                    for page in chunk:
+                        width_pt, height_pt = page_points[page]
+                        write_pdf_page(
+                            f"{self.page_dir}/page-{page}-text.pdf",
+                            width_pt,
+                            height_pt,
+                        )
+                        self.page_degraded(page, num_pages, error)
+                elif len(chunk) == 1:
+                    shutil.move(
+                        f"{TMP_DIR}/ocr-chunk-{chunk_index}.pdf",
+                        f"{self.page_dir}/page-{chunk[0]}-text.pdf",
+                    )
+                else:
+                    chunk_pages = self.count_pdf_pages(
+                        f"{TMP_DIR}/ocr-chunk-{chunk_index}.pdf"
+                    )
+                    if chunk_pages != len(chunk):
+                        raise ConversionError(
+                            f"OCR returned {chunk_pages} pages instead of {len(chunk)}"
+                        )
+                    self.run_command(
+                        [
+                            "pdfseparate",
+                            f"{TMP_DIR}/ocr-chunk-{chunk_index}.pdf",
+                            f"{TMP_DIR}/ocr-chunk-{chunk_index}-%d.pdf",
+                        ],
+                        error_message="Separating OCRed pages failed",
+                        timeout_message="Error separating OCRed pages, pdfseparate timed out",
+                    )
+                    for i, page in enumerate(chunk, start=1):
+                        shutil.move(
+                            f"{TMP_DIR}/ocr-chunk-{chunk_index}-{i}.pdf",
+                            f"{self.page_dir}/page-{page}-text.pdf",
+                        )
+
+                if report:
+                    # tesseract separates the text of each page with a form feed
+                    texts = []
+                    if error is None:
+                        with open(f"{TMP_DIR}/ocr-chunk-{chunk_index}.txt") as f:
+                            texts = f.read().split("\f")
+                    for i, page in enumerate(chunk):
+                        report_pages.append(
+                            {
+                                "page": page,
+                                "seconds": seconds / len(chunk),
+                                "text": texts[i] if i < len(texts) else "",
+                            }
+                        )
+
+                for page in chunk:
+                    os.remove(f"{TMP_DIR}/page-{page}-ocr.png")
+                    if self.checkpoint:
+                        self.checkpoint_page(page, True)
+                if len(chunk) == 1:
+                    self.page_done(
+                        chunk[0],
+                        start_time,
+                        start_cpu_time,
+                        os.path.getsize(f"{self.page_dir}/page-{chunk[0]}-text.pdf"),
+                    )
+                else:
+                    self.stage_bytes += sum(
+                        os.path.getsize(f"{self.page_dir}/page-{page}-text.pdf")
+                        for page in chunk
+                    )
+
+                pages_done += len(chunk)
+                self.percentage += percentage_per_page * len(chunk)
+                self.output(
+                    False,
+                    f"OCRed {pages_done}/{len(pages)} pages",
+                    self.percentage,
+                )
+
+        report_pages.sort(key=lambda report_page: report_page["page"])
+        return report_pages
+
+    def checkpoint_page(self, page: int, ocr: bool) -> None:
+        """
+        Mark a page's PDF (and its text layer, with OCR) as done, with their
+        SHA-256, so the host can check them before reusing them
+        """
+        names = [f"page-{page}.pdf"]
+        if ocr:
+            names.append(f"page-{page}-text.pdf")
+        hashes = {}
+        for name in names:
+            h = hashlib.sha256()
+            with open(f"{self.page_dir}/{name}", "rb") as f:
+                h.update(f.read())
+            hashes[name] = h.hexdigest()
+        write_file_atomically(f"{self.page_dir}/page-{page}.done", json.dumps(hashes))
+
+    def run_command(
+        self,
+        args: List[str],
+        error_message: str,
+        timeout_message: str,
+        timeout: Optional[float] = None,
+        env: Optional[Dict[str, str]] = None,
+    ) -> bytes:
+        """
+        Run a conversion tool and return its output, raising a ConversionError
+        with the given message if it fails or if it doesn't finish in time.
+        It has until the end of the current stage's budget, or timeout seconds
+        if that's sooner.
+        """
+        remaining = self.stage_end_time - time.monotonic()
+        if remaining <= 0:
+            raise FatalConversionError(
+                f"{timeout_message}, the document ran out of time in the {self.stage} stage"
+            )
+        if timeout is None or timeout > remaining:
+            timeout = math.ceil(remaining)
+        try:
+            with self.span(args[0]):
+                p = subprocess.run(
+                    args,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.DEVNULL,
+                    timeout=timeout,
+                    env=env,
+                )
+        except subprocess.TimeoutExpired:
+            raise ConversionError(f"{timeout_message} after {timeout} seconds")
+        except FileNotFoundError:
+            raise FatalConversionError(f"{error_message}, {args[0]} is not installed")
+        if p.returncode != 0:
+            raise ConversionError(error_message)
+        return p.stdout
 
     def output(self, error: bool, text: str, percentage: float) -> None:
-        print(json.dumps({"error": error, "text": text, "percentage": int(percentage)}))
-        sys.stdout.flush()
+        now = time.monotonic()
+        self.output_event(
+            "progress",
+            {
+                "error": error,
+                "text": text,
+                "percentage": int(percentage),
+                "stage": self.stage,
+                "stage_seconds": round(now - self.stage_start_time, 1),
+                "remaining_seconds": max(0, round(self.stage_end_time - now, 1)),
+            },
+        )
 
+    def output_event(self, event: str, fields: Dict[str, Any]) -> None:
+        # Commands run in several threads, so write each line in one go
+        line = json.dumps({"version": PROTOCOL_VERSION, "event": event, **fields})
+        with self.output_lock:
+            sys.stdout.write(line + "\n")
+            sys.stdout.flush()
 
-def main() -> int:
-    if len(sys.argv) != 2:
-        print(f"Usage: {sys.argv[0]} [document-to-pixels]|[pixels-to-pdf]")
-        return -1
 
-    converter = DangerzoneConverter()
+def cpu_time() -> float:
+    """
+    CPU time used so far by this process and the commands that it ran
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
 
-    if sys.argv[1] == "document-to-pixels":
-        return converter.document_to_pixels()
+def classify_page(
+    rgb_filename: str, width: int, height: int
+) -> Tuple[str, Tuple[int, int, int]]:
+    """
+    Classify a page of pixels, using PIL's histogram and statistics, as:
+
+    - "blank": a single flat color, which is also returned
+    - "near-blank": almost no ink on it, for instance a speck of dust
+    - "image": mostly covered in varied colors, like a photo or a slide
+      background, with no paper showing
+    - "text": anything else
+
+    Blank pages are never worth running OCR on, and with OCR_SKIP_PAGES=1,
+    only "text" pages are OCRed.
+    """
+    with open(rgb_filename, "rb") as f:
+        im = Image.frombytes("RGB", (width, height), f.read())
+
+    stat = ImageStat.Stat(im)
+    if all(high - low <= BLANK_TOLERANCE for low, high in stat.extrema):
+        return "blank", (round(stat.mean[0]), round(stat.mean[1]), round(stat.mean[2]))
+
+    gray = im.convert("L")
+    histogram = gray.histogram()
+    num_pixels = width * height
+    light = histogram[PAPER_MIN_LEVEL:]
+    paper_level = PAPER_MIN_LEVEL + light.index(max(light))
+    ink = sum(histogram[: max(0, paper_level - INK_CONTRAST)]) / num_pixels
+    paper_low = max(0, paper_level - PAPER_TOLERANCE)
+    paper_high = paper_level + PAPER_TOLERANCE + 1
+    paper = sum(histogram[paper_low:paper_high]) / num_pixels
+    if ink < NEAR_BLANK_MAX_INK:
+        return "near-blank", (255, 255, 255)
+    if paper < IMAGE_MAX_PAPER and ImageStat.Stat(gray).stddev[0] > IMAGE_MIN_STDDEV:
+        return "image", (255, 255, 255)
+    return "text", (255, 255, 255)
+
+
+def placeholder_image(width: int, height: int, page: int) -> Image.Image:
+    """
+    A width x height page that's clearly marked as one that couldn't be
+    converted, with a border, a cross, and a line of text
+    """
+    im = Image.new("RGB", (width, height), (255, 255, 255))
+    draw = ImageDraw.Draw(im)
+    line_width = max(1, min(width, height) // 100)
+    draw.rectangle(
+        [0, 0, width - 1, height - 1], outline=PLACEHOLDER_COLOR, width=line_width
+    )
+    draw.line([0, 0, width - 1, height - 1], fill=PLACEHOLDER_COLOR, width=line_width)
+    draw.line([0, height - 1, width - 1, 0], fill=PLACEHOLDER_COLOR, width=line_width)
+
+    # The default font is small, so draw the text small and scale it up
+    text = f"Page {page} could not be converted"
+    _, _, text_width, text_height = draw.textbbox((0, 0), text)
+    text_im = Image.new(
+        "RGB", (int(text_width) + 4, int(text_height) + 4), (255, 255, 255)
+    )
+    ImageDraw.Draw(text_im).text((2, 2), text, fill=PLACEHOLDER_COLOR)
+    scale = max(1, min(PLACEHOLDER_TEXT_SCALE, width // text_im.width))
+    text_im = text_im.resize(
+        (text_im.width * scale, text_im.height * scale), Image.Resampling.NEAREST
+    )
+    im.paste(
+        text_im,
+        ((width - text_im.width) // 2, max(0, (height - text_im.height) // 2)),
+    )
+    return im
+
+
+def write_pdf_page(
+    filename: str, width: float, height: float, content: bytes = b""
+) -> None:
+    """
+    Write a minimal single page PDF of width x height points, whose page is
+    drawn by the given content stream
+    """
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %.2f %.2f] "
+        b"/Resources << >> /Contents 4 0 R >>" % (width, height),
+        b"<< /Length %d >>\nstream\n%s\nendstream" % (len(content), content),
+    ]
+    pdf = b"%PDF-1.4\n"
+    offsets = []
+    for i, obj in enumerate(objects, start=1):
+        offsets.append(len(pdf))
+        pdf += b"%d 0 obj\n%s\nendobj\n" % (i, obj)
+    xref_offset = len(pdf)
+    pdf += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for offset in offsets:
+        pdf += b"%010d 00000 n \n" % offset
+    pdf += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (
+        len(objects) + 1,
+        xref_offset,
+    )
+    with open(filename, "wb") as f:
+        f.write(pdf)
+
+
+def parse_page_selection(
+    pages: Optional[str], num_pages: int, max_pages: Optional[int] = None
+) -> List[int]:
+    """
+    Parse a selection of pages like "1-10,50" into a sorted list of page
+    numbers, of at most max_pages pages. Pages past the end of the document
+    are left out. Without a selection, every page is selected.
+    """
+    if not pages:
+        return list(range(1, min(num_pages, max_pages or num_pages) + 1))
+    selected_pages: Set[int] = set()
+    for part in pages.split(","):
+        m = re.fullmatch(r"\s*([0-9]+)\s*(?:-\s*([0-9]+)\s*)?", part)
+        if not m or int(m.group(1)) == 0:
+            raise ConversionError(f"Invalid page selection: {pages}")
+        first = int(m.group(1))
+        last = int(m.group(2)) if m.group(2) else first
+        if last < first:
+            raise ConversionError(f"Invalid page selection: {pages}")
+        selected_pages.update(range(first, min(last, num_pages) + 1))
+    if not selected_pages:
+        raise ConversionError(f"The document has no pages in {pages}")
+    return sorted(selected_pages)[:max_pages]
+
+
+def copy_bytes(src: BinaryIO, dst: BinaryIO, num_bytes: int) -> None:
+    """
+    Copy exactly num_bytes bytes from src to dst
+    """
+    while num_bytes > 0:
+        data = src.read(min(num_bytes, 1024 * 1024))
+        if not data:
+            raise ConversionError("The stream ended too soon")
+        dst.write(data)
+        num_bytes -= len(data)
+
+
+def write_file_atomically(filename: str, contents: str) -> None:
+    """
+    Write a file so that whoever is watching for it never sees it partially
+    written
+    """
+    tmp_filename = f"{filename}.tmp"
+    with open(tmp_filename, "w") as f:
+        f.write(contents)
+    os.rename(tmp_filename, filename)
+
+
+def ocr_geometry(width: int, height: int, ocr_dpi: int) -> Tuple[int, int]:
+    """
+    Size of the copy of a page that gets OCRed. Pages are only ever scaled
+    down, to at most ocr_dpi and at most OCR_MAX_PIXELS pixels.
+    """
+    scale = min(1.0, ocr_dpi / RENDER_DPI, math.sqrt(OCR_MAX_PIXELS / (width * height)))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "command",
+        choices=["document-to-pixels", "pixels-to-pdf", "count-pages", "merge-pdfs"],
+    )
+    parser.add_argument(
+        "--pages",
+        help="Only convert these pages to pixels, for instance 1-10,50",
+    )
+    parser.add_argument(
+        "--max-pages",
+        type=int,
+        help="Only convert the first this many pages (of the selected ones) to pixels",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Stream files over stdin and stdout instead of using volumes",
+    )
+    args = parser.parse_args()
 
-    if sys.argv[1] == "pixels-to-pdf":
-        return converter.pixels_to_pdf()
+    if args.stream:
+        os.makedirs(PIXEL_DIR, exist_ok=True)
+        os.makedirs(SAFE_DIR, exist_ok=True)
+    converter = DangerzoneConverter(args.stream)
+    if args.stream and args.command == "pixels-to-pdf":
+        threading.Thread(target=converter.receive_pixels, daemon=True).start()
 
-    return -1
+    try:
+        if args.command == "document-to-pixels":
+            ret = converter.document_to_pixels(args.pages, args.max_pages)
+        elif args.command == "pixels-to-pdf":
+            ret = converter.pixels_to_pdf()
+        elif args.command == "count-pages":
+            ret = converter.count_pages()
+        elif args.command == "merge-pdfs":
+            ret = converter.merge_pdfs()
+        converter.end_stage()
+        return ret
+    except ConversionError as e:
+        converter.end_stage()
+        converter.output(True, str(e), converter.percentage)
+        return 1
 
 
 if __name__ == "__main__":
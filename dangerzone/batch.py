@@ -0,0 +1,416 @@
+import logging
+import mimetypes
+import os
+import queue
+import shutil
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from .checkpoint import hash_file
+from .container import convert, count_pages
+from .result import ConversionResult, summarize
+
+log = logging.getLogger(__name__)
+
+# Roughly how many seconds a conversion takes: a base for starting its
+# containers, plus some for each page, and for each MB of documents that
+# LibreOffice converts to a PDF first
+COST_BASE_SECONDS = 5.0
+COST_PER_PAGE_SECONDS = 2.0
+COST_PER_OCR_PAGE_SECONDS = 5.0
+COST_PER_OFFICE_MB_SECONDS = 10.0
+
+# Until their pages are counted, documents are guessed to have one page per
+# this many bytes. Images have one page.
+BYTES_PER_PDF_PAGE = 50 * 1024
+BYTES_PER_OFFICE_PAGE = 20 * 1024
+
+# Only PDFs at least this big get their pages counted in a container (see
+# BatchQueue), since for small ones that takes longer than the estimate could
+# save
+PROBE_MIN_BYTES = 1024 * 1024
+
+# With the "sjf" policy, each second that a job waits takes this many seconds
+# off its cost, so big jobs can't wait forever behind a stream of small ones
+DEFAULT_AGING_RATE = 1.0
+
+POLICIES = ["fifo", "sjf", "fair"]
+
+
+def estimate_pages(input_filename: str) -> int:
+    """
+    Estimate how many pages a document has, from its size and MIME type
+    """
+    size = os.path.getsize(input_filename)
+    mime_type = mimetypes.guess_type(input_filename)[0] or ""
+    if mime_type.startswith("image/"):
+        return 1
+    if mime_type == "application/pdf":
+        return max(1, size // BYTES_PER_PDF_PAGE)
+    return max(1, size // BYTES_PER_OFFICE_PAGE)
+
+
+def worth_probing(input_filename: str) -> bool:
+    """
+    Whether counting the pages of a document in a container is cheap enough to
+    improve its estimate
+    """
+    mime_type = mimetypes.guess_type(input_filename)[0] or ""
+    return (
+        mime_type == "application/pdf"
+        and os.path.getsize(input_filename) >= PROBE_MIN_BYTES
+    )
+
+
+def estimate_cost(
+    input_filename: str, ocr: bool = False, num_pages: Optional[int] = None
+) -> float:
+    """
+    Estimate how many seconds converting a document takes, which doesn't need
+    to be accurate, only to put documents in the right order
+    """
+    if num_pages is None:
+        num_pages = estimate_pages(input_filename)
+    per_page = COST_PER_PAGE_SECONDS
+    if ocr:
+        per_page += COST_PER_OCR_PAGE_SECONDS
+    cost = COST_BASE_SECONDS + per_page * num_pages
+
+    mime_type = mimetypes.guess_type(input_filename)[0] or ""
+    if mime_type != "application/pdf" and not mime_type.startswith("image/"):
+        size_mb = os.path.getsize(input_filename) / (1024 * 1024)
+        cost += COST_PER_OFFICE_MB_SECONDS * size_mb
+    return cost
+
+
+class BatchJob:
+    """
+    A document waiting in a BatchQueue, or being converted by it. Once done is
+    set, result says how the conversion went.
+
+    A job that was submitted while an identical one (its leader) was queued
+    or converting isn't converted itself, and gets the safe PDF and the
+    result of its leader instead.
+    """
+
+    def __init__(
+        self,
+        input_filename: str,
+        output_filename: str,
+        convert_kwargs: Dict[str, Any],
+        key: Tuple[str, Optional[str]],
+        cost: float,
+        group: str,
+        weight: float,
+    ) -> None:
+        self.input_filename = input_filename
+        self.output_filename = output_filename
+        self.convert_kwargs = convert_kwargs
+        self.key = key
+        self.cost = cost
+        self.group = group
+        self.weight = weight
+        self.submit_time = time.monotonic()
+        self.start_time: Optional[float] = None
+        self.result = ConversionResult()
+        self.done = threading.Event()
+
+        # Virtual start time, for the "fair" policy
+        self.start_tag = 0.0
+
+        self.leader: Optional[BatchJob] = None
+        self.followers: List[BatchJob] = []
+
+
+class BatchQueue:
+    """
+    Converts documents with a number of workers, in an order that depends on
+    policy:
+
+    - "fifo" converts them in the order they were submitted
+    - "sjf" converts the cheapest ones first (see estimate_cost()), but each
+      second that a job waits makes it aging_rate seconds cheaper, so a big
+      document only waits about as long as it takes to convert
+    - "fair" shares the workers between groups of jobs (like the senders of
+      the documents) in proportion to their weight, by how much conversion
+      time their jobs cost (start-time fair queueing), and converts each
+      group's jobs in the order they were submitted
+
+    Other keyword arguments are passed to convert(). With an endpoint_pool,
+    use as many workers as its endpoints can run conversions at a time.
+
+    If probe_pages is set, a probe thread counts the pages of big PDFs in a
+    count-pages container while they're queued, and updates their cost. That
+    uses the local container engine, so it's skipped when conversions stream,
+    or when the endpoint_pool has remote endpoints.
+
+    When the same document (by its SHA-256) is submitted with the same
+    settings while it's already queued or converting, like when many copies
+    of an attachment arrive at once, the new job waits for that one instead
+    of converting it again (see BatchJob).
+
+    summary() adds up the time and resources that the conversions took.
+    """
+
+    def __init__(
+        self,
+        workers: int = 1,
+        policy: str = "sjf",
+        aging_rate: float = DEFAULT_AGING_RATE,
+        probe_pages: bool = True,
+        stdout_callback: Optional[Callable[[BatchJob, str], None]] = None,
+        **convert_kwargs: Any,
+    ) -> None:
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown scheduling policy {policy}")
+        self.policy = policy
+        self.aging_rate = aging_rate
+        self.stdout_callback = stdout_callback
+        self.convert_kwargs = convert_kwargs
+
+        self.jobs: List[BatchJob] = []
+        self.condition = threading.Condition()
+        self.closed = False
+        self.virtual_time = 0.0
+        self.group_finish_tags: Dict[str, float] = {}
+
+        # Jobs that are queued or converting, by their document and settings
+        self.in_flight: Dict[Tuple[str, Optional[str]], BatchJob] = {}
+
+        # Jobs that were converted, without their followers
+        self.finished: List[BatchJob] = []
+
+        self.threads = [
+            threading.Thread(target=self.work, daemon=True) for _ in range(workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+        # Jobs whose pages the probe thread should count
+        endpoint_pool = convert_kwargs.get("endpoint_pool")
+        self.probe_pages = (
+            probe_pages
+            and not convert_kwargs.get("stream")
+            and not (
+                endpoint_pool is not None
+                and any(endpoint.remote for endpoint in endpoint_pool.endpoints)
+            )
+        )
+        self.probes: "queue.Queue[Optional[BatchJob]]" = queue.Queue()
+        self.probe_thread = threading.Thread(target=self.probe, daemon=True)
+        if self.probe_pages:
+            self.probe_thread.start()
+
+    def submit(
+        self,
+        input_filename: str,
+        output_filename: str,
+        ocr_lang: Optional[str] = None,
+        group: str = "",
+        weight: float = 1.0,
+    ) -> BatchJob:
+        """
+        Queue a document for conversion. Its cost is estimated right away from
+        its size, and again once the probe thread counts its pages, for big
+        PDFs.
+        """
+        key = (hash_file(input_filename), ocr_lang)
+        with self.condition:
+            if self.closed:
+                raise ValueError("Can't submit jobs to a closed queue")
+            leader = self.in_flight.get(key)
+            if leader is not None:
+                log.info(
+                    f"{input_filename} is the same as {leader.input_filename}, "
+                    "waiting for its conversion"
+                )
+                job = BatchJob(
+                    input_filename,
+                    output_filename,
+                    leader.convert_kwargs,
+                    key,
+                    leader.cost,
+                    group,
+                    weight,
+                )
+                job.leader = leader
+                leader.followers.append(job)
+                return job
+
+        cost = self.estimate_cost(
+            input_filename, ocr_lang, estimate_pages(input_filename)
+        )
+        log.info(f"Queueing {input_filename}, estimated to take {cost:.0f}s")
+
+        convert_kwargs = dict(self.convert_kwargs)
+        convert_kwargs["ocr_lang"] = ocr_lang
+        job = BatchJob(
+            input_filename, output_filename, convert_kwargs, key, cost, group, weight
+        )
+        with self.condition:
+            if self.closed:
+                raise ValueError("Can't submit jobs to a closed queue")
+            if key in self.in_flight:
+                # An identical job was submitted while this one was estimated
+                job.leader = self.in_flight[key]
+                job.leader.followers.append(job)
+                return job
+            self.in_flight[key] = job
+            job.start_tag = max(
+                self.virtual_time, self.group_finish_tags.get(group, 0.0)
+            )
+            self.group_finish_tags[group] = job.start_tag + cost / weight
+            self.jobs.append(job)
+            self.condition.notify()
+        if self.probe_pages and worth_probing(input_filename):
+            self.probes.put(job)
+        return job
+
+    def estimate_cost(
+        self, input_filename: str, ocr_lang: Optional[str], num_pages: int
+    ) -> float:
+        first_pages = self.convert_kwargs.get("first_pages")
+        if first_pages:
+            # Only the first pages are converted
+            num_pages = min(num_pages, first_pages)
+        return estimate_cost(input_filename, bool(ocr_lang), num_pages)
+
+    def probe(self) -> None:
+        while True:
+            job = self.probes.get()
+            if job is None:
+                return
+            with self.condition:
+                if job not in self.jobs:
+                    # It's already converting
+                    continue
+
+            try:
+                num_pages = count_pages(
+                    job.input_filename,
+                    self.convert_kwargs.get("deadline"),
+                    self.convert_kwargs.get("deadline_scale"),
+                )
+            except Exception as e:
+                log.warning(f"Couldn't count the pages of {job.input_filename}: {e}")
+                num_pages = None
+            if num_pages is None:
+                continue
+
+            cost = self.estimate_cost(
+                job.input_filename, job.convert_kwargs["ocr_lang"], num_pages
+            )
+            log.info(f"{job.input_filename} is now estimated to take {cost:.0f}s")
+            with self.condition:
+                if job in self.jobs:
+                    # Later jobs of the group start after it's done
+                    self.group_finish_tags[job.group] += (cost - job.cost) / job.weight
+                    job.cost = cost
+
+    def close(self) -> None:
+        """
+        Wait for the jobs that were submitted to be converted, and stop the
+        workers
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+        if self.probe_pages:
+            self.probes.put(None)
+            self.probe_thread.join()
+
+    def summary(self) -> Dict[str, Any]:
+        """
+        Summarize the conversions that are done so far, like their resource
+        usage (see summarize()). Followers share the result of their leader,
+        so each conversion only counts once, and followers are only counted
+        in "followers".
+        """
+        with self.condition:
+            results = [job.result for job in self.finished]
+            followers = sum(len(job.followers) for job in self.finished)
+        summary = summarize(results)
+        summary["followers"] = followers
+        return summary
+
+    def next_job(self) -> Optional[BatchJob]:
+        """
+        Take the next job to convert out of the queue, waiting for one if it's
+        empty, or return None once the queue is closed and empty
+        """
+        with self.condition:
+            while not self.jobs:
+                if self.closed:
+                    return None
+                self.condition.wait()
+
+            if self.policy == "sjf":
+                now = time.monotonic()
+                job = min(
+                    self.jobs,
+                    key=lambda job: job.cost
+                    - self.aging_rate * (now - job.submit_time),
+                )
+            elif self.policy == "fair":
+                job = min(self.jobs, key=lambda job: job.start_tag)
+                self.virtual_time = job.start_tag
+            else:
+                job = self.jobs[0]
+            self.jobs.remove(job)
+            return job
+
+    def work(self) -> None:
+        while True:
+            job = self.next_job()
+            if job is None:
+                return
+
+            def stdout_callback(line: str, job: BatchJob = job) -> None:
+                if self.stdout_callback is not None:
+                    with self.condition:
+                        jobs = [job] + job.followers
+                    for each_job in jobs:
+                        self.stdout_callback(each_job, line)
+
+            job.start_time = time.monotonic()
+            log.info(
+                f"Converting {job.input_filename} after waiting "
+                f"{job.start_time - job.submit_time:.1f}s"
+            )
+            try:
+                convert(
+                    job.input_filename,
+                    job.output_filename,
+                    stdout_callback=stdout_callback,
+                    result=job.result,
+                    **job.convert_kwargs,
+                )
+            except Exception as e:
+                log.error(f"Converting {job.input_filename} failed: {e}")
+
+            # Jobs submitted from now on convert the document again
+            with self.condition:
+                del self.in_flight[job.key]
+                self.finished.append(job)
+            self.finish_followers(job)
+            job.done.set()
+
+    def finish_followers(self, job: BatchJob) -> None:
+        """
+        Give the followers of a job its safe PDF and result
+        """
+        for follower in job.followers:
+            follower.start_time = job.start_time
+            follower.result = job.result
+            if job.result.success and os.path.abspath(
+                follower.output_filename
+            ) != os.path.abspath(job.output_filename):
+                try:
+                    shutil.copyfile(job.output_filename, follower.output_filename)
+                except OSError as e:
+                    log.error(f"Couldn't copy the safe PDF: {e}")
+                    follower.result = ConversionResult()
+            follower.done.set()
@@ -0,0 +1,277 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+from typing import IO, Any, Dict, List, Optional, Set, Tuple
+
+from .validation import (
+    PixelValidationError,
+    PixelValidator,
+    open_regular_file,
+    read_num_pages,
+    read_number_file,
+)
+
+log = logging.getLogger(__name__)
+
+# Files are hashed in chunks of this many bytes
+HASH_CHUNK_SIZE = 1024 * 1024
+
+pixel_file_re = re.compile(r"^page-([1-9][0-9]*)\.(rgb|width|height)$")
+page_file_re = re.compile(r"^page-([1-9][0-9]*)(\.pdf|-text\.pdf|\.done)$")
+
+# Everything that a job puts in its job_dir. Anything else there is left alone.
+JOB_DIRS = ["pixels", "pages", "render", "safe"]
+JOB_FILES = ["job.json", "checkpoint.jsonl"]
+
+
+def hash_file(filename: str) -> str:
+    with open(filename, "rb") as f:
+        return hash_fileobj(f)
+
+
+def hash_container_file(filename: str) -> str:
+    """
+    Hash a file that a container wrote (see open_regular_file())
+    """
+    with open_regular_file(filename) as f:
+        return hash_fileobj(f)
+
+
+def hash_fileobj(f: IO[bytes]) -> str:
+    h = hashlib.sha256()
+    for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+        h.update(chunk)
+    return h.hexdigest()
+
+
+def page_selection(pages: List[int]) -> str:
+    """
+    A selection of pages like "1-10,50", for the --pages of document-to-pixels
+    """
+    ranges = []
+    first = last = pages[0]
+    for page in pages[1:]:
+        if page == last + 1:
+            last = page
+            continue
+        ranges.append((first, last))
+        first = last = page
+    ranges.append((first, last))
+    return ",".join(
+        str(first) if first == last else f"{first}-{last}" for first, last in ranges
+    )
+
+
+class Checkpoint:
+    """
+    Keeps the progress of a conversion in job_dir, so that it can be resumed
+    if it's interrupted, like when the computer restarts in the middle of a
+    long document. Only the pages that weren't done are converted again.
+
+    The pixels of each page are kept in job_dir/pixels once they're validated,
+    and their SHA-256 is appended to job_dir/checkpoint.jsonl. pixels-to-pdf
+    keeps the PDF of each page in job_dir/pages, with a page-N.done file that
+    has the SHA-256 of each of its layers. When resuming, every file is
+    checked against its SHA-256 first, and deleted if it doesn't match.
+
+    job_dir/job.json has the SHA-256 of the document and the settings of the
+    conversion. If they changed, the job starts over. A job_dir that isn't
+    empty and has no job.json isn't used, so that a job never deletes files
+    it didn't create.
+    """
+
+    def __init__(self, job_dir: str, input_filename: str, settings: List[str]) -> None:
+        self.job_dir = job_dir
+        self.input_filename = input_filename
+        self.settings = settings
+        self.pixel_dir = os.path.join(job_dir, "pixels")
+        self.page_dir = os.path.join(job_dir, "pages")
+        self.log_filename = os.path.join(job_dir, "checkpoint.jsonl")
+        self.recorded_pages: Set[int] = set()
+
+    def open(self) -> None:
+        """
+        Start the job, or get ready to resume it if job_dir has the same one
+        """
+        job = {
+            "input_sha256": hash_file(self.input_filename),
+            "settings": self.settings,
+        }
+        job_filename = os.path.join(self.job_dir, "job.json")
+        if (
+            os.path.isdir(self.job_dir)
+            and os.listdir(self.job_dir)
+            and not os.path.exists(job_filename)
+        ):
+            raise ValueError(
+                f"{self.job_dir} isn't empty, and isn't the job directory of a conversion"
+            )
+        try:
+            with open(job_filename) as f:
+                previous_job = json.load(f)
+        except (OSError, ValueError):
+            previous_job = None
+
+        if previous_job != job:
+            if previous_job is not None:
+                log.info("The document or its settings changed, starting over")
+            self.clear()
+            os.makedirs(self.job_dir, exist_ok=True)
+            with open(job_filename, "w") as f:
+                json.dump(job, f)
+        os.makedirs(self.pixel_dir, exist_ok=True)
+        os.makedirs(self.page_dir, exist_ok=True)
+
+    def remove(self) -> None:
+        """
+        Delete the job once it's done, and job_dir if nothing else is in it
+        """
+        for name in JOB_DIRS:
+            path = os.path.join(self.job_dir, name)
+            if os.path.exists(path):
+                shutil.rmtree(path)
+        for name in JOB_FILES:
+            path = os.path.join(self.job_dir, name)
+            if os.path.exists(path):
+                os.remove(path)
+        try:
+            os.rmdir(self.job_dir)
+        except OSError:
+            pass
+
+    def clear(self) -> None:
+        for path in [self.pixel_dir, self.page_dir]:
+            if os.path.exists(path):
+                shutil.rmtree(path)
+        if os.path.exists(self.log_filename):
+            os.remove(self.log_filename)
+        self.recorded_pages = set()
+
+    def resume(self) -> Tuple[Optional[int], List[int]]:
+        """
+        Check what earlier runs of the job left behind, and delete anything
+        that can't be reused. Returns the number of pages of the document, or
+        None if it isn't known yet, and the pages that need to be converted
+        to pixels again.
+        """
+        try:
+            num_pages = read_num_pages(self.pixel_dir)
+        except PixelValidationError:
+            num_pages = None
+        if num_pages is None:
+            self.clear()
+            os.makedirs(self.pixel_dir)
+            os.makedirs(self.page_dir)
+            return None, []
+
+        records: Dict[int, Dict[str, Any]] = {}
+        if os.path.exists(self.log_filename):
+            with open(self.log_filename) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        records[int(record["page"])] = record
+                    except (ValueError, KeyError, TypeError):
+                        # The last line can be cut short
+                        continue
+
+        done_pages = []
+        pixel_pages = []
+        missing_pages = []
+        for page in range(1, num_pages + 1):
+            if self.check_done(page):
+                done_pages.append(page)
+            elif page in records and self.check_pixels(page, records[page]):
+                pixel_pages.append(page)
+            else:
+                missing_pages.append(page)
+
+        # Delete everything that isn't reused
+        for entry in os.scandir(self.pixel_dir):
+            m = pixel_file_re.match(entry.name)
+            if entry.name != "num_pages" and (
+                not m or int(m.group(1)) not in pixel_pages
+            ):
+                os.remove(entry.path)
+        for entry in os.scandir(self.page_dir):
+            m = page_file_re.match(entry.name)
+            if not m or int(m.group(1)) not in done_pages:
+                os.remove(entry.path)
+
+        # Start a new log with just the pages that are left
+        with open(self.log_filename, "w") as f:
+            for page in pixel_pages:
+                f.write(json.dumps(records[page]) + "\n")
+        self.recorded_pages = set(pixel_pages)
+
+        log.info(
+            f"Resuming: {len(done_pages)} of {num_pages} pages are done, "
+            f"{len(pixel_pages)} have pixels, {len(missing_pages)} are left"
+        )
+        return num_pages, missing_pages
+
+    def check_done(self, page: int) -> bool:
+        try:
+            with open_regular_file(
+                os.path.join(self.page_dir, f"page-{page}.done")
+            ) as f:
+                hashes = json.load(f)
+        except (OSError, ValueError, PixelValidationError):
+            return False
+        if not isinstance(hashes, dict) or f"page-{page}.pdf" not in hashes:
+            return False
+        for name, sha256 in hashes.items():
+            if name not in [f"page-{page}.pdf", f"page-{page}-text.pdf"]:
+                return False
+            try:
+                if hash_container_file(os.path.join(self.page_dir, name)) != sha256:
+                    return False
+            except (OSError, PixelValidationError):
+                return False
+        return True
+
+    def check_pixels(self, page: int, record: Dict[str, Any]) -> bool:
+        filename_base = os.path.join(self.pixel_dir, f"page-{page}")
+        try:
+            return (
+                read_number_file(f"{filename_base}.width") == str(record["width"])
+                and read_number_file(f"{filename_base}.height") == str(record["height"])
+                and hash_container_file(f"{filename_base}.rgb") == record["sha256"]
+            )
+        except (OSError, KeyError, PixelValidationError):
+            return False
+
+    def record_pixels(self, validator: PixelValidator) -> None:
+        """
+        Record the pages of pixels that validator validated since last time
+        """
+        for page in sorted(validator.validated_pages - self.recorded_pages):
+            self.record_page(page)
+
+    def record_page(self, page: int) -> None:
+        filename_base = os.path.join(self.pixel_dir, f"page-{page}")
+        record = {
+            "page": page,
+            "width": int(read_number_file(f"{filename_base}.width")),
+            "height": int(read_number_file(f"{filename_base}.height")),
+            "sha256": hash_container_file(f"{filename_base}.rgb"),
+        }
+        with open(self.log_filename, "a") as f:
+            f.write(json.dumps(record) + "\n")
+        self.recorded_pages.add(page)
+
+    def add_pixels(self, render_dir: str, pages: List[int]) -> None:
+        """
+        Move the validated pages of pixels that document-to-pixels rendered
+        in render_dir, numbered from 1, into the job as the given pages
+        """
+        for i, page in enumerate(pages, start=1):
+            for extension in ["rgb", "width", "height"]:
+                os.rename(
+                    os.path.join(render_dir, f"page-{i}.{extension}"),
+                    os.path.join(self.pixel_dir, f"page-{page}.{extension}"),
+                )
+            self.record_page(page)
@@ -1,51 +1,193 @@
+import contextlib
 import json
 import logging
 import os
 import sys
-from typing import Optional
+from typing import Optional, Tuple
 
 import click
 from colorama import Fore, Style
 
+from . import tracing
 from .common import Common
-from .container import convert
+from .container import EndpointPool, convert, parse_endpoint, parse_page_selection
 from .global_common import GlobalCommon
+from .result import ConversionResult
 
 
-def print_header(s: str) -> None:
-    click.echo("")
-    click.echo(Style.BRIGHT + s)
+def print_header(s: str, err: bool = False) -> None:
+    click.echo("", err=err)
+    click.echo(Style.BRIGHT + s, err=err)
 
 
 @click.command()
-@click.option("--output-filename", help="Default is filename ending with -safe.pdf")
+@click.option(
+    "-o",
+    "--output-filename",
+    help="Default is filename ending with -safe.pdf, or - to write the safe PDF to stdout",
+)
 @click.option("--ocr-lang", help="Language to OCR, defaults to none")
-@click.argument("filename", required=True)
+@click.option(
+    "--ocr-dpi",
+    type=click.IntRange(min=1),
+    help="Resolution that pages are downsampled to for OCR, defaults to 150, the resolution they're rendered at, so only very big pages are downsampled",
+)
+@click.option(
+    "--ocr-binarize",
+    is_flag=True,
+    help="OCR a black and white copy of each page instead of a grayscale one",
+)
+@click.option(
+    "--ocr-report",
+    "ocr_report_filename",
+    help="Write the OCR time and text of each page to this JSON file",
+)
+@click.option(
+    "--ocr-batch",
+    is_flag=True,
+    help="OCR chunks of pages with one tesseract process each, instead of one process per page",
+)
+@click.option(
+    "--ocr-workers",
+    type=click.IntRange(min=1),
+    help="How many tesseract processes can run in parallel, defaults to the number of CPUs",
+)
+@click.option(
+    "--ocr-skip-pages",
+    is_flag=True,
+    help="Don't OCR pages that look like they have no text, like photos",
+)
+@click.option(
+    "--max-shards",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Split long documents into up to this many shards, converted in parallel",
+)
+@click.option(
+    "--pages",
+    help="Only convert these pages, for instance 1-10,50",
+)
+@click.option(
+    "--max-pages",
+    "first_pages",
+    type=click.IntRange(min=1),
+    help="Only convert the first this many pages (of the selected ones, with --pages)",
+)
+@click.option(
+    "--deadline",
+    type=click.FloatRange(min=0, min_open=True),
+    help="Give up on the document after this many seconds, defaults to a budget based on its size and number of pages",
+)
+@click.option(
+    "--deadline-scale",
+    type=click.FloatRange(min=0, min_open=True),
+    help="Multiply the time budget of the document by this factor, for slow computers",
+)
+@click.option(
+    "--page-attempts",
+    type=click.IntRange(min=1),
+    help="How many times to try converting each page, defaults to 2",
+)
+@click.option(
+    "--placeholder-pages",
+    is_flag=True,
+    help="Replace pages that can't be converted with a page that says so, instead of failing the whole document",
+)
+@click.option(
+    "--job-dir",
+    help="Keep the progress of the conversion in this directory until it succeeds, and resume it from there if it was interrupted",
+)
+@click.option(
+    "--scratch-dir",
+    help="Directory for the pixels of the pages while converting, defaults to one in the config directory",
+)
+@click.option(
+    "--max-scratch-bytes",
+    type=click.IntRange(min=1),
+    help="Give up on documents that need more than this many bytes of scratch space",
+)
+@click.option(
+    "--stream",
+    is_flag=True,
+    help="Stream files through the containers' stdin and stdout instead of mounting directories, which works with remote container engines",
+)
+@click.option(
+    "--endpoint",
+    "endpoint_specs",
+    multiple=True,
+    help="Convert on the container engine that has the most free capacity out of these: local or a URL like ssh://core@host/run/podman/podman.sock, each followed by =N to run up to N conversions on it at a time",
+)
+@click.option(
+    "--result-json",
+    "result_filename",
+    help="Write how long each stage and page of the conversion took to this JSON file",
+)
+@click.option(
+    "--trace",
+    "trace_filename",
+    help="Trace the conversion to this JSON file, which Perfetto or chrome://tracing can open",
+)
+@click.argument("filename", required=True, metavar="FILENAME (or - for stdin)")
 def cli_main(
-    output_filename: Optional[str], ocr_lang: Optional[str], filename: str
+    output_filename: Optional[str],
+    ocr_lang: Optional[str],
+    ocr_dpi: Optional[int],
+    ocr_binarize: bool,
+    ocr_report_filename: Optional[str],
+    ocr_batch: bool,
+    ocr_workers: Optional[int],
+    ocr_skip_pages: bool,
+    max_shards: int,
+    pages: Optional[str],
+    first_pages: Optional[int],
+    deadline: Optional[float],
+    deadline_scale: Optional[float],
+    page_attempts: Optional[int],
+    placeholder_pages: bool,
+    job_dir: Optional[str],
+    scratch_dir: Optional[str],
+    max_scratch_bytes: Optional[int],
+    stream: bool,
+    endpoint_specs: Tuple[str, ...],
+    result_filename: Optional[str],
+    trace_filename: Optional[str],
+    filename: str,
 ) -> None:
     setup_logging()
     global_common = GlobalCommon()
     common = Common()
 
-    global_common.display_banner()
+    # When the safe PDF goes to stdout, everything else goes to stderr
+    err = output_filename == "-"
+
+    with contextlib.redirect_stdout(sys.stderr if err else sys.stdout):
+        global_common.display_banner()
 
     # Validate filename
-    valid = True
-    try:
-        with open(os.path.abspath(filename), "rb") as f:
-            pass
-    except:
-        valid = False
+    if filename == "-":
+        if not output_filename:
+            click.echo("Use --output-filename when reading from stdin", err=err)
+            return
+        common.input_filename = filename
+    else:
+        valid = True
+        try:
+            with open(os.path.abspath(filename), "rb") as f:
+                pass
+        except:
+            valid = False
 
-    if not valid:
-        click.echo("Invalid filename")
-        return
+        if not valid:
+            click.echo("Invalid filename", err=err)
+            return
 
-    common.input_filename = os.path.abspath(filename)
+        common.input_filename = os.path.abspath(filename)
 
     # Validate safe PDF output filename
-    if output_filename:
+    if output_filename == "-":
+        common.output_filename = output_filename
+
+    elif output_filename:
         valid = True
         if not output_filename.endswith(".pdf"):
             click.echo("Safe PDF filename must end in '.pdf'")
@@ -84,16 +226,38 @@ def cli_main(
                 valid = True
                 break
         if not valid:
-            click.echo("Invalid OCR language code. Valid language codes:")
+            click.echo("Invalid OCR language code. Valid language codes:", err=err)
             for lang in global_common.ocr_languages:
-                click.echo(f"{global_common.ocr_languages[lang]}: {lang}")
+                click.echo(f"{global_common.ocr_languages[lang]}: {lang}", err=err)
+            return
+
+    # Validate page selection
+    if pages:
+        try:
+            parse_page_selection(pages)
+        except ValueError as e:
+            click.echo(str(e), err=err)
             return
 
-    # Ensure container is installed
-    global_common.install_container()
+    # Validate container endpoints
+    endpoint_pool = None
+    if endpoint_specs:
+        try:
+            endpoint_pool = EndpointPool(
+                [parse_endpoint(endpoint_spec) for endpoint_spec in endpoint_specs]
+            )
+        except ValueError as e:
+            click.echo(str(e), err=err)
+            return
+
+    # Ensure container is installed, unless it only runs on remote endpoints
+    if endpoint_pool is None or not all(
+        endpoint.remote for endpoint in endpoint_pool.endpoints
+    ):
+        global_common.install_container(stdout_to_stderr=err)
 
     # Convert the document
-    print_header("Converting document to safe PDF")
+    print_header("Converting document to safe PDF", err)
 
     def stdout_callback(line: str) -> None:
         try:
@@ -103,21 +267,62 @@ def cli_main(
                 s += Style.RESET_ALL + Fore.RED + status["text"]
             else:
                 s += Style.RESET_ALL + status["text"]
-            click.echo(s)
+            click.echo(s, err=err)
         except:
-            click.echo(f"Invalid JSON returned from container: {line}")
+            click.echo(f"Invalid JSON returned from container: {line}", err=err)
 
-    if convert(
-        common.input_filename,
-        common.output_filename,
-        ocr_lang,
-        stdout_callback,
-    ):
-        print_header("Safe PDF created successfully")
-        click.echo(common.output_filename)
+    if trace_filename:
+        tracing.start()
+
+    result = ConversionResult()
+    with tracing.span("convert", input_filename=common.input_filename):
+        success = convert(
+            common.input_filename,
+            common.output_filename,
+            ocr_lang,
+            stdout_callback,
+            ocr_dpi=ocr_dpi,
+            ocr_binarize=ocr_binarize,
+            ocr_report_filename=ocr_report_filename,
+            ocr_batch=ocr_batch,
+            ocr_workers=ocr_workers,
+            ocr_skip_pages=ocr_skip_pages,
+            max_shards=max_shards,
+            pages=pages,
+            first_pages=first_pages,
+            deadline=deadline,
+            deadline_scale=deadline_scale,
+            scratch_dir=scratch_dir,
+            max_scratch_bytes=max_scratch_bytes,
+            page_attempts=page_attempts,
+            placeholder_pages=placeholder_pages,
+            job_dir=job_dir,
+            stream=stream,
+            endpoint_pool=endpoint_pool,
+            result=result,
+        )
+
+    if result_filename:
+        with open(result_filename, "w") as result_file:
+            json.dump(result.to_dict(), result_file, indent=4)
+    if trace_filename:
+        tracing.save(trace_filename)
+
+    if result.degraded_pages:
+        print_header("Some pages were replaced with placeholders", err)
+        for degraded_page in result.degraded_pages:
+            click.echo(
+                f"Page {degraded_page['page']} ({degraded_page['stage']}): {degraded_page['error']}",
+                err=err,
+            )
+
+    if success:
+        print_header("Safe PDF created successfully", err)
+        if not err:
+            click.echo(common.output_filename)
         sys.exit(0)
     else:
-        print_header("Failed to convert document")
+        print_header("Failed to convert document", err)
         sys.exit(-1)
 
 
@@ -1,14 +1,39 @@
+import concurrent.futures
+import contextlib
+import io
+import json
 import logging
 import os
 import pipes
 import platform
+import re
 import shutil
+import stat
 import subprocess
+import sys
 import tempfile
-from typing import Callable, List, Optional
+import threading
+import time
+import uuid
+from typing import IO, Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
 
 import appdirs
 
+from . import tracing
+from .checkpoint import Checkpoint, page_selection
+from .result import PROTOCOL_VERSION, ConversionResult, parse_event
+from .validation import (
+    DEFAULT_MAX_TOTAL_BYTES,
+    MAX_PAGE_HEIGHT,
+    MAX_PAGE_WIDTH,
+    PixelValidationError,
+    PixelValidator,
+    check_num_pages,
+    format_size,
+    open_regular_file,
+    read_num_pages,
+)
+
 # What container tech is used for this platform?
 if platform.system() == "Linux":
     container_tech = "podman"
@@ -28,8 +53,95 @@ log = logging.getLogger(__name__)
 # Name of the dangerzone container
 container_name = "dangerzone.rocks/dangerzone"
 
+# Documents are only split into shards of at least this many pages
+MIN_PAGES_PER_SHARD = 50
+
+# How often to sample the resource usage of a running container, in seconds
+STATS_INTERVAL = 1.0
+
+# Disk space that conversions leave free in the scratch directory, which is
+# at most a SCRATCH_RESERVE_FRACTION of the free space, so that small
+# documents can still be converted on a nearly full disk
+SCRATCH_RESERVE_BYTES = 1024**3
+SCRATCH_RESERVE_FRACTION = 0.1
+
+# Containers keep their scratch files in a tmpfs on /tmp, which can grow to
+# TMPFS_BASE_BYTES plus a multiple of the size of their input: of the document
+# for the containers that read it, and of the pixels for pixels-to-pdf. If
+# that's more than TMPFS_MAX_BYTES, they use their own filesystem instead, so
+# big documents don't take up that much memory. So do the containers that
+# read documents other than PDFs and images, since LibreOffice can turn a
+# small Office document into a PDF of any size.
+TMPFS_BASE_BYTES = 256 * 1024**2
+TMPFS_DOCUMENT_FACTOR = 10
+TMPFS_PIXELS_FACTOR = 3
+TMPFS_MAX_BYTES = 2 * 1024**3
+
+# When streaming, containers keep all of their files in a tmpfs on /tmp/stream,
+# sized like the tmpfs above, but never bigger than STREAM_TMPFS_MAX_BYTES,
+# since the files can't go anywhere else without being written to the host's
+# disk. This also limits how many pixels a streamed document can have.
+STREAM_TMPFS_MAX_BYTES = 8 * 1024**3
+STREAM_ENV_ARGS = [
+    "-e",
+    "DANGERZONE_TMP_DIR=/tmp/stream",
+    "-e",
+    "DANGERZONE_PIXEL_DIR=/tmp/stream/pixels",
+    "-e",
+    "DANGERZONE_SAFE_DIR=/tmp/stream/safe",
+]
+
+# How PDFs and the images that are decoded straight into pixels start. Only
+# these documents need scratch space in proportion to their size.
+HEADER_BYTES = 8
+BOUNDED_DOCUMENT_MAGICS = (
+    b"%PDF-",
+    b"\xff\xd8\xff",
+    b"GIF8",
+    b"\x89PNG\r\n\x1a\n",
+    b"II*\x00",
+    b"MM\x00*",
+)
+
+# Longest line of JSON that a streaming container can output
+MAX_EVENT_LENGTH = 64 * 1024
+
+# How long the health of an endpoint is trusted for, and how long checking it
+# can take, in seconds
+HEALTH_CHECK_INTERVAL = 30.0
+HEALTH_CHECK_TIMEOUT = 10.0
+
+# Units of the sizes in the output of "podman stats" and "docker stats"
+size_units = {
+    "B": 1,
+    "kB": 1000,
+    "KB": 1000,
+    "MB": 1000**2,
+    "GB": 1000**3,
+    "TB": 1000**4,
+    "KiB": 1024,
+    "MiB": 1024**2,
+    "GiB": 1024**3,
+    "TiB": 1024**4,
+}
+size_re = re.compile(r"^\s*([0-9.]+)\s*([A-Za-z]+)\s*$")
+duration_re = re.compile(r"([0-9.]+)(h|ms|m|s|us|µs|ns)")
+duration_units = {
+    "h": 3600,
+    "m": 60,
+    "s": 1,
+    "ms": 0.001,
+    "us": 0.000001,
+    "µs": 0.000001,
+    "ns": 0.000000001,
+}
 
-def exec(args: List[str], stdout_callback: Callable[[str], None] = None) -> int:
+
+def exec(
+    args: List[str],
+    stdout_callback: Callable[[str], None] = None,
+    env: Optional[Dict[str, str]] = None,
+) -> int:
     args_str = " ".join(pipes.quote(s) for s in args)
     log.info("> " + args_str)
 
@@ -41,33 +153,351 @@ def exec(args: List[str], stdout_callback: Callable[[str], None] = None) -> int:
         bufsize=1,
         universal_newlines=True,
         startupinfo=startupinfo,
+        env=env,
     ) as p:
         if stdout_callback and p.stdout is not None:
-            for line in p.stdout:
-                stdout_callback(line)
+            try:
+                for line in p.stdout:
+                    stdout_callback(line)
+            except BaseException:
+                # The callback gave up on the container, so stop it
+                p.terminate()
+                raise
 
         p.communicate()
         return p.returncode
 
 
+class ContainerStatsSampler:
+    """
+    Samples the resource usage of a running container, with "podman stats" or
+    "docker stats", in a background thread. It keeps the peak memory usage,
+    the CPU time, and the bytes read and written by the container.
+
+    The sample that's taken right before the container exits is the last one,
+    so short containers are only sampled once, or not at all. Docker doesn't
+    report the CPU time, so it's added up from the CPU percentage of each
+    sample instead.
+    """
+
+    def __init__(self, runtime_command: List[str], name: str) -> None:
+        self.runtime_command = runtime_command
+        self.name = name
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+        self.start_time = time.monotonic()
+        self.last_sample_time = self.start_time
+        self.stats: Dict[str, Any] = {
+            "wall_seconds": 0.0,
+            "samples": 0,
+            "peak_memory_bytes": 0,
+            "cpu_seconds": 0.0,
+            "read_bytes": 0,
+            "written_bytes": 0,
+        }
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def stop(self) -> Dict[str, Any]:
+        self.stop_event.set()
+        self.thread.join()
+        self.stats["wall_seconds"] = round(time.monotonic() - self.start_time, 3)
+        self.stats["cpu_seconds"] = round(self.stats["cpu_seconds"], 3)
+        return self.stats
+
+    def run(self) -> None:
+        while not self.stop_event.is_set():
+            self.sample()
+            self.stop_event.wait(STATS_INTERVAL)
+
+    def sample(self) -> None:
+        if container_tech == "podman":
+            format = "json"
+        else:
+            format = "{{json .}}"
+        try:
+            p = subprocess.run(
+                self.runtime_command
+                + ["stats", "--no-stream", "--format", format, self.name],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                timeout=10,
+                startupinfo=startupinfo,
+            )
+            stats = json.loads(p.stdout)
+        except (subprocess.TimeoutExpired, ValueError):
+            # The container hasn't started yet, or it's already gone
+            return
+        if isinstance(stats, list):
+            if not stats:
+                return
+            stats = stats[0]
+        if not isinstance(stats, dict):
+            return
+
+        now = time.monotonic()
+        self.stats["samples"] += 1
+        memory = parse_size(str(stats.get("mem_usage", stats.get("MemUsage"))))
+        self.stats["peak_memory_bytes"] = max(self.stats["peak_memory_bytes"], memory)
+        if "cpu_time" in stats:
+            self.stats["cpu_seconds"] = parse_duration(str(stats["cpu_time"]))
+        elif "CPUPerc" in stats:
+            cpu_percent = parse_size(str(stats["CPUPerc"]).replace("%", "B"))
+            self.stats["cpu_seconds"] += (
+                cpu_percent / 100 * (now - self.last_sample_time)
+            )
+        block_io = str(stats.get("block_io", stats.get("BlockIO"))).split("/")
+        if len(block_io) == 2:
+            self.stats["read_bytes"] = max(
+                self.stats["read_bytes"], parse_size(block_io[0])
+            )
+            self.stats["written_bytes"] = max(
+                self.stats["written_bytes"], parse_size(block_io[1])
+            )
+        self.last_sample_time = now
+
+
+def parse_size(size: str) -> int:
+    """
+    Parse a size like "1.5MiB" or "12.3MB" from the output of podman or
+    docker stats into bytes, or 0 if it doesn't look like one
+    """
+    m = size_re.match(size.split("/")[0])
+    if not m or m.group(2) not in size_units:
+        return 0
+    try:
+        return int(float(m.group(1)) * size_units[m.group(2)])
+    except ValueError:
+        return 0
+
+
+def parse_duration(duration: str) -> float:
+    """
+    Parse a duration like "1m2.5s" or "11.6ms" into seconds
+    """
+    seconds = 0.0
+    for number, unit in duration_re.findall(duration):
+        try:
+            seconds += float(number) * duration_units[unit]
+        except ValueError:
+            pass
+    return seconds
+
+
+class NoHealthyEndpointError(Exception):
+    pass
+
+
+class Endpoint:
+    """
+    A podman or docker engine that runs conversions: the one on this computer
+    if url is None, or a remote one, like ssh://core@host/run/podman/podman.sock
+    or unix:///run/podman/podman.sock. It runs up to max_jobs conversions at a
+    time. Nothing can be mounted from this computer in the containers of a
+    remote endpoint, so conversions there are streamed (see convert_stream()).
+    """
+
+    def __init__(self, url: Optional[str] = None, max_jobs: int = 1) -> None:
+        self.url = url
+        self.max_jobs = max_jobs
+        self.active_jobs = 0
+        self.healthy = False
+        self.checked_time: Optional[float] = None
+
+    def __str__(self) -> str:
+        return self.url or "local"
+
+    @property
+    def remote(self) -> bool:
+        return self.url is not None
+
+    def runtime_command(self) -> List[str]:
+        """
+        The podman or docker command that talks to this endpoint
+        """
+        runtime = container_runtime()
+        if self.url is None:
+            return [runtime]
+        if container_tech == "podman":
+            return [runtime, "--url", self.url]
+        return [runtime, "--host", self.url]
+
+    def check_health(self) -> bool:
+        """
+        Check that the container engine answers, and has the dangerzone
+        container image
+        """
+        try:
+            runtime_command = self.runtime_command()
+        except Exception as e:
+            # The container runtime isn't installed
+            log.warning(f"Endpoint {self} is unhealthy: {e}")
+            return False
+
+        try:
+            p = subprocess.run(
+                runtime_command + ["image", "inspect", container_name],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                timeout=HEALTH_CHECK_TIMEOUT,
+                startupinfo=startupinfo,
+            )
+            healthy = p.returncode == 0
+        except (OSError, subprocess.TimeoutExpired):
+            healthy = False
+
+        if not healthy:
+            log.warning(f"Endpoint {self} is unhealthy")
+        return healthy
+
+
+class EndpointPool:
+    """
+    Runs conversions on whichever endpoint has the most free capacity, which
+    is the share of its max_jobs that isn't running yet. Endpoints are
+    checked before their first conversion, again every HEALTH_CHECK_INTERVAL
+    seconds, and right after a conversion fails on them, and unhealthy ones
+    get no conversions until a check passes again.
+    """
+
+    def __init__(self, endpoints: List[Endpoint]) -> None:
+        self.endpoints = endpoints
+        self.condition = threading.Condition()
+
+    def acquire(self) -> Endpoint:
+        """
+        Wait until a healthy endpoint has room for another conversion, and
+        reserve it. Raises NoHealthyEndpointError if none of them is healthy.
+        """
+        with self.condition:
+            while True:
+                self.check_health()
+                healthy = [endpoint for endpoint in self.endpoints if endpoint.healthy]
+                if not healthy:
+                    raise NoHealthyEndpointError(
+                        "None of the container endpoints are healthy"
+                    )
+
+                free = [
+                    endpoint
+                    for endpoint in healthy
+                    if endpoint.active_jobs < endpoint.max_jobs
+                ]
+                if free:
+                    endpoint = max(
+                        free,
+                        key=lambda endpoint: 1
+                        - endpoint.active_jobs / endpoint.max_jobs,
+                    )
+                    endpoint.active_jobs += 1
+                    log.info(f"Converting on endpoint {endpoint}")
+                    return endpoint
+
+                # Wake up in time for the next health check, in case an
+                # endpoint with free capacity comes back
+                self.condition.wait(HEALTH_CHECK_INTERVAL)
+
+    def release(self, endpoint: Endpoint, success: bool) -> None:
+        with self.condition:
+            endpoint.active_jobs -= 1
+            if not success:
+                # Check whether the endpoint itself failed before using it again
+                endpoint.checked_time = None
+            self.condition.notify_all()
+
+    def check_health(self) -> None:
+        """
+        Check the endpoints whose last health check is too old, in parallel
+        """
+        now = time.monotonic()
+        endpoints = [
+            endpoint
+            for endpoint in self.endpoints
+            if endpoint.checked_time is None
+            or now - endpoint.checked_time > HEALTH_CHECK_INTERVAL
+        ]
+        if not endpoints:
+            return
+
+        with concurrent.futures.ThreadPoolExecutor(len(endpoints)) as executor:
+            for endpoint, healthy in zip(
+                endpoints, executor.map(Endpoint.check_health, endpoints)
+            ):
+                endpoint.healthy = healthy
+                endpoint.checked_time = time.monotonic()
+
+
+def parse_endpoint(endpoint: str) -> Endpoint:
+    """
+    Parse an endpoint like "local", "local=2", or
+    "ssh://core@host/run/podman/podman.sock=4", where the number after the
+    last = is how many conversions can run on it at a time (1 by default)
+    """
+    url, _, max_jobs = endpoint.rpartition("=")
+    if not url or not max_jobs.isdigit():
+        url, max_jobs = endpoint, "1"
+    if int(max_jobs) < 1:
+        raise ValueError(f"Endpoint {url} needs to run at least one conversion")
+    if url == "local":
+        return Endpoint(None, int(max_jobs))
+    if "://" not in url:
+        raise ValueError(f"Endpoint {url} isn't local or a URL")
+    return Endpoint(url, int(max_jobs))
+
+
 def exec_container(
     command: List[str],
     extra_args: List[str] = [],
     stdout_callback: Callable[[str], None] = None,
+    stats_callback: Optional[Callable[[Dict[str, Any]], None]] = None,
+    endpoint: Optional[Endpoint] = None,
 ) -> int:
-    if container_tech == "podman":
-        container_runtime = shutil.which("podman")
-        if container_runtime is None:
-            raise Exception(f"podman is not installed")
+    """
+    Run a command in a new container, on endpoint if it's given, or on the
+    local container engine. If stats_callback is given, it gets the resource
+    usage of the container (see ContainerStatsSampler) once it's done.
 
+    DANGERZONE_CONTAINER_RUNTIME can point to a stand-in for podman or
+    docker, like dev_scripts/stub-container-runtime.py.
+    """
+    # Name the container, so its resource usage can be sampled
+    name = f"dangerzone-{uuid.uuid4().hex}"
+    runtime_command = (endpoint or Endpoint()).runtime_command()
+    args = runtime_command + container_args(command, extra_args, name)
+    if stats_callback is None:
+        return exec_traced(args, command, stdout_callback)
+
+    sampler = ContainerStatsSampler(runtime_command, name)
+    sampler.start()
+    try:
+        return exec_traced(args, command, stdout_callback)
+    finally:
+        stats_callback(sampler.stop())
+
+
+def container_runtime() -> str:
+    """
+    The podman or docker executable
+    """
+    runtime = os.environ.get("DANGERZONE_CONTAINER_RUNTIME") or shutil.which(
+        container_tech
+    )
+    if runtime is None:
+        raise Exception(f"{container_tech} is not installed")
+    return runtime
+
+
+def container_args(command: List[str], extra_args: List[str], name: str) -> List[str]:
+    """
+    The arguments of podman or docker that run command in a new container
+    """
+    if container_tech == "podman":
         platform_args = []
         security_args = ["--security-opt", "no-new-privileges"]
         security_args += ["--userns", "keep-id"]
     else:
-        container_runtime = shutil.which("docker")
-        if container_runtime is None:
-            raise Exception(f"docker is not installed")
-
         platform_args = ["--platform", "linux/amd64"]
         security_args = ["--security-opt=no-new-privileges:true"]
 
@@ -76,7 +506,7 @@ def exec_container(
     user_args = ["-u", "dangerzone"]
 
     args = (
-        ["run", "--network", "none"]
+        ["run", "--name", name, "--network", "none"]
         + platform_args
         + user_args
         + security_args
@@ -85,8 +515,74 @@ def exec_container(
         + command
     )
 
-    args = [container_runtime] + args
-    return exec(args, stdout_callback)
+    return args
+
+
+@contextlib.contextmanager
+def stream_container(
+    command: List[str],
+    extra_args: List[str],
+    stats_callback: Callable[[Dict[str, Any]], None],
+    endpoint: Optional[Endpoint] = None,
+) -> Iterator["subprocess.Popen[bytes]"]:
+    """
+    Start a command in a new container, on endpoint if it's given, with pipes
+    to its stdin and stdout instead of volumes (see convert_stream()), and
+    stop it if it's still running once the with block is done. The container
+    is removed once it exits.
+    """
+    name = f"dangerzone-{uuid.uuid4().hex}"
+    runtime_command = (endpoint or Endpoint()).runtime_command()
+    args = runtime_command + container_args(command, ["-i", "--rm"] + extra_args, name)
+    sampler = ContainerStatsSampler(runtime_command, name)
+    sampler.start()
+
+    args_str = " ".join(pipes.quote(s) for s in args)
+    log.info("> " + args_str)
+    try:
+        with tracing.span(f"{container_tech} run", command=" ".join(command)):
+            with subprocess.Popen(
+                args,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                startupinfo=startupinfo,
+            ) as p:
+                try:
+                    yield p
+                finally:
+                    if p.poll() is None:
+                        p.terminate()
+    finally:
+        stats_callback(sampler.stop())
+
+
+def exec_traced(
+    args: List[str],
+    command: List[str],
+    stdout_callback: Callable[[str], None],
+) -> int:
+    """
+    Run a container, tracing how long it takes to start and to run, if tracing
+    is enabled
+    """
+    if not tracing.enabled():
+        return exec(args, stdout_callback)
+
+    # Trace how long the container takes to start, until its first line of
+    # output, and how long it runs altogether
+    start_time = time.time()
+    started = False
+
+    def traced_stdout_callback(line: str) -> None:
+        nonlocal started
+        if not started:
+            started = True
+            tracing.add_span("start container", start_time, time.time() - start_time)
+        if stdout_callback is not None:
+            stdout_callback(line)
+
+    with tracing.span(f"{container_tech} run", command=" ".join(command)):
+        return exec(args, traced_stdout_callback)
 
 
 def convert(
@@ -94,138 +590,1319 @@ def convert(
     output_filename: str,
     ocr_lang: Optional[str],
     stdout_callback: Callable[[str], None],
+    ocr_dpi: Optional[int] = None,
+    ocr_binarize: bool = False,
+    ocr_report_filename: Optional[str] = None,
+    ocr_batch: bool = False,
+    ocr_workers: Optional[int] = None,
+    ocr_skip_pages: bool = False,
+    max_pages: Optional[int] = None,
+    max_pixel_bytes: Optional[int] = None,
+    max_shards: int = 1,
+    pages: Optional[str] = None,
+    first_pages: Optional[int] = None,
+    deadline: Optional[float] = None,
+    deadline_scale: Optional[float] = None,
+    scratch_dir: Optional[str] = None,
+    max_scratch_bytes: Optional[int] = None,
+    page_attempts: Optional[int] = None,
+    placeholder_pages: bool = False,
+    job_dir: Optional[str] = None,
+    stream: bool = False,
+    endpoint_pool: Optional[EndpointPool] = None,
+    result: Optional[ConversionResult] = None,
 ) -> bool:
+    """
+    Convert input_filename into a safe PDF at output_filename.
+
+    OCR runs on a grayscale copy of each page, downsampled to ocr_dpi (and
+    thresholded to black and white if ocr_binarize is set), while the safe PDF
+    keeps the full resolution pixels. By default, pages are only downsampled
+    if they're very big (see DEFAULT_OCR_DPI in the container). To tune these on a corpus, pass
+    ocr_report_filename to get a JSON report with the OCR time and text of
+    each page.
+
+    Up to ocr_workers tesseract processes (by default, one per CPU) OCR pages
+    in parallel. With ocr_batch, each of them OCRs a whole chunk of pages
+    instead of a single one, so it only loads the language model once.
+
+    Blank pages are never OCRed. With ocr_skip_pages, neither are pages that
+    look like they have no text, like photos or pages with just a speck on
+    them (see classify_page() in the container). The OCR report lists the
+    type of each page, to check what that would skip.
+
+    The document can have at most max_pages pages, which add up to at most
+    max_pixel_bytes of pixels (see validation.py for the defaults).
+
+    With pages, a selection like "1-10,50", only those pages of the document
+    are converted, and with first_pages, only the first first_pages of them,
+    like to triage a long document. The other pages are never rendered, and
+    the safe PDF only has the converted pages, numbered from 1.
+
+    Each step of converting a page is tried up to page_attempts times (see
+    PAGE_ATTEMPTS in the container for the default). With placeholder_pages,
+    pages that still fail are replaced with a page that says so, instead of
+    failing the whole document, and are listed in result.degraded_pages.
+
+    The pixels of the pages are written to scratch_dir, which is in the
+    config directory by default, so they can use at most max_scratch_bytes,
+    and never more than the free disk space there (minus
+    SCRATCH_RESERVE_BYTES). The conversion gives up as soon as its pages of
+    pixels add up to more than that. Each page
+    is converted to a PDF as soon as its pixels are validated, and its pixels
+    are deleted then, so they only take up that much space all at once if
+    pixels-to-pdf falls far behind.
+
+    With job_dir, the pixels and the PDF of each page are kept in job_dir
+    instead, until the conversion succeeds, so the pixels of the whole
+    document do take up scratch space all at once. If it's interrupted, converting
+    the same document into the same job_dir again resumes it, and only
+    converts the pages that weren't done (see Checkpoint). Conversions that
+    stream can't be resumed, and ones that can aren't split into shards.
+
+    With stream, nothing is mounted in the containers, and the document, its
+    pixels and the safe PDF are streamed through their stdin and stdout
+    instead (see convert_stream()). This doesn't use scratch_dir, and works
+    with remote container engines, but can't split documents into shards.
+    input_filename and output_filename can then be "-" for this process's
+    stdin and stdout, which always streams.
+
+    With max_shards greater than 1, the pages are counted first, and then
+    split into up to max_shards shards of at least MIN_PAGES_PER_SHARD pages,
+    each one converted by its own pair of containers in parallel. The safe
+    PDFs of the shards are merged in one last container.
+
+    The conversion gets a time budget based on the size of the input and on
+    the number of pages, which is split across its stages (see
+    DEADLINE_BUDGETS in the container). deadline_scale multiplies it, for
+    slow computers, and deadline caps it at a number of seconds.
+
+    With endpoint_pool, the conversion runs on one of its endpoints, once
+    one of them has room for it (see EndpointPool). Conversions on remote
+    endpoints always stream.
+
+    Pass a ConversionResult as result to find out where the time went.
+    """
     success = False
+    start_time = time.monotonic()
+    if result is None:
+        result = ConversionResult()
 
     if ocr_lang:
         ocr = "1"
     else:
         ocr = "0"
 
-    dz_tmp = os.path.join(appdirs.user_config_dir("dangerzone"), "tmp")
-    os.makedirs(dz_tmp, exist_ok=True)
+    pixels_to_pdf_args = [
+        "-e",
+        f"OCR={ocr}",
+        "-e",
+        f"OCR_LANGUAGE={ocr_lang}",
+        "-e",
+        f"OCR_BINARIZE={'1' if ocr_binarize else '0'}",
+        "-e",
+        f"OCR_REPORT={'1' if ocr_report_filename else '0'}",
+    ]
+    if ocr_dpi:
+        pixels_to_pdf_args += ["-e", f"OCR_DPI={ocr_dpi}"]
+    if ocr_batch:
+        pixels_to_pdf_args += ["-e", "OCR_BATCH=1"]
+    if ocr_workers:
+        pixels_to_pdf_args += ["-e", f"OCR_WORKERS={ocr_workers}"]
+    if ocr_skip_pages:
+        pixels_to_pdf_args += ["-e", "OCR_SKIP_PAGES=1"]
+
+    if pages:
+        try:
+            parse_page_selection(pages)
+        except ValueError as e:
+            log.error(e)
+            stdout_callback(
+                json.dumps({"error": True, "text": str(e), "percentage": 0})
+            )
+            result.wall_seconds = time.monotonic() - start_time
+            return False
+
+    if input_filename == "-":
+        # The size of the document is part of its time budget, so read it into
+        # memory first. It's never written to disk.
+        document = sys.stdin.buffer.read()
+        input_size = len(document)
+        stream = True
+    else:
+        input_size = os.path.getsize(input_filename)
+    if output_filename == "-":
+        stream = True
+
+    endpoint = None
+    if endpoint_pool is not None:
+        try:
+            endpoint = endpoint_pool.acquire()
+        except NoHealthyEndpointError as e:
+            log.error(e)
+            stdout_callback(
+                json.dumps({"error": True, "text": str(e), "percentage": 0})
+            )
+            result.wall_seconds = time.monotonic() - start_time
+            return False
+        if endpoint.remote:
+            stream = True
+
+    try:
+        deadline_args = deadline_budget_args(input_size, deadline, deadline_scale)
+
+        # Every container gets these along with its time budget, since pages
+        # are retried in all of them
+        if page_attempts:
+            deadline_args += ["-e", f"PAGE_ATTEMPTS={page_attempts}"]
+        if placeholder_pages:
+            deadline_args += ["-e", "PLACEHOLDER_PAGES=1"]
+
+        if stream:
+            if max_shards > 1:
+                log.warning("Documents aren't split into shards when streaming")
+            if job_dir is not None:
+                log.warning("Conversions that stream can't be resumed")
+            with contextlib.ExitStack() as files:
+                input_file: IO[bytes]
+                if input_filename == "-":
+                    input_file = io.BytesIO(document)
+                else:
+                    input_file = files.enter_context(open(input_filename, "rb"))
+                if output_filename == "-":
+                    output_file = sys.stdout.buffer
+                else:
+                    output_file = files.enter_context(open(output_filename, "wb"))
+                ocr_report_file = None
+                if ocr_lang and ocr_report_filename:
+                    ocr_report_file = files.enter_context(
+                        open(ocr_report_filename, "wb")
+                    )
+
+                success = convert_stream(
+                    input_file,
+                    input_size,
+                    output_file,
+                    ocr_report_file,
+                    pixels_to_pdf_args,
+                    max_pages,
+                    max_pixel_bytes,
+                    deadline_args,
+                    start_time,
+                    result,
+                    stdout_callback,
+                    endpoint=endpoint,
+                    pages=pages,
+                    first_pages=first_pages,
+                )
 
-    tmpdir = tempfile.TemporaryDirectory(dir=dz_tmp)
-    pixel_dir = os.path.join(tmpdir.name, "pixels")
-    safe_dir = os.path.join(tmpdir.name, "safe")
+            if not success:
+                # Don't leave partial files behind
+                for filename in [output_filename, ocr_report_filename]:
+                    if filename and filename != "-" and os.path.exists(filename):
+                        os.remove(filename)
+            result.success = success
+            result.wall_seconds = time.monotonic() - start_time
+            return success
+
+        if job_dir is not None:
+            scratch_dir = job_dir
+        elif scratch_dir is None:
+            scratch_dir = os.path.join(appdirs.user_config_dir("dangerzone"), "tmp")
+        os.makedirs(scratch_dir, exist_ok=True)
+
+        # Make sure there's room for the pixels before starting
+        scratch_bytes = scratch_space(scratch_dir, max_scratch_bytes)
+        if scratch_bytes <= 0:
+            log.error(f"No scratch space left in {scratch_dir}")
+            stdout_callback(
+                json.dumps(
+                    {
+                        "error": True,
+                        "text": f"Not enough free disk space in {scratch_dir}",
+                        "percentage": 0,
+                    }
+                )
+            )
+            result.wall_seconds = time.monotonic() - start_time
+            return False
+        max_pixel_bytes = min(max_pixel_bytes or DEFAULT_MAX_TOTAL_BYTES, scratch_bytes)
+        log.info(
+            f"Pixels can use up to {format_size(max_pixel_bytes)} in {scratch_dir}"
+        )
+
+        tmpdir = None
+        checkpoint = None
+        if job_dir is not None:
+            work_dir = job_dir
+            settings = list(pixels_to_pdf_args)
+            if placeholder_pages:
+                settings.append("PLACEHOLDER_PAGES=1")
+            if pages:
+                settings.append(f"PAGES={pages}")
+            if first_pages:
+                settings.append(f"FIRST_PAGES={first_pages}")
+            checkpoint = Checkpoint(job_dir, input_filename, settings)
+            try:
+                checkpoint.open()
+            except ValueError as e:
+                log.error(e)
+                stdout_callback(
+                    json.dumps({"error": True, "text": str(e), "percentage": 0})
+                )
+                result.wall_seconds = time.monotonic() - start_time
+                return False
+            if max_shards > 1:
+                log.warning("Conversions that can be resumed aren't split into shards")
+                max_shards = 1
+        else:
+            tmpdir = tempfile.TemporaryDirectory(dir=scratch_dir)
+            work_dir = tmpdir.name
+        safe_dir = os.path.join(work_dir, "safe")
+        os.makedirs(safe_dir, exist_ok=True)
+
+        if max_shards > 1:
+            converted = convert_shards(
+                input_filename,
+                work_dir,
+                pixels_to_pdf_args,
+                max_pages,
+                max_pixel_bytes,
+                max_shards,
+                deadline_args,
+                start_time,
+                result,
+                stdout_callback,
+                endpoint=endpoint,
+                pages=pages,
+                first_pages=first_pages,
+            )
+        else:
+            converted = convert_pages(
+                input_filename,
+                pages,
+                work_dir,
+                pixels_to_pdf_args,
+                max_pages,
+                max_pixel_bytes,
+                deadline_args,
+                start_time,
+                result,
+                stdout_callback,
+                endpoint=endpoint,
+                checkpoint=checkpoint,
+                first_pages=first_pages,
+            )
+
+        if converted:
+            with tracing.span("move safe PDF"):
+                # Move the final file to the right place
+                if os.path.exists(output_filename):
+                    os.remove(output_filename)
+
+                container_output_filename = os.path.join(
+                    safe_dir, "safe-output-compressed.pdf"
+                )
+                shutil.move(container_output_filename, output_filename)
+
+                if ocr_lang and ocr_report_filename:
+                    shutil.move(
+                        os.path.join(safe_dir, "ocr-report.json"), ocr_report_filename
+                    )
+
+            # We did it
+            success = True
+
+        # Clean up
+        with tracing.span("clean up"):
+            if tmpdir is not None:
+                tmpdir.cleanup()
+            elif checkpoint is not None and success:
+                checkpoint.remove()
+            else:
+                log.info(f"Convert into the job directory {work_dir} again to resume")
+
+        result.success = success
+        result.wall_seconds = time.monotonic() - start_time
+
+        return success
+
+    finally:
+        if endpoint_pool is not None and endpoint is not None:
+            endpoint_pool.release(endpoint, result.success)
+
+
+def convert_pages(
+    input_filename: str,
+    pages: Optional[str],
+    work_dir: str,
+    pixels_to_pdf_args: List[str],
+    max_pages: Optional[int],
+    max_pixel_bytes: Optional[int],
+    deadline_args: List[str],
+    start_time: float,
+    result: ConversionResult,
+    stdout_callback: Callable[[str], None],
+    shard: Optional[int] = None,
+    endpoint: Optional[Endpoint] = None,
+    checkpoint: Optional[Checkpoint] = None,
+    first_pages: Optional[int] = None,
+) -> bool:
+    """
+    Convert a document, or only the selected pages of it (or the first
+    first_pages of those), into a safe PDF at
+    work_dir/safe/safe-output-compressed.pdf, using a document-to-pixels
+    container and a pixels-to-pdf container. With a checkpoint, only the
+    pages that earlier runs didn't finish are converted. Without one, the
+    containers run at the same time (see convert_pipelined()).
+    """
+    if checkpoint is None:
+        return convert_pipelined(
+            input_filename,
+            pages,
+            first_pages,
+            work_dir,
+            pixels_to_pdf_args,
+            max_pages,
+            max_pixel_bytes,
+            deadline_args,
+            start_time,
+            result,
+            stdout_callback,
+            shard,
+            endpoint,
+        )
+
+    pixel_dir = os.path.join(work_dir, "pixels")
+    safe_dir = os.path.join(work_dir, "safe")
     os.makedirs(pixel_dir, exist_ok=True)
     os.makedirs(safe_dir, exist_ok=True)
 
-    # Convert document to pixels
-    command = ["/usr/bin/python3", "/usr/local/bin/dangerzone.py", "document-to-pixels"]
+    # Pages that are missing from the checkpoint are rendered on their own,
+    # and then moved into pixel_dir
+    render_dir = pixel_dir
+    missing_pages = None
+    if checkpoint is not None:
+        num_pages, missing_pages = checkpoint.resume()
+        if num_pages is None:
+            missing_pages = None
+        else:
+            result.num_pages = num_pages
+            if missing_pages:
+                render_dir = os.path.join(work_dir, "render")
+                if os.path.exists(render_dir):
+                    shutil.rmtree(render_dir)
+                os.makedirs(render_dir)
+                # The pages of the job are numbered within the selection
+                document_pages = selected_pages(pages, num_pages)
+                pages = page_selection([document_pages[i - 1] for i in missing_pages])
+                first_pages = None
+
+    if missing_pages is None or missing_pages:
+        if not convert_to_pixels(
+            input_filename,
+            pages,
+            first_pages,
+            render_dir,
+            max_pages,
+            max_pixel_bytes,
+            deadline_args,
+            start_time,
+            result,
+            stdout_callback,
+            shard,
+            endpoint,
+            checkpoint if missing_pages is None else None,
+            len(missing_pages) if missing_pages else None,
+        ):
+            return False
+
+        if checkpoint is not None and missing_pages:
+            checkpoint.add_pixels(render_dir, missing_pages)
+            shutil.rmtree(render_dir)
+            # The pages were numbered within the selection
+            for page_event in result.pages + result.degraded_pages:
+                if (
+                    page_event["command"] == "document-to-pixels"
+                    and isinstance(page_event["page"], int)
+                    and 0 < page_event["page"] <= len(missing_pages)
+                ):
+                    page_event["page"] = missing_pages[page_event["page"] - 1]
+
+    pixel_bytes = sum(
+        entry.stat().st_size
+        for entry in os.scandir(pixel_dir)
+        if entry.name.endswith(".rgb")
+    )
+
+    # Convert pixels to safe PDF
+    command = ["/usr/bin/python3", "/usr/local/bin/dangerzone.py", "pixels-to-pdf"]
     extra_args = [
-        "-v",
-        f"{input_filename}:/tmp/input_file",
         "-v",
         f"{pixel_dir}:/dangerzone",
+        "-v",
+        f"{safe_dir}:/safezone",
     ]
-    ret = exec_container(command, extra_args, stdout_callback)
+    if checkpoint is not None:
+        extra_args += [
+            "-v",
+            f"{checkpoint.page_dir}:/checkpoint",
+            "-e",
+            "CHECKPOINT=1",
+        ]
+    extra_args += (
+        pixels_to_pdf_args
+        + tmpfs_args(TMPFS_PIXELS_FACTOR * pixel_bytes)
+        + deadline_env_args(deadline_args, start_time)
+    )
+    ret = exec_container(
+        command,
+        extra_args,
+        event_callback(stdout_callback, result, "pixels-to-pdf", shard),
+        stats_callback(result, "pixels-to-pdf", shard),
+        endpoint,
+    )
     if ret != 0:
-        log.error("documents-to-pixels failed")
-    else:
-        # TODO: validate convert to pixels output
+        log.error("pixels-to-pdf failed")
+        return False
+
+    return True
+
+
+def convert_pipelined(
+    input_filename: str,
+    pages: Optional[str],
+    first_pages: Optional[int],
+    work_dir: str,
+    pixels_to_pdf_args: List[str],
+    max_pages: Optional[int],
+    max_pixel_bytes: Optional[int],
+    deadline_args: List[str],
+    start_time: float,
+    result: ConversionResult,
+    stdout_callback: Callable[[str], None],
+    shard: Optional[int],
+    endpoint: Optional[Endpoint],
+) -> bool:
+    """
+    Convert a document like convert_pages(), but start pixels-to-pdf as soon
+    as document-to-pixels has counted the pages, like convert_stream() does.
+    Each page is moved from work_dir/pixels to work_dir/ready as soon as it's
+    validated, and pixels-to-pdf converts it from there and deletes it, so
+    only the pages in between take up scratch space, instead of the pixels of
+    the whole document. If document-to-pixels fails, a stop file in
+    work_dir/ready tells pixels-to-pdf to give up.
+    """
+    pixel_dir = os.path.join(work_dir, "pixels")
+    ready_dir = os.path.join(work_dir, "ready")
+    safe_dir = os.path.join(work_dir, "safe")
+    os.makedirs(pixel_dir, exist_ok=True)
+    os.makedirs(ready_dir, exist_ok=True)
+    os.makedirs(safe_dir, exist_ok=True)
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    pixels_to_pdf: Optional["concurrent.futures.Future[int]"] = None
+
+    def start_pixels_to_pdf(validator: PixelValidator) -> None:
+        nonlocal pixels_to_pdf
+        if pixels_to_pdf is not None or validator.num_pages is None:
+            return
 
-        # Convert pixels to safe PDF
+        # The pixels of the pages aren't known yet, only how many they can be
+        pixel_bytes = min(
+            validator.max_total_bytes,
+            validator.num_pages * MAX_PAGE_WIDTH * MAX_PAGE_HEIGHT * 3,
+        )
         command = ["/usr/bin/python3", "/usr/local/bin/dangerzone.py", "pixels-to-pdf"]
-        extra_args = [
+        extra_args = (
+            [
+                "-v",
+                f"{ready_dir}:/dangerzone",
+                "-v",
+                f"{safe_dir}:/safezone",
+                "-e",
+                "WAIT_FOR_PIXELS=1",
+            ]
+            + pixels_to_pdf_args
+            + tmpfs_args(TMPFS_PIXELS_FACTOR * pixel_bytes)
+            + deadline_env_args(deadline_args, start_time)
+        )
+        pixels_to_pdf = executor.submit(
+            exec_container,
+            command,
+            extra_args,
+            event_callback(stdout_callback, result, "pixels-to-pdf", shard),
+            stats_callback(result, "pixels-to-pdf", shard),
+            endpoint,
+        )
+
+    converted = False
+    with executor:
+        try:
+            converted = convert_to_pixels(
+                input_filename,
+                pages,
+                first_pages,
+                pixel_dir,
+                max_pages,
+                max_pixel_bytes,
+                deadline_args,
+                start_time,
+                result,
+                stdout_callback,
+                shard,
+                endpoint,
+                None,
+                ready_dir=ready_dir,
+                poll_callback=start_pixels_to_pdf,
+            )
+        finally:
+            if not converted:
+                with open(os.path.join(ready_dir, "stop"), "w"):
+                    pass
+        if pixels_to_pdf is None:
+            return False
+        ret = pixels_to_pdf.result()
+
+    if not converted:
+        return False
+    if ret != 0:
+        log.error("pixels-to-pdf failed")
+        return False
+    return True
+
+
+def convert_to_pixels(
+    input_filename: str,
+    pages: Optional[str],
+    first_pages: Optional[int],
+    pixel_dir: str,
+    max_pages: Optional[int],
+    max_pixel_bytes: Optional[int],
+    deadline_args: List[str],
+    start_time: float,
+    result: ConversionResult,
+    stdout_callback: Callable[[str], None],
+    shard: Optional[int],
+    endpoint: Optional[Endpoint],
+    checkpoint: Optional[Checkpoint],
+    expected_pages: Optional[int] = None,
+    ready_dir: Optional[str] = None,
+    poll_callback: Optional[Callable[[PixelValidator], None]] = None,
+) -> bool:
+    """
+    Convert a document, or only the selected pages of it, into validated
+    pixels in pixel_dir, with a document-to-pixels container. With a
+    checkpoint, each page is recorded as soon as it's validated. With
+    expected_pages, the container must convert exactly that many pages.
+
+    With ready_dir, validated pages are moved there (see PixelValidator).
+    poll_callback gets the validator every time it has looked for new pages.
+    """
+    command = ["/usr/bin/python3", "/usr/local/bin/dangerzone.py", "document-to-pixels"]
+    command += page_args(pages, first_pages)
+    extra_args = (
+        [
+            "-v",
+            f"{input_filename}:/tmp/input_file",
             "-v",
             f"{pixel_dir}:/dangerzone",
+        ]
+        + document_tmpfs_args(input_filename)
+        + deadline_env_args(deadline_args, start_time)
+    )
+    # Validate the pixels while the container is still converting pages
+    validator = PixelValidator(pixel_dir, max_pages, max_pixel_bytes, ready_dir)
+
+    callback = event_callback(stdout_callback, result, "document-to-pixels", shard)
+
+    def document_to_pixels_callback(line: str) -> None:
+        callback(line)
+        validator.poll()
+        if checkpoint is not None:
+            checkpoint.record_pixels(validator)
+        if poll_callback is not None:
+            poll_callback(validator)
+
+    try:
+        ret = exec_container(
+            command,
+            extra_args,
+            document_to_pixels_callback,
+            stats_callback(result, "document-to-pixels", shard),
+            endpoint,
+        )
+        if ret == 0:
+            with tracing.span("validate pixels"):
+                validator.finish()
+            if expected_pages is not None and validator.num_pages != expected_pages:
+                raise PixelValidationError(
+                    f"Converted {validator.num_pages} pages instead of {expected_pages}"
+                )
+            if checkpoint is not None:
+                checkpoint.record_pixels(validator)
+            if poll_callback is not None:
+                poll_callback(validator)
+    except PixelValidationError as e:
+        log.error(f"Invalid document-to-pixels output: {e}")
+        stdout_callback(json.dumps({"error": True, "text": str(e), "percentage": 50}))
+        ret = -1
+
+    if ret != 0:
+        log.error("documents-to-pixels failed")
+        return False
+    if shard is None and result.num_pages is None:
+        result.num_pages = validator.num_pages
+    return True
+
+
+def convert_shards(
+    input_filename: str,
+    work_dir: str,
+    pixels_to_pdf_args: List[str],
+    max_pages: Optional[int],
+    max_pixel_bytes: Optional[int],
+    max_shards: int,
+    deadline_args: List[str],
+    start_time: float,
+    result: ConversionResult,
+    stdout_callback: Callable[[str], None],
+    endpoint: Optional[Endpoint] = None,
+    pages: Optional[str] = None,
+    first_pages: Optional[int] = None,
+) -> bool:
+    """
+    Count the pages of a document, convert shards of its pages (or of the
+    selected ones) in parallel, and merge them into a safe PDF at
+    work_dir/safe/safe-output-compressed.pdf
+    """
+    count_dir = os.path.join(work_dir, "count")
+    safe_dir = os.path.join(work_dir, "safe")
+    merge_dir = os.path.join(work_dir, "merge")
+    os.makedirs(count_dir, exist_ok=True)
+    os.makedirs(merge_dir, exist_ok=True)
+
+    # Count the pages
+    command = ["/usr/bin/python3", "/usr/local/bin/dangerzone.py", "count-pages"]
+    extra_args = (
+        [
+            "-v",
+            f"{input_filename}:/tmp/input_file",
+            "-v",
+            f"{count_dir}:/dangerzone",
+        ]
+        + document_tmpfs_args(input_filename)
+        + deadline_env_args(deadline_args, start_time)
+    )
+    ret = exec_container(
+        command,
+        extra_args,
+        event_callback(stdout_callback, result, "count-pages"),
+        stats_callback(result, "count-pages"),
+        endpoint,
+    )
+    if ret != 0:
+        log.error("count-pages failed")
+        return False
+    document_pages = None
+    try:
+        if pages or first_pages:
+            num_pages = read_num_pages(count_dir)
+            if num_pages is not None:
+                # Only the selected pages count towards max_pages
+                document_pages = [
+                    page
+                    for page in selected_pages(pages, num_pages)
+                    if page <= num_pages
+                ][:first_pages]
+                if not document_pages:
+                    raise PixelValidationError(f"The document has no pages in {pages}")
+                num_pages = check_num_pages(len(document_pages), max_pages)
+        else:
+            num_pages = read_num_pages(count_dir, max_pages)
+    except PixelValidationError as e:
+        log.error(f"Invalid count-pages output: {e}")
+        stdout_callback(json.dumps({"error": True, "text": str(e), "percentage": 0}))
+        return False
+    if num_pages is None:
+        log.error("count-pages didn't count the pages")
+        return False
+    result.num_pages = num_pages
+
+    # If the document had to be converted to a PDF to count its pages, the
+    # shards start from that PDF instead of converting the document again. The
+    # container wrote it, so it has to be a regular file: the container engine
+    # would follow a symlink on the host when mounting it.
+    document_filename = os.path.join(count_dir, "document.pdf")
+    if os.path.lexists(document_filename):
+        if not stat.S_ISREG(os.lstat(document_filename).st_mode):
+            log.error("Invalid count-pages output: document.pdf isn't a regular file")
+            return False
+        shard_input_filename = document_filename
+    else:
+        shard_input_filename = input_filename
+
+    shards = shard_page_ranges(num_pages, max_shards)
+    log.info(f"Converting {num_pages} pages in {len(shards)} shards")
+
+    # Combine the progress of all shards into one
+    lock = threading.Lock()
+    percentages = [0] * len(shards)
+
+    def shard_callback(shard: int) -> Callable[[str], None]:
+        def callback(line: str) -> None:
+            try:
+                status = json.loads(line)
+            except ValueError:
+                stdout_callback(line)
+                return
+            # The output of the container can't be trusted, so only progress
+            # events with a percentage and a text are merged
+            if (
+                not isinstance(status, dict)
+                or not isinstance(status.get("percentage"), (int, float))
+                or isinstance(status["percentage"], bool)
+                or not 0 <= status["percentage"] <= 100
+                or not isinstance(status.get("text"), str)
+            ):
+                stdout_callback(line)
+                return
+            with lock:
+                percentages[shard] = status["percentage"]
+                status["percentage"] = 5 + int(sum(percentages) * 0.9 / len(shards))
+                status["text"] = f"Part {shard + 1}/{len(shards)}: {status['text']}"
+                stdout_callback(json.dumps(status))
+
+        return callback
+
+    def convert_shard(shard: int) -> bool:
+        first_page, last_page = shards[shard]
+        shard_max_pixel_bytes = None
+        if max_pixel_bytes:
+            # Each shard gets its share of the budget
+            shard_max_pixel_bytes = (
+                max_pixel_bytes * (last_page - first_page + 1) // num_pages
+            )
+        if document_pages is None:
+            shard_pages = f"{first_page}-{last_page}"
+        else:
+            shard_pages = page_selection(document_pages[first_page - 1 : last_page])
+        return convert_pages(
+            shard_input_filename,
+            shard_pages,
+            os.path.join(work_dir, f"shard-{shard + 1}"),
+            pixels_to_pdf_args,
+            max_pages,
+            shard_max_pixel_bytes,
+            deadline_args,
+            start_time,
+            result,
+            shard_callback(shard),
+            shard + 1,
+            endpoint,
+        )
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(shards)) as executor:
+        if not all(executor.map(convert_shard, range(len(shards)))):
+            return False
+
+    # Merge the safe PDFs of the shards
+    ocr_reports = []
+    with tracing.span("move shards"):
+        for shard in range(len(shards)):
+            shard_safe_dir = os.path.join(work_dir, f"shard-{shard + 1}", "safe")
+            shutil.move(
+                os.path.join(shard_safe_dir, "safe-output-compressed.pdf"),
+                os.path.join(merge_dir, f"part-{shard + 1}.pdf"),
+            )
+            ocr_report_filename = os.path.join(shard_safe_dir, "ocr-report.json")
+            if os.path.lexists(ocr_report_filename):
+                with open_regular_file(ocr_report_filename) as report_file:
+                    ocr_reports.append(json.load(report_file))
+            shutil.rmtree(os.path.join(work_dir, f"shard-{shard + 1}"))
+
+        # The shards don't need the document anymore
+        shutil.rmtree(count_dir)
+
+    command = ["/usr/bin/python3", "/usr/local/bin/dangerzone.py", "merge-pdfs"]
+    extra_args = (
+        [
+            "-v",
+            f"{merge_dir}:/dangerzone",
             "-v",
             f"{safe_dir}:/safezone",
             "-e",
-            f"OCR={ocr}",
-            "-e",
-            f"OCR_LANGUAGE={ocr_lang}",
+            f"NUM_PAGES={num_pages}",
         ]
-        ret = exec_container(command, extra_args, stdout_callback)
+        + pixels_to_pdf_args
+        + tmpfs_args(sum(entry.stat().st_size for entry in os.scandir(merge_dir)))
+        + deadline_env_args(deadline_args, start_time)
+    )
+    ret = exec_container(
+        command,
+        extra_args,
+        event_callback(stdout_callback, result, "merge-pdfs"),
+        stats_callback(result, "merge-pdfs"),
+        endpoint,
+    )
+    if ret != 0:
+        log.error("merge-pdfs failed")
+        return False
+
+    # Number the pages and degraded pages of the shards within the whole
+    # document
+    for page_event in result.pages + result.degraded_pages:
+        if page_event["shard"] is not None and isinstance(page_event["page"], int):
+            page_event["page"] += shards[page_event["shard"] - 1][0] - 1
+
+    if ocr_reports:
+        # Number the pages of the shards' OCR reports within the whole document
+        ocr_report = ocr_reports[0]
+        ocr_report["pages"] = []
+        for shard, shard_ocr_report in enumerate(ocr_reports):
+            for page in shard_ocr_report["pages"]:
+                page["page"] += shards[shard][0] - 1
+                ocr_report["pages"].append(page)
+            if shard > 0:
+                for page_type, count in shard_ocr_report["page_types"].items():
+                    ocr_report["page_types"][page_type] += count
+        with open(os.path.join(safe_dir, "ocr-report.json"), "w") as f:
+            json.dump(ocr_report, f, indent=4)
+
+    return True
+
+
+def count_pages(
+    input_filename: str,
+    deadline: Optional[float] = None,
+    deadline_scale: Optional[float] = None,
+) -> Optional[int]:
+    """
+    Count the pages of a document in a count-pages container of the local
+    container engine, within the same time budget as converting it (see
+    convert()), or return None if it can't be counted. Documents other than
+    PDFs and images are converted to a PDF to count their pages, so this is
+    only cheap for those.
+    """
+    start_time = time.monotonic()
+    deadline_args = deadline_budget_args(
+        os.path.getsize(input_filename), deadline, deadline_scale
+    )
+    with tempfile.TemporaryDirectory() as count_dir:
+        command = ["/usr/bin/python3", "/usr/local/bin/dangerzone.py", "count-pages"]
+        extra_args = (
+            [
+                "-v",
+                f"{input_filename}:/tmp/input_file",
+                "-v",
+                f"{count_dir}:/dangerzone",
+            ]
+            + document_tmpfs_args(input_filename)
+            + deadline_env_args(deadline_args, start_time)
+        )
+        if exec_container(command, extra_args) != 0:
+            return None
+        try:
+            return read_num_pages(count_dir)
+        except PixelValidationError:
+            return None
+
+
+def convert_stream(
+    input_file: IO[bytes],
+    input_size: int,
+    output_file: IO[bytes],
+    ocr_report_file: Optional[IO[bytes]],
+    pixels_to_pdf_args: List[str],
+    max_pages: Optional[int],
+    max_pixel_bytes: Optional[int],
+    deadline_args: List[str],
+    start_time: float,
+    result: ConversionResult,
+    stdout_callback: Callable[[str], None],
+    endpoint: Optional[Endpoint] = None,
+    pages: Optional[str] = None,
+    first_pages: Optional[int] = None,
+) -> bool:
+    """
+    Convert a document from input_file (of input_size bytes) into a safe PDF
+    in output_file without mounting anything in the containers, so that
+    nothing but the safe PDF is written to the host's disk, and remote
+    container engines (like docker -H) work. The containers keep their files
+    in a tmpfs (see stream_tmpfs_args()), so the pixels of the document are
+    limited to what fits in it.
+
+    The document is streamed into the stdin of document-to-pixels. The pages
+    of pixels that come out of its stdout are validated, and streamed into
+    the stdin of pixels-to-pdf, which runs at the same time and converts each
+    page as soon as it arrives. The safe PDF comes out of its stdout. The
+    container's docstring describes the events that carry these files.
+    """
+    max_pixel_bytes = min(
+        max_pixel_bytes or DEFAULT_MAX_TOTAL_BYTES,
+        (STREAM_TMPFS_MAX_BYTES - TMPFS_BASE_BYTES) // TMPFS_PIXELS_FACTOR,
+    )
+    validator = PixelValidator(None, max_pages, max_pixel_bytes)
+    header = input_file.read(HEADER_BYTES)
+    input_file.seek(0)
+    files = {"safe-output-compressed.pdf": output_file}
+    if ocr_report_file is not None:
+        files["ocr-report.json"] = ocr_report_file
+    received: List[str] = []
+
+    document_to_pixels_command = [
+        "/usr/bin/python3",
+        "/usr/local/bin/dangerzone.py",
+        "document-to-pixels",
+        "--stream",
+    ] + page_args(pages, first_pages)
+    pixels_to_pdf_command = [
+        "/usr/bin/python3",
+        "/usr/local/bin/dangerzone.py",
+        "pixels-to-pdf",
+        "--stream",
+    ]
+    with stream_container(
+        document_to_pixels_command,
+        STREAM_ENV_ARGS
+        + stream_tmpfs_args(document_scratch_bytes(header, input_size))
+        + deadline_env_args(deadline_args, start_time),
+        stats_callback(result, "document-to-pixels"),
+        endpoint,
+    ) as document_to_pixels, stream_container(
+        pixels_to_pdf_command,
+        STREAM_ENV_ARGS
+        + pixels_to_pdf_args
+        + stream_tmpfs_args(TMPFS_PIXELS_FACTOR * max_pixel_bytes)
+        + deadline_env_args(deadline_args, start_time),
+        stats_callback(result, "pixels-to-pdf"),
+        endpoint,
+    ) as pixels_to_pdf:
+
+        def send_document() -> None:
+            assert document_to_pixels.stdin is not None
+            try:
+                shutil.copyfileobj(input_file, document_to_pixels.stdin)
+                document_to_pixels.stdin.close()
+            except BrokenPipeError:
+                # document-to-pixels stopped early, and its exit code says why
+                pass
+
+        def receive_files() -> None:
+            assert pixels_to_pdf.stdout is not None
+            stdout = pixels_to_pdf.stdout
+            callback = event_callback(stdout_callback, result, "pixels-to-pdf")
+            for line in iter(lambda: stdout.readline(MAX_EVENT_LENGTH), b""):
+                event = parse_event(line.decode(errors="replace"))
+                if (
+                    event is not None
+                    and event["event"] == "file"
+                    and event.get("name") in files
+                    and event["name"] not in received
+                    and isinstance(event.get("bytes"), int)
+                ):
+                    received.append(event["name"])
+                    copy_bytes(stdout, files[event["name"]], event["bytes"])
+                    files[event["name"]].flush()
+                else:
+                    callback(line.decode(errors="replace"))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            sending = executor.submit(send_document)
+            receiving = executor.submit(receive_files)
+
+            try:
+                relay_pixels(
+                    document_to_pixels,
+                    pixels_to_pdf,
+                    validator,
+                    event_callback(stdout_callback, result, "document-to-pixels"),
+                )
+                valid = document_to_pixels.wait() == 0
+                if valid:
+                    with tracing.span("validate pixels"):
+                        validator.finish()
+                else:
+                    log.error("documents-to-pixels failed")
+            except PixelValidationError as e:
+                log.error(f"Invalid document-to-pixels output: {e}")
+                stdout_callback(
+                    json.dumps({"error": True, "text": str(e), "percentage": 50})
+                )
+                valid = False
+            except BrokenPipeError:
+                log.error("pixels-to-pdf stopped before all pages were sent")
+                valid = False
+
+            if not valid:
+                # Stop both containers, so the threads stop too
+                document_to_pixels.terminate()
+                pixels_to_pdf.terminate()
+            sending.result()
+            try:
+                receiving.result()
+            except EOFError:
+                log.error("pixels-to-pdf stopped before the safe PDF was received")
+                valid = False
+
+        ret = pixels_to_pdf.wait()
         if ret != 0:
             log.error("pixels-to-pdf failed")
-        else:
-            # Move the final file to the right place
-            if os.path.exists(output_filename):
-                os.remove(output_filename)
 
-            container_output_filename = os.path.join(
-                safe_dir, "safe-output-compressed.pdf"
+    result.num_pages = validator.num_pages
+    return valid and ret == 0 and "safe-output-compressed.pdf" in received
+
+
+def relay_pixels(
+    document_to_pixels: "subprocess.Popen[bytes]",
+    pixels_to_pdf: "subprocess.Popen[bytes]",
+    validator: PixelValidator,
+    callback: Callable[[str], None],
+) -> None:
+    """
+    Validate the page count and the pages of pixels that document-to-pixels
+    streams out, and stream them into pixels-to-pdf. The rest of the output of
+    document-to-pixels goes to callback.
+    """
+    assert document_to_pixels.stdout is not None
+    assert pixels_to_pdf.stdin is not None
+    stdout = document_to_pixels.stdout
+    stdin = pixels_to_pdf.stdin
+    for line in iter(lambda: stdout.readline(MAX_EVENT_LENGTH), b""):
+        event = parse_event(line.decode(errors="replace"))
+        if event is None or event["event"] not in ["num_pages", "pixels"]:
+            callback(line.decode(errors="replace"))
+            continue
+
+        fields: Dict[str, Any]
+        if event["event"] == "num_pages":
+            fields = {"num_pages": event.get("num_pages")}
+            if not isinstance(fields["num_pages"], int):
+                raise PixelValidationError("Invalid number of pages returned")
+            validator.set_num_pages(fields["num_pages"])
+        else:
+            fields = {
+                key: event.get(key) for key in ["page", "width", "height", "bytes"]
+            }
+            if not all(isinstance(value, int) for value in fields.values()):
+                raise PixelValidationError("Invalid page returned")
+            validator.add_page(
+                fields["page"], fields["width"], fields["height"], fields["bytes"]
             )
-            shutil.move(container_output_filename, output_filename)
 
-            # We did it
-            success = True
+        # Only pass on the fields that were validated
+        event = {"version": PROTOCOL_VERSION, "event": event["event"], **fields}
+        stdin.write(json.dumps(event).encode() + b"\n")
+        if event["event"] == "pixels":
+            try:
+                copy_bytes(stdout, stdin, fields["bytes"])
+            except EOFError:
+                raise PixelValidationError(f"Page {fields['page']} was cut short")
+        stdin.flush()
+
+    stdin.close()
+
+
+def copy_bytes(src: IO[bytes], dst: IO[bytes], num_bytes: int) -> None:
+    """
+    Copy exactly num_bytes bytes from src to dst, or raise EOFError if src
+    ends before that
+    """
+    while num_bytes > 0:
+        data = src.read(min(num_bytes, 1024 * 1024))
+        if not data:
+            raise EOFError()
+        dst.write(data)
+        num_bytes -= len(data)
+
+
+def event_callback(
+    stdout_callback: Callable[[str], None],
+    result: ConversionResult,
+    command: str,
+    shard: Optional[int] = None,
+) -> Callable[[str], None]:
+    """
+    Make a callback for a container's output, which adds its stage and page
+    events to result, and passes everything else on to stdout_callback
+    """
+
+    if shard is None:
+        process = command
+    else:
+        process = f"{command} (shard {shard})"
+
+    def callback(line: str) -> None:
+        event = parse_event(line)
+        if event is None or event["event"] == "progress":
+            stdout_callback(line)
+        elif event["event"] == "span":
+            tracing.add_container_span(event, process)
+        else:
+            result.add_event(event, command, shard)
+            if event["event"] == "stage":
+                event["name"] = f"stage {event.get('stage')}"
+                tracing.add_container_span(event, process)
+            elif event["event"] == "page":
+                event["name"] = f"page {event.get('page')}"
+                tracing.add_container_span(event, process)
+
+    return callback
+
+
+def stats_callback(
+    result: ConversionResult, command: str, shard: Optional[int] = None
+) -> Callable[[Dict[str, Any]], None]:
+    """
+    Make a callback that adds the resource usage of a container to result
+    """
+
+    def callback(stats: Dict[str, Any]) -> None:
+        result.add_container_stats(stats, command, shard)
+
+    return callback
+
+
+def scratch_space(scratch_dir: str, max_scratch_bytes: Optional[int]) -> int:
+    """
+    How many bytes a conversion can write to scratch_dir: the free disk space
+    there, minus a reserve (see SCRATCH_RESERVE_BYTES), and at most
+    max_scratch_bytes
+    """
+    free_bytes = shutil.disk_usage(scratch_dir).free
+    free_bytes -= min(SCRATCH_RESERVE_BYTES, int(free_bytes * SCRATCH_RESERVE_FRACTION))
+    if max_scratch_bytes is not None:
+        return min(free_bytes, max_scratch_bytes)
+    return free_bytes
+
+
+def document_scratch_bytes(header: bytes, input_size: int) -> Optional[int]:
+    """
+    How many bytes of scratch files the containers that read a document need,
+    judging from its first bytes and its size, or None if there's no telling
+    """
+    if header.startswith(BOUNDED_DOCUMENT_MAGICS):
+        return TMPFS_DOCUMENT_FACTOR * input_size
+    return None
+
+
+def document_tmpfs_args(input_filename: str) -> List[str]:
+    """
+    Arguments that mount a tmpfs on the /tmp of a container that reads the
+    document in input_filename, if its scratch files fit (see tmpfs_args())
+    """
+    with open(input_filename, "rb") as f:
+        header = f.read(HEADER_BYTES)
+    return tmpfs_args(document_scratch_bytes(header, os.path.getsize(input_filename)))
+
+
+def tmpfs_args(scratch_bytes: Optional[int]) -> List[str]:
+    """
+    Arguments that mount a tmpfs on a container's /tmp, with room for
+    scratch_bytes of scratch files, or none if that would take up too much
+    memory, or if scratch_bytes is None because there's no telling
+    """
+    if scratch_bytes is None:
+        return []
+    size = TMPFS_BASE_BYTES + scratch_bytes
+    if size > TMPFS_MAX_BYTES:
+        return []
+    return ["--tmpfs", f"/tmp:rw,nosuid,nodev,mode=1777,size={size}"]
+
+
+def stream_tmpfs_args(scratch_bytes: Optional[int]) -> List[str]:
+    """
+    Arguments that mount a tmpfs on a streaming container's /tmp/stream, with
+    room for scratch_bytes of files, up to STREAM_TMPFS_MAX_BYTES, which is
+    also what it gets if scratch_bytes is None because there's no telling
+    """
+    if scratch_bytes is None:
+        scratch_bytes = STREAM_TMPFS_MAX_BYTES
+    size = min(TMPFS_BASE_BYTES + scratch_bytes, STREAM_TMPFS_MAX_BYTES)
+    return ["--tmpfs", f"/tmp/stream:rw,nosuid,nodev,mode=1777,size={size}"]
+
+
+def deadline_budget_args(
+    input_size: int, deadline: Optional[float], deadline_scale: Optional[float]
+) -> List[str]:
+    """
+    Arguments that tell the containers of a document about its time budget
+    """
+    deadline_args = ["-e", f"INPUT_SIZE={input_size}"]
+    if deadline:
+        deadline_args += ["-e", f"DEADLINE={deadline}"]
+    if deadline_scale:
+        deadline_args += ["-e", f"DEADLINE_SCALE={deadline_scale}"]
+    return deadline_args
+
+
+def deadline_env_args(deadline_args: List[str], start_time: float) -> List[str]:
+    """
+    Arguments that tell a container about the time budget of the document, and
+    how much of it the previous containers already took
+    """
+    return deadline_args + [
+        "-e",
+        f"DEADLINE_ELAPSED={time.monotonic() - start_time:.1f}",
+    ]
+
+
+def shard_page_ranges(num_pages: int, max_shards: int) -> List[Tuple[int, int]]:
+    """
+    Split num_pages pages into up to max_shards (first_page, last_page) ranges
+    of about the same size, each at least MIN_PAGES_PER_SHARD pages long
+    """
+    num_shards = max(1, min(max_shards, num_pages // MIN_PAGES_PER_SHARD))
+    shards = []
+    first_page = 1
+    for shard in range(num_shards):
+        shard_size = num_pages // num_shards
+        if shard < num_pages % num_shards:
+            shard_size += 1
+        shards.append((first_page, first_page + shard_size - 1))
+        first_page += shard_size
+    return shards
+
+
+def parse_page_selection(pages: str) -> List[Tuple[int, int]]:
+    """
+    Parse a selection of pages like "1-10,50" into (first_page, last_page)
+    ranges, the same way document-to-pixels does, or raise ValueError
+    """
+    ranges = []
+    for part in pages.split(","):
+        m = re.fullmatch(r"\s*([0-9]+)\s*(?:-\s*([0-9]+)\s*)?", part)
+        if not m or int(m.group(1)) == 0:
+            raise ValueError(f"Invalid page selection: {pages}")
+        first = int(m.group(1))
+        last = int(m.group(2)) if m.group(2) else first
+        if last < first:
+            raise ValueError(f"Invalid page selection: {pages}")
+        ranges.append((first, last))
+    return ranges
+
+
+def selected_pages(pages: Optional[str], num_pages: int) -> List[int]:
+    """
+    The first num_pages pages of a selection, in order. When document-to-pixels
+    converted num_pages pages of a selection, these are the pages of the
+    document that it numbered from 1 to num_pages.
+    """
+    if not pages:
+        return list(range(1, num_pages + 1))
+    document_pages: Set[int] = set()
+    for first, last in parse_page_selection(pages):
+        document_pages.update(range(first, min(last, first + num_pages - 1) + 1))
+    return sorted(document_pages)[:num_pages]
+
 
-    # Clean up
-    tmpdir.cleanup()
-
-    return success
-
-
-# From global_common:
-
-# def validate_convert_to_pixel_output(self, common, output):
-#     """
-#     Take the output from the convert to pixels tasks and validate it. Returns
-#     a tuple like: (success (boolean), error_message (str))
-#     """
-#     max_image_width = 10000
-#     max_image_height = 10000
-
-#     # Did we hit an error?
-#     for line in output.split("\n"):
-#         if (
-#             "failed:" in line
-#             or "The document format is not supported" in line
-#             or "Error" in line
-#         ):
-#             return False, output
-
-#     # How many pages was that?
-#     num_pages = None
-#     for line in output.split("\n"):
-#         if line.startswith("Document has "):
-#             num_pages = line.split(" ")[2]
-#             break
-#     if not num_pages or not num_pages.isdigit() or int(num_pages) <= 0:
-#         return False, "Invalid number of pages returned"
-#     num_pages = int(num_pages)
-
-#     # Make sure we have the files we expect
-#     expected_filenames = []
-#     for i in range(1, num_pages + 1):
-#         expected_filenames += [
-#             f"page-{i}.rgb",
-#             f"page-{i}.width",
-#             f"page-{i}.height",
-#         ]
-#     expected_filenames.sort()
-#     actual_filenames = os.listdir(common.pixel_dir.name)
-#     actual_filenames.sort()
-
-#     if expected_filenames != actual_filenames:
-#         return (
-#             False,
-#             f"We expected these files:\n{expected_filenames}\n\nBut we got these files:\n{actual_filenames}",
-#         )
-
-#     # Make sure the files are the correct sizes
-#     for i in range(1, num_pages + 1):
-#         with open(f"{common.pixel_dir.name}/page-{i}.width") as f:
-#             w_str = f.read().strip()
-#         with open(f"{common.pixel_dir.name}/page-{i}.height") as f:
-#             h_str = f.read().strip()
-#         w = int(w_str)
-#         h = int(h_str)
-#         if (
-#             not w_str.isdigit()
-#             or not h_str.isdigit()
-#             or w <= 0
-#             or w > max_image_width
-#             or h <= 0
-#             or h > max_image_height
-#         ):
-#             return False, f"Page {i} has invalid geometry"
-
-#         # Make sure the RGB file is the correct size
-#         if os.path.getsize(f"{common.pixel_dir.name}/page-{i}.rgb") != w * h * 3:
-#             return False, f"Page {i} has an invalid RGB file size"
-
-#     return True, True
+def page_args(pages: Optional[str], first_pages: Optional[int]) -> List[str]:
+    """
+    The arguments of document-to-pixels that only convert the selected pages
+    """
+    args = []
+    if pages:
+        args += ["--pages", pages]
+    if first_pages:
+        args += ["--max-pages", str(first_pages)]
+    return args
@@ -423,9 +423,11 @@ class GlobalCommon(object):
         else:
             return None
 
-    def install_container(self) -> Optional[bool]:
+    def install_container(self, stdout_to_stderr: bool = False) -> Optional[bool]:
         """
-        Make sure the podman container is installed. Linux only.
+        Make sure the podman container is installed. Linux only. With
+        stdout_to_stderr, the output of loading it goes to stderr, for when
+        stdout is the safe PDF.
         """
         if self.is_container_installed():
             return True
@@ -436,6 +438,7 @@ class GlobalCommon(object):
         p = subprocess.Popen(
             [self.get_container_runtime(), "load"],
             stdin=subprocess.PIPE,
+            stdout=sys.stderr if stdout_to_stderr else None,
             startupinfo=self.get_subprocess_startupinfo(),
         )
 
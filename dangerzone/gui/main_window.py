@@ -10,8 +10,9 @@ from typing import Optional
 from colorama import Fore, Style
 from PySide2 import QtCore, QtGui, QtWidgets
 
+from .. import tracing
 from ..common import Common
-from ..container import convert
+from ..container import convert, parse_page_selection
 from ..global_common import GlobalCommon
 from .common import GuiCommon
 
@@ -378,6 +379,26 @@ class SettingsWidget(QtWidgets.QWidget):
         ocr_layout.addWidget(self.ocr_combobox)
         ocr_layout.addStretch()
 
+        # Only convert some pages
+        self.pages_checkbox = QtWidgets.QCheckBox("Only convert pages")
+        self.pages_checkbox.clicked.connect(self.update_ui)
+        self.pages_lineedit = QtWidgets.QLineEdit()
+        self.pages_lineedit.setPlaceholderText("1-10,50")
+        self.pages_lineedit.textChanged.connect(self.update_ui)
+        pages_layout = QtWidgets.QHBoxLayout()
+        pages_layout.addWidget(self.pages_checkbox)
+        pages_layout.addWidget(self.pages_lineedit)
+        pages_layout.addStretch()
+
+        self.first_pages_checkbox = QtWidgets.QCheckBox("Only convert the first")
+        self.first_pages_spinbox = QtWidgets.QSpinBox()
+        self.first_pages_spinbox.setRange(1, 9999)
+        first_pages_layout = QtWidgets.QHBoxLayout()
+        first_pages_layout.addWidget(self.first_pages_checkbox)
+        first_pages_layout.addWidget(self.first_pages_spinbox)
+        first_pages_layout.addWidget(QtWidgets.QLabel("pages"))
+        first_pages_layout.addStretch()
+
         # Button
         self.start_button = QtWidgets.QPushButton("Convert to Safe Document")
         self.start_button.clicked.connect(self.start_button_clicked)
@@ -397,6 +418,8 @@ class SettingsWidget(QtWidgets.QWidget):
         if platform.system() != "Windows":
             layout.addLayout(open_layout)
         layout.addLayout(ocr_layout)
+        layout.addLayout(pages_layout)
+        layout.addLayout(first_pages_layout)
         layout.addSpacing(20)
         layout.addLayout(button_layout)
         layout.addStretch()
@@ -419,6 +442,20 @@ class SettingsWidget(QtWidgets.QWidget):
         if index != -1:
             self.ocr_combobox.setCurrentIndex(index)
 
+        if self.global_common.settings.get("only_pages"):
+            self.pages_checkbox.setCheckState(QtCore.Qt.Checked)
+        else:
+            self.pages_checkbox.setCheckState(QtCore.Qt.Unchecked)
+        self.pages_lineedit.setText(self.global_common.settings.get("pages"))
+
+        if self.global_common.settings.get("only_first_pages"):
+            self.first_pages_checkbox.setCheckState(QtCore.Qt.Checked)
+        else:
+            self.first_pages_checkbox.setCheckState(QtCore.Qt.Unchecked)
+        self.first_pages_spinbox.setValue(
+            self.global_common.settings.get("first_pages")
+        )
+
         if platform.system() == "Darwin" or platform.system() == "Linux":
             if self.global_common.settings.get("open"):
                 self.open_checkbox.setCheckState(QtCore.Qt.Checked)
@@ -447,6 +484,13 @@ class SettingsWidget(QtWidgets.QWidget):
             else:
                 self.start_button.setEnabled(False)
 
+        # The selection of pages must be valid
+        if self.pages_checkbox.checkState() == QtCore.Qt.Checked:
+            try:
+                parse_page_selection(self.pages_lineedit.text())
+            except ValueError:
+                self.start_button.setEnabled(False)
+
     def document_selected(self) -> None:
         # Update the danger doc label
         self.dangerous_doc_label.setText(
@@ -483,6 +527,15 @@ class SettingsWidget(QtWidgets.QWidget):
             "ocr", self.ocr_checkbox.checkState() == QtCore.Qt.Checked
         )
         self.global_common.settings.set("ocr_language", self.ocr_combobox.currentText())
+        self.global_common.settings.set(
+            "only_pages", self.pages_checkbox.checkState() == QtCore.Qt.Checked
+        )
+        self.global_common.settings.set("pages", self.pages_lineedit.text())
+        self.global_common.settings.set(
+            "only_first_pages",
+            self.first_pages_checkbox.checkState() == QtCore.Qt.Checked,
+        )
+        self.global_common.settings.set("first_pages", self.first_pages_spinbox.value())
         if platform.system() == "Darwin" or platform.system() == "Linux":
             self.global_common.settings.set(
                 "open", self.open_checkbox.checkState() == QtCore.Qt.Checked
@@ -515,12 +568,30 @@ class ConvertThread(QtCore.QThread):
         else:
             ocr_lang = None
 
-        if convert(
-            self.common.input_filename,
-            self.common.output_filename,
-            ocr_lang,
-            self.stdout_callback,
-        ):
+        if self.global_common.settings.get("only_pages"):
+            pages = self.global_common.settings.get("pages")
+        else:
+            pages = None
+        if self.global_common.settings.get("only_first_pages"):
+            first_pages = self.global_common.settings.get("first_pages")
+        else:
+            first_pages = None
+
+        # Set DANGERZONE_TRACE to a filename to trace the conversion
+        trace_filename = tracing.start_from_environment()
+        with tracing.span("convert", input_filename=self.common.input_filename):
+            success = convert(
+                self.common.input_filename,
+                self.common.output_filename,
+                ocr_lang,
+                self.stdout_callback,
+                pages=pages,
+                first_pages=first_pages,
+            )
+        if trace_filename:
+            tracing.save(trace_filename)
+
+        if success:
             self.finished.emit(self.error)
 
     def stdout_callback(self, line: str) -> None:
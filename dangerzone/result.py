@@ -0,0 +1,174 @@
+import json
+from typing import Any, Dict, List, Optional
+
+# Newest version of the container's JSON events that this understands
+PROTOCOL_VERSION = 1
+
+
+def parse_event(line: str) -> Optional[Dict[str, Any]]:
+    """
+    Parse a line of container output into an event, or return None if it isn't
+    one. Progress lines from containers that predate the versioned events are
+    turned into progress events.
+    """
+    try:
+        event = json.loads(line)
+    except ValueError:
+        return None
+    if not isinstance(event, dict):
+        return None
+    if "version" not in event:
+        event["version"] = 0
+        event["event"] = "progress"
+    if not isinstance(event["version"], int) or event["version"] > PROTOCOL_VERSION:
+        return None
+    return event
+
+
+class ConversionResult:
+    """
+    What happened during a conversion: whether it succeeded, how long it took,
+    and where that time went, from the stage and page events of the containers.
+    Each event is tagged with the container command that sent it, and with
+    its shard if the document was converted in shards.
+
+    It also has the resource usage of each container that the conversion ran,
+    as sampled by the host, and the pages that were replaced with placeholders
+    because they couldn't be converted.
+    """
+
+    def __init__(self) -> None:
+        self.success = False
+        self.wall_seconds = 0.0
+        self.num_pages: Optional[int] = None
+        self.stages: List[Dict[str, Any]] = []
+        self.pages: List[Dict[str, Any]] = []
+        self.containers: List[Dict[str, Any]] = []
+        self.degraded_pages: List[Dict[str, Any]] = []
+
+    def add_event(
+        self, event: Dict[str, Any], command: str, shard: Optional[int] = None
+    ) -> None:
+        if event["event"] == "stage":
+            events = self.stages
+            keys = ["stage", "wall_seconds", "cpu_seconds", "bytes"]
+        elif event["event"] == "page":
+            events = self.pages
+            keys = ["stage", "page", "wall_seconds", "cpu_seconds", "bytes"]
+        elif event["event"] == "degraded":
+            events = self.degraded_pages
+            keys = ["stage", "page", "error"]
+        else:
+            return
+
+        # The container isn't trusted, so only keep the fields we expect
+        fields: Dict[str, Any] = {"command": command, "shard": shard}
+        for key in keys:
+            value = event.get(key)
+            if key == "stage":
+                if not isinstance(value, str):
+                    return
+                fields[key] = value[:32]
+            elif key == "error":
+                if not isinstance(value, str):
+                    return
+                fields[key] = value[:256]
+            elif value is None or isinstance(value, (int, float)):
+                fields[key] = value
+            else:
+                return
+        events.append(fields)
+
+    def add_container_stats(
+        self, stats: Dict[str, Any], command: str, shard: Optional[int] = None
+    ) -> None:
+        self.containers.append({"command": command, "shard": shard, **stats})
+
+    def resource_totals(self) -> Dict[str, float]:
+        """
+        Add up the resource usage of all containers. Containers run one after
+        the other, except for shards, which run at the same time. So the peak
+        memory usage is the largest of the containers outside of shards, or the
+        sum of each shard's largest, whichever is bigger.
+        """
+        totals: Dict[str, float] = {
+            "peak_memory_bytes": 0,
+            "cpu_seconds": 0.0,
+            "read_bytes": 0,
+            "written_bytes": 0,
+        }
+        shard_peaks: Dict[int, int] = {}
+        for container in self.containers:
+            totals["cpu_seconds"] += container["cpu_seconds"]
+            totals["read_bytes"] += container["read_bytes"]
+            totals["written_bytes"] += container["written_bytes"]
+            if container["shard"] is None:
+                totals["peak_memory_bytes"] = max(
+                    totals["peak_memory_bytes"], container["peak_memory_bytes"]
+                )
+            else:
+                shard_peaks[container["shard"]] = max(
+                    shard_peaks.get(container["shard"], 0),
+                    container["peak_memory_bytes"],
+                )
+        totals["peak_memory_bytes"] = max(
+            totals["peak_memory_bytes"], sum(shard_peaks.values())
+        )
+        return totals
+
+    def stage_totals(self) -> Dict[str, Dict[str, float]]:
+        """
+        Add up the wall time, CPU time and bytes of each stage, across commands
+        and shards
+        """
+        totals: Dict[str, Dict[str, float]] = {}
+        for stage in self.stages:
+            total = totals.setdefault(
+                stage["stage"], {"wall_seconds": 0.0, "cpu_seconds": 0.0, "bytes": 0}
+            )
+            for key in total:
+                total[key] += stage[key] or 0
+        return totals
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "version": PROTOCOL_VERSION,
+            "success": self.success,
+            "wall_seconds": round(self.wall_seconds, 3),
+            "num_pages": self.num_pages,
+            "resource_totals": self.resource_totals(),
+            "stage_totals": self.stage_totals(),
+            "containers": self.containers,
+            "stages": self.stages,
+            "pages": self.pages,
+            "degraded_pages": self.degraded_pages,
+        }
+
+
+def summarize(results: List[ConversionResult]) -> Dict[str, Any]:
+    """
+    Summarize the results of a batch of conversions: how many succeeded, and
+    the total, average and largest time and resources that they took
+    """
+    summary: Dict[str, Any] = {
+        "conversions": len(results),
+        "succeeded": sum(1 for result in results if result.success),
+        "pages": sum(result.num_pages or 0 for result in results),
+    }
+    per_conversion = [result.resource_totals() for result in results]
+    for result, totals in zip(results, per_conversion):
+        totals["wall_seconds"] = result.wall_seconds
+    for key in [
+        "wall_seconds",
+        "cpu_seconds",
+        "peak_memory_bytes",
+        "read_bytes",
+        "written_bytes",
+    ]:
+        values = [totals[key] for totals in per_conversion]
+        summary[key] = {
+            "total": sum(values),
+            "mean": sum(values) / len(values) if values else 0,
+            "max": max(values, default=0),
+        }
+    return summary
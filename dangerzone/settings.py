@@ -21,6 +21,10 @@ class Settings:
             "save": True,
             "ocr": True,
             "ocr_language": "English",
+            "only_pages": False,
+            "pages": "",
+            "only_first_pages": False,
+            "first_pages": 10,
             "open": True,
             "open_app": None,
         }
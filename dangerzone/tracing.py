@@ -0,0 +1,127 @@
+"""
+Tracing for conversions, which records spans on the host and inside the
+containers, and saves them as a JSON file in Chrome's trace event format. Open
+it in Perfetto (ui.perfetto.dev) or in chrome://tracing.
+
+Tracing is off until start() is called, so span() and add_span() don't cost
+anything otherwise. Spans are timestamped with the wall clock, which is shared
+by the host and the containers.
+"""
+import contextlib
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional
+
+_lock = threading.Lock()
+_events: Optional[List[Dict[str, Any]]] = None
+_processes: Dict[str, int] = {}
+
+
+def start() -> None:
+    global _events
+    with _lock:
+        _events = []
+        _processes.clear()
+
+
+def enabled() -> bool:
+    return _events is not None
+
+
+def save(filename: str) -> None:
+    """
+    Write the spans recorded so far to filename
+    """
+    with _lock:
+        if _events is None:
+            return
+        with open(filename, "w") as f:
+            json.dump({"traceEvents": _events, "displayTimeUnit": "ms"}, f)
+
+
+def add_span(
+    name: str,
+    start_time: float,
+    seconds: float,
+    process: str = "host",
+    thread: Optional[int] = None,
+    args: Optional[Dict[str, Any]] = None,
+) -> None:
+    """
+    Record a span that started at start_time (seconds since the epoch) and
+    lasted for the given number of seconds. Spans of each process (the host,
+    or a container) are shown together.
+    """
+    if _events is None:
+        return
+    if thread is None:
+        thread = threading.get_ident()
+    with _lock:
+        if process not in _processes:
+            _processes[process] = len(_processes) + 1
+            _events.append(
+                {
+                    "name": "process_name",
+                    "ph": "M",
+                    "pid": _processes[process],
+                    "args": {"name": process},
+                }
+            )
+        _events.append(
+            {
+                "name": name,
+                "ph": "X",
+                "ts": round(start_time * 1000000),
+                "dur": round(seconds * 1000000),
+                "pid": _processes[process],
+                "tid": thread,
+                "args": args or {},
+            }
+        )
+
+
+@contextlib.contextmanager
+def span(name: str, **args: Any) -> Iterator[None]:
+    """
+    Record a span on the host, for as long as the with block runs
+    """
+    if _events is None:
+        yield
+        return
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        add_span(name, start_time, time.time() - start_time, args=args)
+
+
+def add_container_span(event: Dict[str, Any], process: str) -> None:
+    """
+    Record a span that a container reported. The container isn't trusted, so
+    spans that don't look right are dropped.
+    """
+    name = event.get("name")
+    start_time = event.get("start_time")
+    seconds = event.get("wall_seconds")
+    thread = event.get("thread", 0)
+    if (
+        not isinstance(name, str)
+        or not isinstance(start_time, (int, float))
+        or not isinstance(seconds, (int, float))
+        or not isinstance(thread, int)
+    ):
+        return
+    add_span(name[:64], start_time, seconds, process, thread)
+
+
+def start_from_environment() -> Optional[str]:
+    """
+    Start tracing if DANGERZONE_TRACE is set to the filename to save it to,
+    and return that filename
+    """
+    filename = os.environ.get("DANGERZONE_TRACE")
+    if filename:
+        start()
+    return filename
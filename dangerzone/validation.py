@@ -0,0 +1,263 @@
+import errno
+import logging
+import mmap
+import os
+import re
+import stat
+from typing import BinaryIO, Optional, Set
+
+# Limits on the pixel pages that document-to-pixels produces
+MAX_PAGE_WIDTH = 10000
+MAX_PAGE_HEIGHT = 10000
+DEFAULT_MAX_PAGES = 10000
+DEFAULT_MAX_TOTAL_BYTES = 64 * 1024 * 1024 * 1024
+
+# Longest file with a number in it (like a page's width) that's read
+MAX_NUMBER_FILE_BYTES = 32
+
+log = logging.getLogger(__name__)
+
+page_height_re = re.compile(r"^page-([1-9][0-9]*)\.height$")
+
+
+class PixelValidationError(Exception):
+    pass
+
+
+class PixelValidator:
+    """
+    Validates the pixel pages that the document-to-pixels container writes to
+    pixel_dir. The container writes each page's .rgb and .width files first,
+    and then its .height file, so poll() can be called any number of times
+    while the container is still running, and it validates the pages that are
+    complete so far. Once the container is done, finish() makes sure that the
+    whole document is there.
+
+    Each .rgb file is memory-mapped to check its size against the page's
+    declared geometry, without reading it. Raises PixelValidationError as soon
+    as something is wrong.
+
+    With ready_dir, each page is moved there as soon as it's validated, and
+    the page count is written there as soon as it's known, so pixels-to-pdf
+    can convert the pages while document-to-pixels is still running (see
+    convert_pages() in container.py). The .height file of a page is moved
+    last, like the container writes it last.
+
+    When the container streams its pages instead (see convert_stream() in
+    container.py), pixel_dir is None, and the page count and each page are
+    validated with set_num_pages() and add_page() before they're read.
+    """
+
+    def __init__(
+        self,
+        pixel_dir: Optional[str],
+        max_pages: Optional[int] = None,
+        max_total_bytes: Optional[int] = None,
+        ready_dir: Optional[str] = None,
+    ) -> None:
+        self.pixel_dir = pixel_dir
+        self.ready_dir = ready_dir
+        self.max_pages = max_pages or DEFAULT_MAX_PAGES
+        self.max_total_bytes = max_total_bytes or DEFAULT_MAX_TOTAL_BYTES
+
+        self.num_pages: Optional[int] = None
+        self.validated_pages: Set[int] = set()
+        self.next_page = 1
+        self.total_bytes = 0
+        self.warned = False
+
+    def poll(self) -> None:
+        assert self.pixel_dir is not None
+        if self.num_pages is None:
+            self.num_pages = read_num_pages(self.pixel_dir, self.max_pages)
+            if self.num_pages is None:
+                return
+            if self.ready_dir is not None:
+                filename = os.path.join(self.ready_dir, "num_pages")
+                with open(f"{filename}.tmp", "w") as f:
+                    f.write(str(self.num_pages))
+                os.replace(f"{filename}.tmp", filename)
+
+        # Pages are converted in order, so only look for the next ones
+        while self.next_page <= self.num_pages:
+            if self.next_page not in self.validated_pages:
+                if not os.path.exists(
+                    os.path.join(self.pixel_dir, f"page-{self.next_page}.height")
+                ):
+                    break
+                self._validate_page(self.next_page)
+            self.next_page += 1
+
+    def finish(self) -> None:
+        if self.pixel_dir is None:
+            if self.num_pages is None or len(self.validated_pages) != self.num_pages:
+                raise PixelValidationError("Some pages are missing")
+            return
+
+        self.poll()
+        if self.num_pages is None:
+            raise PixelValidationError("Invalid number of pages returned")
+
+        # Validate any pages that weren't converted in order
+        for name in os.listdir(self.pixel_dir):
+            m = page_height_re.match(name)
+            if m and int(m.group(1)) not in self.validated_pages:
+                self._validate_page(int(m.group(1)))
+
+        # Make sure we have the files we expect, and nothing else
+        expected_filenames = {"num_pages"}
+        if self.ready_dir is None:
+            for page in range(1, self.num_pages + 1):
+                expected_filenames.update(
+                    [f"page-{page}.rgb", f"page-{page}.width", f"page-{page}.height"]
+                )
+        actual_filenames = set(os.listdir(self.pixel_dir))
+        if expected_filenames != actual_filenames:
+            missing = sorted(expected_filenames - actual_filenames)
+            unexpected = sorted(actual_filenames - expected_filenames)
+            raise PixelValidationError(
+                f"Invalid pixel files, missing: {missing}, unexpected: {unexpected}"
+            )
+
+    def set_num_pages(self, num_pages: int) -> None:
+        if self.num_pages is not None:
+            raise PixelValidationError("Invalid number of pages returned")
+        self.num_pages = check_num_pages(num_pages, self.max_pages)
+
+    def _validate_page(self, page: int) -> None:
+        assert self.pixel_dir is not None
+        filename_base = os.path.join(self.pixel_dir, f"page-{page}")
+        w_str = read_number_file(f"{filename_base}.width")
+        h_str = read_number_file(f"{filename_base}.height")
+        if not w_str.isdigit() or not h_str.isdigit():
+            raise PixelValidationError(f"Page {page} has invalid geometry")
+
+        # Make sure the RGB file is the correct size
+        with open_regular_file(f"{filename_base}.rgb") as f:
+            try:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    size = len(m)
+            except ValueError:
+                # Empty files can't be mapped
+                size = 0
+        self.add_page(page, int(w_str), int(h_str), size)
+
+        if self.ready_dir is not None:
+            for extension in ["rgb", "width", "height"]:
+                os.rename(
+                    f"{filename_base}.{extension}",
+                    os.path.join(self.ready_dir, f"page-{page}.{extension}"),
+                )
+
+    def add_page(self, page: int, width: int, height: int, size: int) -> None:
+        """
+        Validate the geometry and the number of bytes of a page, and count it
+        towards the limits
+        """
+        if self.num_pages is None or page <= 0 or page > self.num_pages:
+            raise PixelValidationError(f"Unexpected page {page}")
+        if page in self.validated_pages:
+            raise PixelValidationError(f"Page {page} was returned twice")
+        if (
+            width <= 0
+            or width > MAX_PAGE_WIDTH
+            or height <= 0
+            or height > MAX_PAGE_HEIGHT
+        ):
+            raise PixelValidationError(f"Page {page} has invalid geometry")
+        if size != width * height * 3:
+            raise PixelValidationError(f"Page {page} has an invalid RGB file size")
+
+        self.total_bytes += size
+        if self.total_bytes > self.max_total_bytes:
+            raise PixelValidationError(
+                f"Document is too large ({self.total_bytes} bytes of pixels so far, the maximum is {self.max_total_bytes})"
+            )
+        self.validated_pages.add(page)
+
+        # Pages can have very different sizes, like a big cover followed by
+        # small pages, so an estimate of the whole document from the pages so
+        # far is only worth a warning
+        estimated_bytes = self.total_bytes * self.num_pages // len(self.validated_pages)
+        if estimated_bytes > self.max_total_bytes and not self.warned:
+            log.warning(
+                f"If the rest of its pages are like the first ones, the document needs about {format_size(estimated_bytes)} of pixels, and the maximum is {format_size(self.max_total_bytes)}"
+            )
+            self.warned = True
+
+
+def read_num_pages(pixel_dir: str, max_pages: Optional[int] = None) -> Optional[int]:
+    """
+    Read and validate the page count that the container wrote to pixel_dir,
+    or return None if it hasn't written it yet
+    """
+    try:
+        num_pages_str = read_number_file(os.path.join(pixel_dir, "num_pages"))
+    except FileNotFoundError:
+        return None
+
+    if not num_pages_str.isdigit():
+        raise PixelValidationError("Invalid number of pages returned")
+    return check_num_pages(int(num_pages_str), max_pages)
+
+
+def open_regular_file(filename: str) -> BinaryIO:
+    """
+    Open a file that a container wrote, if it's a regular file. Raises
+    PixelValidationError if it isn't, since a symlink could point to any file
+    of the user's, and reading a FIFO would block forever.
+    """
+    flags = (
+        os.O_RDONLY
+        | getattr(os, "O_NOFOLLOW", 0)
+        | getattr(os, "O_NONBLOCK", 0)
+        | getattr(os, "O_BINARY", 0)
+    )
+    try:
+        fd = os.open(filename, flags)
+    except OSError as e:
+        if e.errno == errno.ELOOP:
+            raise PixelValidationError(f"{os.path.basename(filename)} is a symlink")
+        raise
+    if not stat.S_ISREG(os.fstat(fd).st_mode):
+        os.close(fd)
+        raise PixelValidationError(f"{os.path.basename(filename)} isn't a regular file")
+    return os.fdopen(fd, "rb")
+
+
+def read_number_file(filename: str) -> str:
+    """
+    Read a file with a number in it that a container wrote, as a string
+    """
+    with open_regular_file(filename) as f:
+        data = f.read(MAX_NUMBER_FILE_BYTES + 1)
+    if len(data) > MAX_NUMBER_FILE_BYTES:
+        raise PixelValidationError(f"{os.path.basename(filename)} is too long")
+    return data.decode(errors="replace").strip()
+
+
+def check_num_pages(num_pages: int, max_pages: Optional[int] = None) -> int:
+    if num_pages <= 0:
+        raise PixelValidationError("Invalid number of pages returned")
+    max_pages = max_pages or DEFAULT_MAX_PAGES
+    if num_pages > max_pages:
+        raise PixelValidationError(
+            f"Document has too many pages ({num_pages}, the maximum is {max_pages})"
+        )
+    return num_pages
+
+
+def format_size(num_bytes: int) -> str:
+    """
+    A number of bytes in the largest unit that keeps it at 1 or more
+    """
+    size = float(num_bytes)
+    for unit in ["bytes", "KB", "MB", "GB"]:
+        if size < 1000:
+            break
+        size /= 1000
+    else:
+        unit = "TB"
+    if unit == "bytes":
+        return f"{num_bytes} bytes"
+    return f"{size:.1f} {unit}"
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Benchmark merging the pages of a document into a single PDF, comparing one
+pdfunite process over all pages with the tree merge that the container does.
+
+It needs poppler's pdfunite, so run it in the container image, from the root
+of the source code tree:
+
+    podman run --rm --network none -v $PWD:/src:ro dangerzone.rocks/dangerzone \\
+        python3 /src/dev_scripts/bench-merge.py
+
+Pages are letter-sized PDFs that are padded with a comment in their content
+stream, to make them about as big as a compressed page of pixels.
+"""
+import argparse
+import importlib.util
+import os
+import subprocess
+import tempfile
+import time
+from typing import List
+
+# Load the conversion script from the source code tree
+spec = importlib.util.spec_from_file_location(
+    "dangerzone_container",
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        "container",
+        "dangerzone.py",
+    ),
+)
+assert spec is not None and spec.loader is not None
+dangerzone_container = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(dangerzone_container)
+
+
+def create_pages(tmp_dir: str, num_pages: int, page_size: int) -> List[str]:
+    content = b"%" + b"x" * page_size + b"\n0 0 0 rg 72 72 468 648 re f"
+    filenames = []
+    for page in range(1, num_pages + 1):
+        filename = os.path.join(tmp_dir, f"page-{page}.pdf")
+        dangerzone_container.write_pdf_page(filename, 612, 792, content)
+        filenames.append(filename)
+    return filenames
+
+
+def bench(num_pages: int, page_size: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filenames = create_pages(tmp_dir, num_pages, page_size)
+
+        start_time = time.monotonic()
+        p = subprocess.run(
+            ["pdfunite"] + filenames + [os.path.join(tmp_dir, "single.pdf")],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        if p.returncode == 0:
+            single = f"{time.monotonic() - start_time:.2f}s"
+        else:
+            single = "failed"
+
+        converter = dangerzone_container.DangerzoneConverter()
+        start_time = time.monotonic()
+        try:
+            converter.merge_pdf_files(
+                filenames,
+                os.path.join(tmp_dir, "tree.pdf"),
+                error_message="Tree merge failed",
+                timeout_message="Tree merge timed out",
+            )
+            tree = f"{time.monotonic() - start_time:.2f}s"
+        except dangerzone_container.ConversionError:
+            tree = "failed"
+
+        print(
+            f"{num_pages:>6} pages: single pdfunite {single:>8}, tree merge {tree:>8}"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--pages",
+        type=int,
+        nargs="+",
+        default=[10, 100, 1000, 5000],
+        help="Page counts to benchmark",
+    )
+    parser.add_argument(
+        "--page-size",
+        type=int,
+        default=100000,
+        help="Approximate size of each page in bytes",
+    )
+    args = parser.parse_args()
+
+    print(
+        f"{os.cpu_count()} CPUs, chunks of {dangerzone_container.MERGE_CHUNK_SIZE} files"
+    )
+    for num_pages in args.pages:
+        bench(num_pages, args.page_size)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Benchmark the host-side validation of document-to-pixels output, on fake
+documents with lots of pages. Pages are letter-sized at 150 DPI, and are
+created as sparse files, so this doesn't need gigabytes of free disk space.
+
+It measures the two ways the validator runs: polling after each page (like
+it does while the container is converting pages), and a final check.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+# Load dangerzone module and resources from the source code tree
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ["DANGERZONE_MODE"] = "cli"
+
+from dangerzone.validation import PixelValidator
+
+WIDTH = 1275
+HEIGHT = 1650
+
+
+def create_page(pixel_dir: str, page: int) -> None:
+    filename_base = os.path.join(pixel_dir, f"page-{page}")
+    with open(f"{filename_base}.rgb", "wb") as f:
+        f.truncate(WIDTH * HEIGHT * 3)
+    with open(f"{filename_base}.width", "w") as f:
+        f.write(str(WIDTH))
+    with open(f"{filename_base}.height", "w") as f:
+        f.write(str(HEIGHT))
+
+
+def bench(num_pages: int) -> None:
+    with tempfile.TemporaryDirectory() as pixel_dir:
+        validator = PixelValidator(pixel_dir)
+        with open(os.path.join(pixel_dir, "num_pages"), "w") as f:
+            f.write(str(num_pages))
+
+        poll_seconds = 0.0
+        for page in range(1, num_pages + 1):
+            create_page(pixel_dir, page)
+            start_time = time.perf_counter()
+            validator.poll()
+            poll_seconds += time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        validator.finish()
+        finish_seconds = time.perf_counter() - start_time
+
+    print(
+        f"{num_pages} pages: "
+        f"{poll_seconds:.3f}s polling ({poll_seconds / num_pages * 1000:.3f}ms per page), "
+        f"{finish_seconds:.3f}s final check"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--pages", type=int, nargs="+", default=[10, 100, 1000], help="Page counts"
+    )
+    args = parser.parse_args()
+    for num_pages in args.pages:
+        bench(num_pages)
+
+
+if __name__ == "__main__":
+    main()
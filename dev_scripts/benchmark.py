@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+"""
+Benchmark converting the sample documents in test_docs, and synthetic
+documents with lots of pages (from generate-documents.py), with and without
+OCR. Each document is
+converted a number of times, and the report has the p50 and p95 latency, the
+time that each stage took, the pages per second, and the bytes per page of
+the safe PDF, for each document.
+
+Save a report, and compare a later one to it, from the root of the source
+code tree:
+
+    ./dev_scripts/benchmark.py --output baseline.json
+    ./dev_scripts/benchmark.py --output new.json --baseline baseline.json
+
+Comparing exits with an error if the latency of any document got worse by
+more than --threshold percent.
+
+With --local, documents are converted without containers, by running the
+conversion script directly (see use_local_executor()). This needs the
+conversion tools of the container to be installed, and is NOT safe for
+untrusted documents.
+"""
+import argparse
+import contextlib
+import glob
+import importlib.util
+import json
+import logging
+import math
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+# Load dangerzone module and resources from the source code tree
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ["DANGERZONE_MODE"] = "cli"
+
+import dangerzone.container
+from dangerzone.container import convert
+from dangerzone.result import ConversionResult, summarize
+
+log = logging.getLogger(__name__)
+
+# The generator of synthetic documents is a script, so load it from its file
+spec = importlib.util.spec_from_file_location(
+    "generate_documents",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "generate-documents.py"),
+)
+assert spec is not None and spec.loader is not None
+generate_documents = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(generate_documents)
+
+TEST_DOCS_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test_docs"
+)
+
+# The conversion script that --local runs
+LOCAL_SCRIPT = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "container",
+    "dangerzone.py",
+)
+
+
+def local_env(extra_args: List[str], tmp_dir: str) -> Dict[str, str]:
+    """
+    The environment variables of extra_args, and the ones that tell the
+    conversion script where its files are instead of the volumes of
+    extra_args. The document is copied into tmp_dir, where the script keeps
+    its scratch files.
+    """
+    env = dict(os.environ)
+    for i in range(0, len(extra_args) - 1, 2):
+        if extra_args[i] == "-e":
+            key, _, value = extra_args[i + 1].partition("=")
+            env[key] = value
+        elif extra_args[i] == "-v":
+            src, _, dst = extra_args[i + 1].rpartition(":")
+            if dst == "/tmp/input_file":
+                shutil.copyfile(src, os.path.join(tmp_dir, "input_file"))
+            elif dst == "/dangerzone":
+                env["DANGERZONE_PIXEL_DIR"] = src
+            elif dst == "/safezone":
+                env["DANGERZONE_SAFE_DIR"] = src
+            elif dst == "/checkpoint":
+                env["DANGERZONE_CHECKPOINT_DIR"] = src
+    env["DANGERZONE_TMP_DIR"] = tmp_dir
+    return env
+
+
+def exec_local(
+    command: List[str],
+    extra_args: List[str] = [],
+    stdout_callback: Callable[[str], None] = None,
+    stats_callback: Optional[Callable[[Dict[str, Any]], None]] = None,
+    endpoint: Optional[dangerzone.container.Endpoint] = None,
+) -> int:
+    """
+    Stands in for exec_container(), and runs the conversion script directly
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        env = local_env(extra_args, tmp_dir)
+        # The command starts with the container's python and script
+        args = [sys.executable, LOCAL_SCRIPT] + command[2:]
+        return dangerzone.container.exec(args, stdout_callback, env)
+
+
+@contextlib.contextmanager
+def stream_local(
+    command: List[str],
+    extra_args: List[str],
+    stats_callback: Callable[[Dict[str, Any]], None],
+    endpoint: Optional[dangerzone.container.Endpoint] = None,
+) -> Iterator["subprocess.Popen[bytes]"]:
+    """
+    Stands in for stream_container(), and runs the conversion script directly
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        env = local_env(extra_args, tmp_dir)
+        env["DANGERZONE_PIXEL_DIR"] = os.path.join(tmp_dir, "pixels")
+        env["DANGERZONE_SAFE_DIR"] = os.path.join(tmp_dir, "safe")
+        args = [sys.executable, LOCAL_SCRIPT] + command[2:]
+        with subprocess.Popen(
+            args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env
+        ) as p:
+            try:
+                yield p
+            finally:
+                if p.poll() is None:
+                    p.terminate()
+
+
+def use_local_executor() -> None:
+    """
+    Convert documents without containers, by replacing the functions that
+    run containers with ones that run the conversion script on this computer.
+    Nothing is sandboxed, so this is only for benchmarks and tests.
+    """
+    log.warning("Converting without containers, this is only for testing")
+    dangerzone.container.exec_container = exec_local
+    dangerzone.container.stream_container = stream_local
+
+
+def percentile(values: List[float], p: float) -> float:
+    """
+    The nearest-rank p-th percentile of values
+    """
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def bench_document(
+    filename: str, ocr_lang: Optional[str], repeat: int, tmp_dir: str
+) -> Dict[str, Any]:
+    results = []
+    output_sizes = []
+    output_filename = os.path.join(tmp_dir, "safe.pdf")
+    for _ in range(repeat):
+        result = ConversionResult()
+        convert(filename, output_filename, ocr_lang, lambda line: None, result=result)
+        results.append(result)
+        if result.success:
+            output_sizes.append(os.path.getsize(output_filename))
+            os.remove(output_filename)
+
+    succeeded = [result for result in results if result.success]
+    latencies = [result.wall_seconds for result in succeeded]
+    num_pages = 0
+    if succeeded and succeeded[0].num_pages:
+        num_pages = succeeded[0].num_pages
+    p50 = percentile(latencies, 50)
+
+    # Average time of each stage, across the successful conversions
+    stages: Dict[str, float] = {}
+    for result in succeeded:
+        for stage, totals in result.stage_totals().items():
+            stages[stage] = stages.get(stage, 0) + totals["wall_seconds"] / len(
+                succeeded
+            )
+
+    return {
+        "runs": len(results),
+        "failures": len(results) - len(succeeded),
+        "pages": num_pages,
+        "p50_seconds": round(p50, 3),
+        "p95_seconds": round(percentile(latencies, 95), 3),
+        "pages_per_second": round(num_pages / p50, 3) if p50 else 0,
+        "output_bytes_per_page": (
+            round(sum(output_sizes) / len(output_sizes) / num_pages)
+            if output_sizes and num_pages
+            else 0
+        ),
+        "stage_seconds": {stage: round(s, 3) for stage, s in stages.items()},
+        "resources": summarize(results),
+    }
+
+
+def compare(report: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> bool:
+    """
+    Print how each document's latency changed since the baseline, and return
+    False if any got worse by more than threshold percent
+    """
+    ok = True
+    print(f"{'document':<32} {'p50':>18} {'p95':>18} {'pages/s':>18}")
+    for name, case in report["cases"].items():
+        if name not in baseline["cases"]:
+            continue
+        base = baseline["cases"][name]
+        columns = []
+        for key in ["p50_seconds", "p95_seconds", "pages_per_second"]:
+            if base[key]:
+                change = (case[key] - base[key]) / base[key] * 100
+            else:
+                change = 0.0
+            columns.append(f"{base[key]:.2f}->{case[key]:.2f} {change:+.0f}%")
+            if key != "pages_per_second" and change > threshold:
+                ok = False
+        print(f"{name:<32} {columns[0]:>18} {columns[1]:>18} {columns[2]:>18}")
+    return ok
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "documents",
+        nargs="*",
+        help="Documents to convert, defaults to everything in test_docs",
+    )
+    parser.add_argument(
+        "--synthetic-pages",
+        type=int,
+        nargs="*",
+        default=[10, 100],
+        help="Also convert synthetic documents with these numbers of pages",
+    )
+    parser.add_argument(
+        "--synthetic-formats",
+        nargs="*",
+        default=["pdf"],
+        choices=list(generate_documents.FORMATS),
+        help="Formats of the synthetic documents (see generate-documents.py)",
+    )
+    parser.add_argument(
+        "--synthetic-content",
+        choices=["text", "photo"],
+        default="text",
+        help="Content of the synthetic documents",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="How many times to convert each"
+    )
+    parser.add_argument(
+        "--ocr-lang",
+        default="eng",
+        help="Language to OCR in the runs with OCR, or nothing to skip them",
+    )
+    parser.add_argument(
+        "--local", action="store_true", help="Convert without containers"
+    )
+    parser.add_argument("--output", help="Save the report to this JSON file")
+    parser.add_argument("--baseline", help="Compare to this saved report")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=10,
+        help="Percent of added latency that counts as a regression",
+    )
+    args = parser.parse_args()
+
+    if args.local:
+        use_local_executor()
+
+    documents = args.documents or sorted(glob.glob(os.path.join(TEST_DOCS_DIR, "*")))
+    ocr_langs: List[Optional[str]] = [None]
+    if args.ocr_lang:
+        ocr_langs.append(args.ocr_lang)
+
+    report: Dict[str, Any] = {
+        "executor": "local" if args.local else "container",
+        "repeat": args.repeat,
+        "cases": {},
+    }
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        page_size = generate_documents.PAGE_SIZES["letter"]
+        image_size = (page_size[0] * 150 // 72, page_size[1] * 150 // 72)
+        for num_pages in args.synthetic_pages:
+            for extension in args.synthetic_formats:
+                documents.append(
+                    generate_documents.generate(
+                        extension,
+                        tmp_dir,
+                        num_pages,
+                        page_size,
+                        args.synthetic_content,
+                        image_size,
+                    )
+                )
+
+        for filename in documents:
+            for ocr_lang in ocr_langs:
+                name = os.path.basename(filename)
+                if ocr_lang:
+                    name += f" (OCR {ocr_lang})"
+                case = bench_document(filename, ocr_lang, args.repeat, tmp_dir)
+                report["cases"][name] = case
+                print(
+                    f"{name:<32} p50 {case['p50_seconds']:>7.2f}s  p95 {case['p95_seconds']:>7.2f}s  "
+                    f"{case['pages_per_second']:>7.2f} pages/s  {case['failures']} failed",
+                    flush=True,
+                )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if not compare(report, baseline, args.threshold):
+            print("Latency regressed")
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
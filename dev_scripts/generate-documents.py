@@ -0,0 +1,460 @@
+#!/usr/bin/env python3
+"""
+Generate synthetic documents for scaling tests, in every format that the
+container converts, with a given number of pages, page size and content.
+
+PDFs, OpenDocument files and images are written directly. The Microsoft
+Office formats are converted from the matching OpenDocument file with
+LibreOffice, and images and photo content need Pillow, so run this in the
+container image, from the root of the source code tree:
+
+    podman run --rm --network none -v $PWD:/src:Z dangerzone.rocks/dangerzone \\
+        python3 /src/dev_scripts/generate-documents.py --pages 5000 pdf
+
+Pages are sheets for spreadsheets, slides for presentations, and frames for
+the image formats that have them (GIF and TIFF).
+"""
+import argparse
+import io
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import zipfile
+from typing import Dict, List, Optional, Tuple
+from xml.sax.saxutils import escape
+
+# Extension: (MIME type that the container expects, OpenDocument extension it's
+# converted from and LibreOffice's filter for it, or None)
+FORMATS: Dict[str, Tuple[str, Optional[Tuple[str, str]]]] = {
+    "pdf": ("application/pdf", None),
+    "docx": (
+        "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+        ("odt", "MS Word 2007 XML"),
+    ),
+    "doc": ("application/msword", ("odt", "MS Word 97")),
+    "docm": (
+        "application/vnd.ms-word.document.macroEnabled.12",
+        ("odt", "MS Word 2007 XML VBA"),
+    ),
+    "xlsx": (
+        "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        ("ods", "Calc MS Excel 2007 XML"),
+    ),
+    "xls": ("application/vnd.ms-excel", ("ods", "MS Excel 97")),
+    "pptx": (
+        "application/vnd.openxmlformats-officedocument.presentationml.presentation",
+        ("odp", "Impress MS PowerPoint 2007 XML"),
+    ),
+    "ppt": ("application/vnd.ms-powerpoint", ("odp", "MS PowerPoint 97")),
+    "odt": ("application/vnd.oasis.opendocument.text", None),
+    "odg": ("application/vnd.oasis.opendocument.graphics", None),
+    "odp": ("application/vnd.oasis.opendocument.presentation", None),
+    "ods": ("application/vnd.oasis.opendocument.spreadsheet", None),
+    "jpg": ("image/jpeg", None),
+    "gif": ("image/gif", None),
+    "png": ("image/png", None),
+    "tif": ("image/tiff", None),
+}
+
+PAGE_SIZES = {"letter": (612, 792), "a4": (595, 842)}
+
+WORDS = (
+    "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod "
+    "tempor incididunt ut labore et dolore magna aliqua"
+).split()
+
+ODF_NAMESPACES = (
+    'xmlns:office="urn:oasis:names:tc:opendocument:xmlns:office:1.0" '
+    'xmlns:style="urn:oasis:names:tc:opendocument:xmlns:style:1.0" '
+    'xmlns:text="urn:oasis:names:tc:opendocument:xmlns:text:1.0" '
+    'xmlns:table="urn:oasis:names:tc:opendocument:xmlns:table:1.0" '
+    'xmlns:draw="urn:oasis:names:tc:opendocument:xmlns:drawing:1.0" '
+    'xmlns:fo="urn:oasis:names:tc:opendocument:xmlns:xsl-fo-compatible:1.0" '
+    'xmlns:svg="urn:oasis:names:tc:opendocument:xmlns:svg-compatible:1.0" '
+    'xmlns:presentation="urn:oasis:names:tc:opendocument:xmlns:presentation:1.0" '
+    'xmlns:xlink="http://www.w3.org/1999/xlink" office:version="1.2"'
+)
+
+
+def text_lines(page: int, num_lines: int) -> List[str]:
+    rng = random.Random(page)
+    return [
+        f"Page {page}, line {line}: " + " ".join(rng.choices(WORDS, k=10))
+        for line in range(1, num_lines + 1)
+    ]
+
+
+def photo(width: int, height: int, seed: int) -> bytes:
+    """
+    A JPEG that's about as hard to compress as a photo: a color gradient with
+    noise over it
+    """
+    from PIL import Image
+
+    rng = random.Random(seed)
+    gradient = Image.linear_gradient("L").resize((width, height))
+    noise = Image.effect_noise((width, height), 64)
+    im = Image.merge(
+        "RGB",
+        [
+            gradient,
+            noise,
+            gradient.rotate(rng.choice([90, 180, 270]), expand=False),
+        ],
+    )
+    buf = io.BytesIO()
+    im.save(buf, "JPEG", quality=85)
+    return buf.getvalue()
+
+
+def write_pdf(
+    filename: str,
+    num_pages: int,
+    page_size: Tuple[int, int],
+    content: str,
+    image_size: Tuple[int, int],
+) -> None:
+    """
+    Write a PDF with num_pages pages of text, or of the same photo
+    """
+    width, height = page_size
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [%s] /Count %d >>"
+        % (
+            b" ".join(b"%d 0 R" % (5 + 2 * i) for i in range(num_pages)),
+            num_pages,
+        ),
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    if content == "photo":
+        jpeg = photo(image_size[0], image_size[1], 0)
+        objects.append(
+            b"<< /Type /XObject /Subtype /Image /Width %d /Height %d "
+            b"/ColorSpace /DeviceRGB /BitsPerComponent 8 /Filter /DCTDecode "
+            b"/Length %d >>\nstream\n%s\nendstream"
+            % (image_size[0], image_size[1], len(jpeg), jpeg)
+        )
+    else:
+        objects.append(b"null")
+
+    for page in range(1, num_pages + 1):
+        if content == "photo":
+            stream = b"q %d 0 0 %d 36 36 cm /Im1 Do Q" % (width - 72, height - 72)
+        else:
+            stream = b"BT /F1 10 Tf 36 %d Td 12 TL " % (height - 48)
+            for line in text_lines(page, (height - 72) // 12):
+                stream += b"(%s) '\n" % line.encode()
+            stream += b"ET"
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d] "
+            b"/Resources << /Font << /F1 3 0 R >> /XObject << /Im1 4 0 R >> >> "
+            b"/Contents %d 0 R >>" % (width, height, len(objects) + 2)
+        )
+        objects.append(
+            b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream)
+        )
+
+    with open(filename, "wb") as f:
+        f.write(b"%PDF-1.4\n")
+        offsets = []
+        for i, obj in enumerate(objects, start=1):
+            offsets.append(f.tell())
+            f.write(b"%d 0 obj\n%s\nendobj\n" % (i, obj))
+        xref_offset = f.tell()
+        f.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+        for offset in offsets:
+            f.write(b"%010d 00000 n \n" % offset)
+        f.write(
+            b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+            % (len(objects) + 1, xref_offset)
+        )
+
+
+def odf_frame(
+    content: str, page: int, x: int, y: int, width: int, height: int, anchor: str
+) -> str:
+    """
+    A frame with the page's text or photo, for OpenDocument files
+    """
+    frame = (
+        f'<draw:frame {anchor} svg:x="{x}pt" svg:y="{y}pt" '
+        f'svg:width="{width}pt" svg:height="{height}pt">'
+    )
+    if content == "photo":
+        frame += (
+            '<draw:image xlink:href="Pictures/photo.jpg" xlink:type="simple" '
+            'xlink:show="embed" xlink:actuate="onLoad"/>'
+        )
+    else:
+        frame += "<draw:text-box>"
+        for line in text_lines(page, height // 14):
+            frame += f"<text:p>{escape(line)}</text:p>"
+        frame += "</draw:text-box>"
+    return frame + "</draw:frame>"
+
+
+def write_odf(
+    filename: str,
+    extension: str,
+    num_pages: int,
+    page_size: Tuple[int, int],
+    content: str,
+    image_size: Tuple[int, int],
+) -> None:
+    """
+    Write an OpenDocument text, spreadsheet, presentation or drawing
+    """
+    width, height = page_size
+    mime_type = FORMATS[extension][0]
+    if extension == "ods":
+        # Spreadsheets only have text
+        content = "text"
+
+    body = ""
+    for page in range(1, num_pages + 1):
+        if extension == "odt":
+            body += f'<text:p text:style-name="PageBreak">Page {page}</text:p>'
+            if content == "photo":
+                body += "<text:p>" + odf_frame(
+                    content,
+                    page,
+                    0,
+                    0,
+                    width - 72,
+                    height - 108,
+                    'text:anchor-type="paragraph"',
+                )
+                body += "</text:p>"
+            else:
+                for line in text_lines(page, (height - 72) // 14):
+                    body += f"<text:p>{escape(line)}</text:p>"
+        elif extension == "ods":
+            body += f'<table:table table:name="Sheet{page}">'
+            for row, line in enumerate(text_lines(page, 50), start=1):
+                body += "<table:table-row>"
+                body += f'<table:table-cell office:value-type="float" office:value="{row}"><text:p>{row}</text:p></table:table-cell>'
+                for word in line.split()[3:10]:
+                    body += f'<table:table-cell office:value-type="string"><text:p>{escape(word)}</text:p></table:table-cell>'
+                body += "</table:table-row>"
+            body += "</table:table>"
+        else:
+            body += (
+                f'<draw:page draw:name="page{page}" draw:master-page-name="Default">'
+            )
+            body += odf_frame(content, page, 36, 36, width - 72, height - 72, "")
+            body += "</draw:page>"
+
+    body_element = {
+        "odt": "office:text",
+        "ods": "office:spreadsheet",
+        "odp": "office:presentation",
+        "odg": "office:drawing",
+    }[extension]
+    content_xml = (
+        f'<?xml version="1.0" encoding="UTF-8"?>'
+        f"<office:document-content {ODF_NAMESPACES}>"
+        f"<office:automatic-styles>"
+        f'<style:style style:name="PageBreak" style:family="paragraph">'
+        f'<style:paragraph-properties fo:break-before="page"/></style:style>'
+        f"</office:automatic-styles>"
+        f"<office:body><{body_element}>{body}</{body_element}></office:body>"
+        f"</office:document-content>"
+    )
+    if extension == "odt":
+        master_page = "Standard"
+    else:
+        master_page = "Default"
+    styles_xml = (
+        f'<?xml version="1.0" encoding="UTF-8"?>'
+        f"<office:document-styles {ODF_NAMESPACES}>"
+        f"<office:automatic-styles>"
+        f'<style:page-layout style:name="Layout"><style:page-layout-properties '
+        f'fo:page-width="{width}pt" fo:page-height="{height}pt" '
+        f'fo:margin-top="36pt" fo:margin-bottom="36pt" fo:margin-left="36pt" '
+        f'fo:margin-right="36pt"/></style:page-layout>'
+        f"</office:automatic-styles>"
+        f'<office:master-styles><style:master-page style:name="{master_page}" '
+        f'style:page-layout-name="Layout"/></office:master-styles>'
+        f"</office:document-styles>"
+    )
+    manifest_xml = (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<manifest:manifest xmlns:manifest="urn:oasis:names:tc:opendocument:xmlns:manifest:1.0" manifest:version="1.2">'
+        f'<manifest:file-entry manifest:full-path="/" manifest:media-type="{mime_type}"/>'
+        '<manifest:file-entry manifest:full-path="content.xml" manifest:media-type="text/xml"/>'
+        '<manifest:file-entry manifest:full-path="styles.xml" manifest:media-type="text/xml"/>'
+    )
+    if content == "photo":
+        manifest_xml += '<manifest:file-entry manifest:full-path="Pictures/photo.jpg" manifest:media-type="image/jpeg"/>'
+    manifest_xml += "</manifest:manifest>"
+
+    with zipfile.ZipFile(filename, "w", zipfile.ZIP_DEFLATED) as z:
+        # The MIME type has to come first, uncompressed
+        z.writestr("mimetype", mime_type, compress_type=zipfile.ZIP_STORED)
+        z.writestr("META-INF/manifest.xml", manifest_xml)
+        z.writestr("content.xml", content_xml)
+        z.writestr("styles.xml", styles_xml)
+        if content == "photo":
+            z.writestr("Pictures/photo.jpg", photo(image_size[0], image_size[1], 0))
+
+
+def write_image(
+    filename: str,
+    extension: str,
+    num_pages: int,
+    content: str,
+    image_size: Tuple[int, int],
+) -> None:
+    """
+    Write an image of text or of a photo, with a frame for each page if the
+    format has frames
+    """
+    from PIL import Image, ImageDraw
+
+    frames = []
+    for page in range(1, num_pages + 1):
+        if content == "photo":
+            im = Image.open(io.BytesIO(photo(image_size[0], image_size[1], page)))
+        else:
+            im = Image.new("RGB", image_size, "white")
+            draw = ImageDraw.Draw(im)
+            for i, line in enumerate(text_lines(page, image_size[1] // 14)):
+                draw.text((10, 10 + i * 14), line, fill="black")
+        if extension == "gif":
+            im = im.convert("P")
+        frames.append(im)
+
+    if extension in ["gif", "tif"]:
+        frames[0].save(filename, save_all=True, append_images=frames[1:])
+    else:
+        if num_pages > 1:
+            print(f"{extension} images can only have one page", file=sys.stderr)
+        frames[0].save(filename)
+
+
+def generate(
+    extension: str,
+    output_dir: str,
+    num_pages: int,
+    page_size: Tuple[int, int],
+    content: str,
+    image_size: Tuple[int, int],
+) -> str:
+    filename = os.path.join(
+        output_dir, f"synthetic-{num_pages}-pages-{content}.{extension}"
+    )
+    mime_type, source = FORMATS[extension]
+    if extension == "pdf":
+        write_pdf(filename, num_pages, page_size, content, image_size)
+    elif extension in ["odt", "ods", "odp", "odg"]:
+        write_odf(filename, extension, num_pages, page_size, content, image_size)
+    elif source is None:
+        write_image(filename, extension, num_pages, content, image_size)
+    else:
+        # Convert the matching OpenDocument file with LibreOffice
+        source_extension, libreoffice_filter = source
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            source_filename = os.path.join(
+                tmp_dir,
+                os.path.basename(filename)[: -len(extension)] + source_extension,
+            )
+            write_odf(
+                source_filename,
+                source_extension,
+                num_pages,
+                page_size,
+                content,
+                image_size,
+            )
+            subprocess.run(
+                [
+                    "libreoffice",
+                    "--headless",
+                    f"-env:UserInstallation=file://{tmp_dir}/profile",
+                    "--convert-to",
+                    f"{extension}:{libreoffice_filter}",
+                    "--outdir",
+                    tmp_dir,
+                    source_filename,
+                ],
+                check=True,
+                stdout=subprocess.DEVNULL,
+            )
+            shutil.move(source_filename[: -len(source_extension)] + extension, filename)
+
+    # Make sure the container will see the expected MIME type
+    try:
+        import magic
+
+        detected = magic.Magic(mime=True).from_file(filename)
+        if detected != mime_type:
+            print(
+                f"{filename} is detected as {detected}, not {mime_type}",
+                file=sys.stderr,
+            )
+    except ImportError:
+        pass
+
+    return filename
+
+
+def parse_size(size: str) -> Tuple[int, int]:
+    if size.lower() in PAGE_SIZES:
+        return PAGE_SIZES[size.lower()]
+    width, _, height = size.lower().partition("x")
+    return int(width), int(height)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "formats",
+        nargs="*",
+        help=f"Formats to generate, defaults to all of them: {', '.join(FORMATS)}",
+    )
+    parser.add_argument("--pages", type=int, default=10, help="Number of pages")
+    parser.add_argument(
+        "--page-size",
+        default="letter",
+        help="Page size: letter, a4, or WIDTHxHEIGHT in points",
+    )
+    parser.add_argument(
+        "--image-size",
+        help="Size of images and photos: WIDTHxHEIGHT in pixels, defaults to the page size at 150 DPI",
+    )
+    parser.add_argument("--content", choices=["text", "photo"], default="text")
+    parser.add_argument("--output-dir", default=".", help="Where to write them")
+    args = parser.parse_args()
+
+    for extension in args.formats:
+        if extension not in FORMATS:
+            parser.error(f"unknown format: {extension}")
+
+    page_size = parse_size(args.page_size)
+    if args.image_size:
+        image_size = parse_size(args.image_size)
+    else:
+        image_size = (page_size[0] * 150 // 72, page_size[1] * 150 // 72)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    for extension in args.formats or list(FORMATS):
+        print(
+            generate(
+                extension,
+                args.output_dir,
+                args.pages,
+                page_size,
+                args.content,
+                image_size,
+            ),
+            flush=True,
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+A stand-in for podman or docker, which returns canned output, to try out how
+dangerzone handles containers without running any. Point dangerzone to it with:
+
+    DANGERZONE_CONTAINER_RUNTIME=dev_scripts/stub-container-runtime.py
+
+"run" prints a progress event, waits for STUB_RUN_SECONDS (2 by default) and
+exits with STUB_EXIT_CODE (0 by default). "run -i" (a streaming conversion)
+runs the conversion script of the source tree instead, without a container,
+which needs its conversion tools to be installed. "stats" prints canned
+resource usage in podman's format, or in docker's when asked for "{{json .}}".
+
+To try out pools of endpoints, "listen" makes a stand-in endpoint at each
+unix socket that it's given, until it's killed:
+
+    dev_scripts/stub-container-runtime.py listen /tmp/a.sock /tmp/b.sock &
+    dangerzone-cli --endpoint unix:///tmp/a.sock=2 --endpoint unix:///tmp/b.sock ...
+
+An endpoint given with --url (podman) or --host (docker) is healthy while
+something listens on its socket, and "image inspect" and "run" fail if not.
+"""
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import List, Optional
+
+PODMAN_STATS = {
+    "id": "0123456789ab",
+    "name": "dangerzone",
+    "cpu_time": "1.5s",
+    "cpu_percent": "75.00%",
+    "avg_cpu": "75.00%",
+    "mem_usage": "128.5MB / 16.6GB",
+    "mem_percent": "0.77%",
+    "net_io": "0B / 0B",
+    "block_io": "12.3MB / 45.6MB",
+    "pids": "3",
+}
+
+DOCKER_STATS = {
+    "BlockIO": "12.3MB / 45.6MB",
+    "CPUPerc": "75.00%",
+    "Container": "dangerzone",
+    "ID": "0123456789ab",
+    "MemPerc": "0.77%",
+    "MemUsage": "122.5MiB / 15.5GiB",
+    "Name": "dangerzone",
+    "NetIO": "0B / 0B",
+    "PIDs": "3",
+}
+
+
+def endpoint_is_up(url: Optional[str]) -> bool:
+    if url is None or not url.startswith("unix://"):
+        return True
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.connect(url[len("unix://") :])
+        return True
+    except OSError:
+        return False
+
+
+def listen(paths: List[str]) -> int:
+    def serve(path: str) -> None:
+        if os.path.exists(path):
+            os.remove(path)
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.bind(path)
+            s.listen()
+            while True:
+                conn, _ = s.accept()
+                conn.close()
+
+    for path in paths:
+        threading.Thread(target=serve, args=(path,), daemon=True).start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        return 0
+
+
+def run_stream(args: List[str]) -> int:
+    """
+    Run the command of "run -i" with the conversion script of the source tree
+    """
+    env = dict(os.environ)
+    i = 0
+    while args[i] != "dangerzone.rocks/dangerzone":
+        if args[i] == "-e":
+            key, _, value = args[i + 1].partition("=")
+            env[key] = value
+        i += 1
+    command = args[i + 1 :]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        env["DANGERZONE_TMP_DIR"] = tmp_dir
+        env["DANGERZONE_PIXEL_DIR"] = os.path.join(tmp_dir, "pixels")
+        env["DANGERZONE_SAFE_DIR"] = os.path.join(tmp_dir, "safe")
+        script = os.path.join(
+            os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            "container",
+            "dangerzone.py",
+        )
+        return subprocess.run(
+            [sys.executable, script] + command[2:], env=env
+        ).returncode
+
+
+def main() -> int:
+    args = sys.argv[1:]
+    url = None
+    while len(args) >= 2 and args[0] in ["--url", "--host", "-H"]:
+        url = args[1]
+        args = args[2:]
+    if not args:
+        return 125
+
+    if args[0] == "listen":
+        return listen(args[1:])
+
+    if args[0] == "image":
+        return 0 if endpoint_is_up(url) else 125
+
+    if not endpoint_is_up(url):
+        print(f"Cannot connect to {url}", file=sys.stderr)
+        return 125
+
+    if args[0] == "stats":
+        if "{{json .}}" in args:
+            print(json.dumps(DOCKER_STATS))
+        else:
+            print(json.dumps([PODMAN_STATS]))
+        return 0
+
+    if args[0] == "run":
+        if "-i" in args:
+            return run_stream(args)
+
+        print(
+            json.dumps(
+                {
+                    "version": 1,
+                    "event": "progress",
+                    "error": False,
+                    "text": f"Stub container on {url or 'local'}",
+                    "percentage": 0,
+                }
+            ),
+            flush=True,
+        )
+        time.sleep(float(os.environ.get("STUB_RUN_SECONDS") or 2))
+        return int(os.environ.get("STUB_EXIT_CODE") or 0)
+
+    return 125
+
+
+if __name__ == "__main__":
+    sys.exit(main())